@@ -0,0 +1,191 @@
+# -- coding: utf-8 --
+"""Local stand-in for the CDS API (v2) used by the benchmarks.
+
+Implements the submit (`POST /api/v2/resources/<name>`), poll
+(`GET /api/v2/tasks/<id>`) and download (`GET /download/<id>`) protocol.
+Each request stays `queue_delay` seconds queued and `processing` seconds
+running before its result of `size` bytes (zeros or `content`) can be
+downloaded. Downloads are throttled to `bandwidth` bytes per second and
+connection and support HTTP Range requests. A share of `failure_rate` of
+the requests fails in CDS with a transient error, a share of `error_rate`
+of the downloads is answered with `503 Service Unavailable`.
+
+    python benchmarks/fakecds.py --port 8080 --queue-delay 2
+"""
+
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BLOCK = 1 << 16
+
+
+class FakeCDS(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(
+        self,
+        port=0,
+        queue_delay=1.0,
+        processing=0.5,
+        size=1 << 20,
+        bandwidth=None,
+        content=None,
+        failure_rate=0.0,
+        error_rate=0.0,
+        seed=0,
+    ):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.queue_delay = queue_delay
+        self.processing = processing
+        self.content = content
+        self.size = size if content is None else len(content)
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/api/v2"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def submit(self, body):
+        with self.lock:
+            request_id = f"fake-{next(self.ids)}"
+            fails = self.random.random() < self.failure_rate
+        self.requests[request_id] = dict(
+            submitted=time.time(), request=body, fails=fails
+        )
+        return self.state(request_id)
+
+    def unavailable(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def state(self, request_id):
+        request = self.requests[request_id]
+        age = time.time() - request["submitted"]
+        reply = dict(request_id=request_id, state="queued")
+        if age >= self.queue_delay:
+            reply["state"] = "running"
+        if age >= self.queue_delay + self.processing and request["fails"]:
+            error = dict(message="An internal error occurred", reason="Try again")
+            return dict(request_id=request_id, state="failed", error=error)
+        if age >= self.queue_delay + self.processing:
+            reply.update(
+                state="completed",
+                location=f"/download/{request_id}",
+                content_length=self.size,
+                content_type="application/x-netcdf",
+            )
+        return reply
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, reply, status=200):
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.startswith("/api/v2/resources/"):
+            return self._json({"message": "not found"}, 404)
+        self._json(self.server.submit(json.loads(body or b"{}")), 202)
+
+    def do_GET(self):
+        request_id = self.path.rsplit("/", 1)[-1]
+        if request_id not in self.server.requests:
+            return self._json({"message": "not found"}, 404)
+        if self.path.startswith("/api/v2/tasks/"):
+            return self._json(self.server.state(request_id))
+        if self.path.startswith("/download/"):
+            if self.server.unavailable():
+                return self._json({"message": "Service Unavailable"}, 503)
+            return self._range(self.headers.get("Range"))
+        self._json({"message": "not found"}, 404)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(self.server.size))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def _range(self, header):
+        size = self.server.size
+        if not header or not header.startswith("bytes="):
+            return self._download(0, size)
+        first, _, last = header[len("bytes=") :].partition("-")
+        start, end = int(first), min(int(last) + 1 if last else size, size)
+        self._download(start, end, 206, f"bytes {start}-{end - 1}/{size}")
+
+    def do_DELETE(self):
+        self.server.requests.pop(self.path.rsplit("/", 1)[-1], None)
+        self.send_response(204)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _download(self, start, end, status=200, content_range=None):
+        self.send_response(status)
+        if content_range:
+            self.send_header("Content-Range", content_range)
+        self.send_header("Content-Type", "application/x-netcdf")
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        content = self.server.content or b"\0" * BLOCK
+        began, sent = time.time(), 0
+        while start < end:
+            n = min(BLOCK, end - start)
+            if self.server.content is None:
+                self.wfile.write(content[:n])
+            else:
+                self.wfile.write(content[start : start + n])
+            start += n
+            sent += n
+            if self.server.bandwidth:
+                ahead = sent / self.server.bandwidth - (time.time() - began)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--queue-delay", type=float, default=1.0)
+    parser.add_argument("--processing", type=float, default=0.5)
+    parser.add_argument("--size", type=int, default=1 << 20)
+    parser.add_argument("--bandwidth", type=float, help="bytes/s per connection")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    server = FakeCDS(
+        args.port,
+        args.queue_delay,
+        args.processing,
+        args.size,
+        args.bandwidth,
+        failure_rate=args.failure_rate,
+        error_rate=args.error_rate,
+    )
+    print(f"Fake CDS listening on {server.url}")
+    server.serve_forever()
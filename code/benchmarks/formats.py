@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""End-to-end retrieval of the same fields as NetCDF and as GRIB.
+
+The fields are encoded like CDS delivers them (16 bit packed NetCDF3 and
+16 bit GRIB1) and served by the fake CDS server (see `fakecds.py`), where
+the conversion to NetCDF takes `netcdf_delay` extra seconds. The GRIB
+retrieval includes the local decode into NetCDF4 (see `datarequests.grib`).
+
+    PYTHONPATH=. python benchmarks/formats.py [time steps] [MiB/s] [netcdf delay]
+"""
+
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import xarray as xr
+
+from fakecds import FakeCDS
+
+LEVELS = [500, 700, 850, 1000]
+GRID = 1.0
+
+
+def fields(steps):
+    """Smooth temperature-like fields on a global grid."""
+    lat = np.arange(90, -90 - GRID / 2, -GRID)
+    lon = np.arange(0, 360, GRID)
+    time = np.datetime64("2000-01-01T00") + np.arange(steps) * np.timedelta64(6, "h")
+    base = 250 + 30 * np.cos(np.deg2rad(lat))[:, None] + 0 * lon
+    data = np.stack(
+        [
+            np.stack([base + 0.01 * level + np.sin(i / 4) for level in LEVELS])
+            for i in range(steps)
+        ]
+    )
+    return xr.Dataset(
+        {"t": (("time", "level", "latitude", "longitude"), data.astype("f4"))},
+        coords=dict(time=time, level=LEVELS, latitude=lat, longitude=lon),
+    )
+
+
+def netcdf(ds, path):
+    scale = float(ds.t.max() - ds.t.min()) / (2 ** 16 - 2)
+    encoding = dict(
+        dtype="int16",
+        scale_factor=scale,
+        add_offset=float(ds.t.min() + ds.t.max()) / 2,
+        _FillValue=-32767,
+    )
+    ds.to_netcdf(path, format="NETCDF3_64BIT", encoding={"t": encoding})
+
+
+def grib(ds, path):
+    import eccodes
+
+    lat, lon = ds.latitude.values, ds.longitude.values
+    with open(path, "wb") as f:
+        for t in ds.time.values:
+            for level in LEVELS:
+                gid = eccodes.codes_grib_new_from_samples("regular_ll_pl_grib1")
+                eccodes.codes_set_key_vals(
+                    gid,
+                    dict(
+                        Ni=len(lon),
+                        Nj=len(lat),
+                        latitudeOfFirstGridPointInDegrees=float(lat[0]),
+                        latitudeOfLastGridPointInDegrees=float(lat[-1]),
+                        longitudeOfFirstGridPointInDegrees=float(lon[0]),
+                        longitudeOfLastGridPointInDegrees=float(lon[-1]),
+                        iDirectionIncrementInDegrees=GRID,
+                        jDirectionIncrementInDegrees=GRID,
+                    ),
+                )
+                stamp = str(t)
+                eccodes.codes_set(gid, "shortName", "t")
+                eccodes.codes_set(gid, "level", level)
+                eccodes.codes_set(gid, "dataDate", int(stamp[:10].replace("-", "")))
+                eccodes.codes_set(gid, "dataTime", int(stamp[11:13]) * 100)
+                eccodes.codes_set(gid, "bitsPerValue", 16)
+                values = ds.t.sel(time=t, level=level).values.astype(float)
+                eccodes.codes_set_values(gid, values.ravel())
+                eccodes.codes_write(gid, f)
+                eccodes.codes_release(gid)
+
+
+def _retrieve(fmt, url, folder, results):
+    os.environ.update(
+        CDSAPI_URL=url,
+        CDSAPI_KEY="0:benchmark",
+        DATAREQUESTS_CATALOG=os.path.join(folder, f"{fmt}.sqlite"),
+        DATAREQUESTS_STAGED="0",
+    )
+    import fakeredis
+    from rq import Queue, SimpleWorker
+    from datarequests import tasks
+
+    queue = Queue(connection=fakeredis.FakeStrictRedis())
+    target = os.path.join(folder, f"{fmt}.nc")
+    request = dict(
+        name="reanalysis-era5-pressure-levels",
+        format=fmt,
+        variable=["temperature"],
+        pressure_level=[str(x) for x in LEVELS],
+        year=["2000"],
+        month=["01"],
+        time=["00:00", "06:00", "12:00", "18:00"],
+        area=[90, -180, -90, 180],
+        target=target,
+    )
+    queue.enqueue(tasks.get_data, kwargs={"request": request})
+    start = time.perf_counter()
+    SimpleWorker([queue], connection=queue.connection).work(
+        burst=True, logging_level="WARNING"
+    )
+    elapsed = time.perf_counter() - start
+    results.put(
+        dict(
+            seconds=elapsed,
+            output_bytes=os.path.getsize(target),
+            failed=queue.failed_job_registry.count,
+        )
+    )
+
+
+def run(fmt, content, folder, bandwidth, processing):
+    server = FakeCDS(
+        queue_delay=1.0, processing=processing, bandwidth=bandwidth, content=content
+    ).start()
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(
+        target=_retrieve, args=(fmt, server.url, folder, results)
+    )
+    p.start()
+    result = results.get()
+    p.join()
+    server.shutdown()
+    result.update(format=fmt, transferred_bytes=len(content))
+    return result
+
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 124
+    bandwidth = float(sys.argv[2]) * (1 << 20) if len(sys.argv) > 2 else 8 << 20
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 5.0
+    ds = fields(steps)
+    with tempfile.TemporaryDirectory() as folder:
+        encoded = {}
+        for fmt, write in (("netcdf", netcdf), ("grib", grib)):
+            path = os.path.join(folder, f"source.{fmt}")
+            write(ds, path)
+            with open(path, "rb") as f:
+                encoded[fmt] = f.read()
+        for fmt, processing in (("netcdf", 0.5 + delay), ("grib", 0.5)):
+            result = run(fmt, encoded[fmt], folder, bandwidth, processing)
+            print(json.dumps(result))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Download time of a single result split into parallel byte ranges.
+
+The fake CDS server throttles every connection, like a long-distance TCP
+stream would be. Each run verifies the size and checksum of the result.
+
+    PYTHONPATH=. python benchmarks/ranges.py [size in MiB] [MiB/s per connection]
+"""
+
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+from fakecds import FakeCDS
+from datarequests import transfer
+
+
+def run(server, url, segments, folder):
+    target = os.path.join(folder, f"{segments}.nc")
+    start = time.perf_counter()
+    sha256 = transfer.fetch(
+        requests.Session(), url, target, server.size, segments=segments
+    )
+    elapsed = time.perf_counter() - start
+    assert os.path.getsize(target) == server.size
+    assert sha256 == _zeros(server.size)
+    os.remove(target)
+    return dict(segments=segments, seconds=elapsed, rate=server.size / elapsed)
+
+
+def _zeros(size):
+    digest = hashlib.sha256()
+    block = b"\0" * (1 << 20)
+    for _ in range(size // len(block)):
+        digest.update(block)
+    digest.update(b"\0" * (size % len(block)))
+    return digest.hexdigest()
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) << 20 if len(sys.argv) > 1 else 128 << 20
+    bandwidth = float(sys.argv[2]) * (1 << 20) if len(sys.argv) > 2 else 32 << 20
+    transfer.MIN_SEGMENT_SIZE = 1 << 20
+    server = FakeCDS(size=size, bandwidth=bandwidth).start()
+    request_id = server.submit({})["request_id"]
+    url = server.url.replace("/api/v2", f"/download/{request_id}")
+    with tempfile.TemporaryDirectory() as folder:
+        for segments in (1, 2, 4, 8):
+            print(json.dumps(run(server, url, segments, folder)))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Submission throughput of `send_request` vs. `send_requests`.
+
+Runs against fakeredis if installed, otherwise against a local Redis on
+localhost:6379 (database 15 is flushed before every run). The catalog and
+the ledger are kept in a temporary folder.
+
+    PYTHONPATH=. python benchmarks/submit.py [number of requests]
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("CDSAPI_URL", "http://localhost/api/v2")
+os.environ.setdefault("CDSAPI_KEY", "0:benchmark")
+FOLDER = tempfile.mkdtemp()
+os.environ.update(
+    DATAREQUESTS_CATALOG=os.path.join(FOLDER, "catalog.sqlite"),
+    DATAREQUESTS_LEDGER=os.path.join(FOLDER, "ledger.sqlite"),
+)
+
+from rq import Queue  # noqa: E402
+from datarequests import era5  # noqa: E402
+from datarequests.defaults import year, month  # noqa: E402
+from datarequests.variables import PRESSURE_LEVELS  # noqa: E402
+
+
+def connection():
+    try:
+        import fakeredis
+    except ImportError:
+        from redis import Redis
+
+        return Redis(host="localhost", db=15)
+    return fakeredis.FakeStrictRedis()
+
+
+def campaign(n, folder):
+    count = 0
+    for v in PRESSURE_LEVELS:
+        for y in year():
+            for m in month():
+                if count == n:
+                    return
+                req = era5.ERA5PressureLevelsRequest(
+                    variable=[v], year=[y], month=[m], pressure_level=[500]
+                )
+                yield req, os.path.join(folder, y, m, f"ERA5.pl.{v}.nc")
+                count += 1
+
+
+def run(name, n, send):
+    redis = connection()
+    redis.flushdb()
+    era5.REDIS_CONNECTION = redis
+    era5.QUE = Queue(connection=redis)
+    with tempfile.TemporaryDirectory() as folder:
+        pairs = list(campaign(n, folder))
+        start = time.perf_counter()
+        send(pairs)
+        elapsed = time.perf_counter() - start
+    return dict(
+        name=name, requests=len(pairs), seconds=elapsed, rate=len(pairs) / elapsed
+    )
+
+
+def single(pairs):
+    for request, output in pairs:
+        request.send_request(output)
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    sys.stdout = open(os.devnull, "w")  # send_request prints every status
+    results = [
+        run("send_request", n, single),
+        run("send_requests", n, era5.send_requests),
+    ]
+    sys.stdout = sys.__stdout__
+    for result in results:
+        print(json.dumps(result))
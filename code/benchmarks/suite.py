@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""End-to-end benchmark suite of the retrieval pipeline.
+
+Every scenario runs in a fresh process against a local fake CDS server
+(see `fakecds.py`) and fakeredis, or a local Redis given with `--redis`
+(the database is flushed). For each number of requests it measures
+
+- `submit`: throughput of `send_request` and `send_requests`
+- `retrieve`: throughput, end-to-end latency percentiles (from sending the
+  requests until each result is on disk) and peak memory for each worker
+  scale; `aio` runs one asyncio worker with `scale` concurrent jobs, `rq`
+  runs `scale` worker processes (requires `--redis`)
+
+Results are JSON lines tagged with the git revision. Two result files of
+different versions are compared with `--compare`:
+
+    PYTHONPATH=. python benchmarks/suite.py --requests 100 1000 --scales 16 64 \\
+        > new.jsonl
+    PYTHONPATH=. python benchmarks/suite.py --compare old.jsonl new.jsonl
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from fakecds import FakeCDS
+
+KEYS = ("benchmark", "name", "engine", "scale", "requests")
+METRICS = ("rate", "p50", "p90", "p99", "peak_rss_kb")
+
+
+def _environment(url, folder, args):
+    os.environ.update(
+        CDSAPI_URL=url,
+        CDSAPI_KEY="0:benchmark",
+        DATAREQUESTS_CATALOG=os.path.join(folder, "catalog.sqlite"),
+        DATAREQUESTS_LEDGER=os.path.join(folder, "ledger.sqlite"),
+        DATAREQUESTS_STAGED="0" if args.blocking else "1",
+        CDS_MAX_INFLIGHT="100000",  # measure the pipeline, not the limits
+        FAILURE_BACKOFF="0.5",
+    )
+
+
+def _connection(args):
+    if args.redis:
+        from redis import Redis
+
+        connection = Redis.from_url(args.redis)
+    else:
+        import fakeredis
+
+        connection = fakeredis.FakeStrictRedis()
+    connection.flushdb()
+    return connection
+
+
+def _campaign(n, folder):
+    from datarequests import era5
+    from datarequests.variables import SINGLE_LEVELS
+
+    count = 0
+    for v in SINGLE_LEVELS:
+        for y in range(1979, 2021):
+            for m in range(1, 13):
+                if count == n:
+                    return
+                request = era5.ERA5SingleLevelsRequest(
+                    variable=[v], year=[y], month=[m], day=[1], time=["00:00"]
+                )
+                yield request, os.path.join(folder, str(y), f"{m:02}", f"{v}.nc")
+                count += 1
+
+
+def _setup(args, folder):
+    from rq import Queue
+    from datarequests import era5
+
+    connection = _connection(args)
+    era5.REDIS_CONNECTION = connection
+    era5.QUE = Queue(connection=connection, default_timeout="1h")
+    return connection
+
+
+def submit(args, n, folder, results):
+    from datarequests import era5
+
+    _setup(args, folder)
+    pairs = list(_campaign(n, folder))
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")  # statuses printed
+    start = time.perf_counter()
+    for request, output in pairs:
+        request.send_request(output)
+    single = time.perf_counter() - start
+    _setup(args, folder)
+    start = time.perf_counter()
+    era5.send_requests(pairs)
+    bulk = time.perf_counter() - start
+    sys.stdout = stdout
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    for name, seconds in (("send_request", single), ("send_requests", bulk)):
+        results.put(dict(name=name, seconds=seconds, rate=n / seconds, peak_rss_kb=rss))
+
+
+def retrieve(args, n, folder, engine, scale, results):
+    from rq import Queue
+    from rq.job import Job
+    from rq.utils import utcnow
+    from datarequests import era5, scheduler
+
+    connection = _setup(args, folder)
+    pairs = list(_campaign(n, folder))
+    ids = [request.job_id for request, _ in pairs]
+    queues = [Queue(name, connection=connection) for name in scheduler.QUEUES]
+    start, sent = time.perf_counter(), utcnow()
+    era5.send_requests(pairs)
+
+    def done():
+        statuses = era5._job_statuses(ids, connection)
+        return all(s in ("finished", "failed") for s in statuses)
+
+    if engine == "aio":
+        asyncio.run(_aio(connection, queues, scale, done))
+    else:
+        _rq(args, connection, queues, scale, done)
+    elapsed = time.perf_counter() - start
+    latencies = sorted(
+        (job.ended_at - sent).total_seconds()  # retries reset `enqueued_at`
+        for job in Job.fetch_many(ids, connection=connection)
+        if job.get_status() == "finished"
+    )
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    result = dict(
+        seconds=elapsed,
+        rate=n / elapsed,
+        finished=len(latencies),
+        failed=n - len(latencies),
+        peak_rss_kb=max(own, workers),
+    )
+    if latencies:
+        result.update(
+            {f"p{p}": scheduler.percentile(latencies, p) for p in (50, 90, 99)}
+        )
+    results.put(result)
+
+
+async def _aio(connection, queues, scale, done):
+    from datarequests import aio, tasks
+
+    loop = asyncio.get_running_loop()
+    worker = asyncio.create_task(aio.Worker(queues, scale).run())
+    while not done():
+        await loop.run_in_executor(None, tasks.poll, connection)
+        await asyncio.sleep(0.2)
+    worker.cancel()
+
+
+def _work(url, names):
+    from redis import Redis
+    from rq import Queue, Worker
+    from datarequests import failures
+
+    connection = Redis.from_url(url)
+    queues = [Queue(name, connection=connection) for name in names]
+    Worker(queues, connection=connection, exception_handlers=[failures.handle]).work(
+        with_scheduler=True, logging_level="WARNING"
+    )
+
+
+def _rq(args, connection, queues, scale, done):
+    from datarequests import tasks
+
+    names = [q.name for q in queues]
+    processes = [
+        multiprocessing.Process(target=_work, args=(args.redis, names))
+        for _ in range(scale)
+    ]
+    for p in processes:
+        p.start()
+    while not done():
+        tasks.poll(connection)
+        time.sleep(0.2)
+    for p in processes:
+        p.terminate()
+        p.join()
+
+
+def _run(target, *args):
+    """Run a scenario in a fresh process and return its results."""
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=target, args=(*args, results))
+    p.start()
+    p.join()
+    found = []
+    while not results.empty():
+        found.append(results.get())
+    return found
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Ratio new/old of the metrics of all scenarios in both files."""
+
+    def load(path):
+        with open(path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+        return {tuple(r.get(k) for k in KEYS): r for r in rows}
+
+    before, after = load(old), load(new)
+    for key in sorted(set(before) & set(after), key=str):
+        ratios = {
+            m: after[key][m] / before[key][m]
+            for m in METRICS
+            if before[key].get(m) and after[key].get(m) is not None
+        }
+        print(json.dumps(dict(zip(KEYS, key), **ratios)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--scales", type=int, nargs="+", default=[16, 64])
+    parser.add_argument("--engines", nargs="+", default=["aio"])
+    parser.add_argument("--redis", help="e.g. redis://localhost:6379/15")
+    parser.add_argument("--blocking", action="store_true", help="not staged")
+    parser.add_argument("--queue-delay", type=float, default=1.0)
+    parser.add_argument("--processing", type=float, default=0.5)
+    parser.add_argument("--size", type=int, default=1 << 20)
+    parser.add_argument("--bandwidth", type=float, help="bytes/s per connection")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+    if args.compare:
+        return compare(*args.compare)
+    if "rq" in args.engines and not args.redis:
+        parser.error("the rq engine needs --redis")
+    server = FakeCDS(
+        queue_delay=args.queue_delay,
+        processing=args.processing,
+        size=args.size,
+        bandwidth=args.bandwidth,
+        failure_rate=args.failure_rate,
+        error_rate=args.error_rate,
+    ).start()
+    tag = dict(
+        revision=revision(),
+        staged=not args.blocking,
+        failure_rate=args.failure_rate,
+        error_rate=args.error_rate,
+    )
+    for n in args.requests:
+        with tempfile.TemporaryDirectory() as folder:
+            _environment(server.url, folder, args)
+            for result in _run(submit, args, n, folder):
+                print(json.dumps(dict(result, benchmark="submit", requests=n, **tag)))
+        for engine in args.engines:
+            for scale in args.scales:
+                with tempfile.TemporaryDirectory() as folder:
+                    _environment(server.url, folder, args)
+                    for result in _run(retrieve, args, n, folder, engine, scale):
+                        result.update(
+                            benchmark="retrieve",
+                            engine=engine,
+                            scale=scale,
+                            requests=n,
+                            **tag,
+                        )
+                        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
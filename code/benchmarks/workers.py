@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Worker throughput of one process per download vs. the asyncio worker.
+
+Both models retrieve the same number of requests from a local fake CDS
+server (see `fakecds.py`). The process model runs `processes` blocking
+`cdsapi` clients in parallel, as `--scale worker=N` does. The asyncio
+model runs a single `datarequests.aio.Worker` on a fakeredis queue.
+
+    PYTHONPATH=. python benchmarks/workers.py [requests] [processes] [concurrency]
+"""
+
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+from fakecds import FakeCDS
+
+
+def _environment(url, folder):
+    os.environ["CDSAPI_URL"] = url
+    os.environ["CDSAPI_KEY"] = "0:benchmark"
+    os.environ["DATAREQUESTS_CATALOG"] = os.path.join(folder, "catalog.sqlite")
+    os.environ.setdefault("CDS_MAX_INFLIGHT", "1024")  # compare engines, not limits
+
+
+def _retrieve(args):
+    url, target = args
+    import cdsapi
+
+    client = cdsapi.Client(url=url, key="0:benchmark", quiet=True, progress=False)
+    client.retrieve("reanalysis-era5-single-levels", {"variable": "x"}, target)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def processes(url, n, folder, workers):
+    targets = [(url, os.path.join(folder, f"{i}.nc")) for i in range(n)]
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, maxtasksperchild=None) as pool:
+        rss = max(pool.map(_retrieve, targets, chunksize=1))
+    elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, peak_rss_kb=rss * workers)
+
+
+def _aio(url, n, folder, concurrency, results):
+    _environment(url, folder)
+    import fakeredis
+    from rq import Queue
+    from datarequests import aio, tasks
+
+    queue = Queue(connection=fakeredis.FakeStrictRedis())
+    for i in range(n):
+        req = dict(
+            name="reanalysis-era5-single-levels",
+            variable=["2m_temperature"],
+            year=["2000"],
+            month=["01"],
+            day=["01"],
+            time=["00:00"],
+            area=[90, -180, -90, 180],
+            target=os.path.join(folder, f"{i}.nc"),
+        )
+        queue.enqueue(tasks.get_data, kwargs={"request": req})
+    start = time.perf_counter()
+    aio.Worker([queue], concurrency).work(burst=True)
+    elapsed = time.perf_counter() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(
+        dict(seconds=elapsed, peak_rss_kb=rss, failed=queue.failed_job_registry.count)
+    )
+
+
+def asyncio_worker(url, n, folder, concurrency):
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(
+        target=_aio, args=(url, n, folder, concurrency, results)
+    )
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 64
+    server = FakeCDS(queue_delay=1.0, processing=0.5).start()
+    with tempfile.TemporaryDirectory() as folder:
+        _environment(server.url, folder)
+        for name, result in (
+            ("processes", processes(server.url, n, folder, workers)),
+            ("asyncio", asyncio_worker(server.url, n, folder, concurrency)),
+        ):
+            result.update(name=name, requests=n, rate=n / result["seconds"])
+            print(json.dumps(result))
@@ -0,0 +1,144 @@
+# -- coding: utf-8 --
+"""Pool of CDS accounts to spread requests across.
+
+Credentials are read from `CDSAPI_KEYS` as comma separated `UID:API_KEY`
+pairs; without it the single account of `~/.cdsapirc` is used. Each job
+is assigned the account with the lowest load (requests in flight relative
+to its limit) that has a free slot, when it submits to CDS. Per-account
+counters are kept in Redis to compare the throughput of the accounts:
+
+    python -m datarequests.accounts
+"""
+
+import os
+import time
+
+import cdsapi
+import requests
+
+from . import limits
+from . import transfer
+
+COUNTERS = "datarequests:account:{}"
+WAIT = int(os.environ.get("CDS_SLOT_WAIT", 60))  # seconds until tried again
+# Connections kept per account, shared by all downloads of a process
+POOL_SIZE = int(os.environ.get("CDS_POOL_SIZE", max(10, transfer.SEGMENTS)))
+
+
+class Busy(Exception):
+    """No account has a free slot (submissions are scheduled again)."""
+
+
+class Account:
+    """Clients of a single CDS account."""
+
+    def __init__(self, url=None, key=None, verify=None):
+        self.client = _client(url, key, verify)
+        self.name = self.client.key.split(":", 1)[0]
+        # Submissions return immediately and must not be deleted on CDS when
+        # the result object is garbage collected; the poller picks them up.
+        self.submitter = _client(
+            url, key, verify, wait_until_complete=False, delete=False
+        )
+
+    @property
+    def url(self):
+        return self.client.url
+
+    @property
+    def key(self):
+        return self.client.key
+
+    @property
+    def verify(self):
+        return self.client.verify
+
+    def limiter(self, connection):
+        return limits.Limiter(connection, self.name)
+
+
+def _client(url, key, verify, **kwargs):
+    client = cdsapi.Client(url=url, key=key, verify=verify, **kwargs)
+    # A session per client, cdsapi would share one between all accounts
+    client.session = requests.Session()
+    client.session.auth = tuple(client.key.split(":", 1))
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=POOL_SIZE)
+    client.session.mount("https://", adapter)
+    client.session.mount("http://", adapter)
+    return client
+
+
+def load():
+    keys = [k.strip() for k in os.environ.get("CDSAPI_KEYS", "").split(",")]
+    if not any(keys):
+        return {a.name: a for a in [Account()]}
+    url = os.environ.get("CDSAPI_URL", "https://cds.climate.copernicus.eu/api/v2")
+    return {a.name: a for a in (Account(url, k) for k in keys if k)}
+
+
+ACCOUNTS = load()
+
+
+def get(name):
+    return ACCOUNTS[name]
+
+
+def acquire(connection, token, poll=5):
+    """Block until an account has a free slot for `token`.
+
+    Only for blocking retrievals, slots may be taken for hours.
+    """
+    while True:
+        account = try_acquire(connection, token)
+        if account is not None:
+            return account
+        time.sleep(poll)
+
+
+def try_acquire(connection, token):
+    """Least loaded account with a free slot for `token` (or `None`)."""
+    for account in sorted(ACCOUNTS.values(), key=lambda a: load_of(connection, a)):
+        if account.limiter(connection).try_acquire(token):
+            return account
+    return None
+
+
+def load_of(connection, account):
+    limiter = account.limiter(connection)
+    return limiter.inflight() / limiter.limit
+
+
+def count(connection, account, **values):
+    """Add `values` to the counters of `account`."""
+    with connection.pipeline() as pipe:
+        for field, value in values.items():
+            pipe.hincrbyfloat(COUNTERS.format(account.name), field, value)
+        pipe.execute()
+
+
+def stats(connection):
+    """Counters, load and derived throughput per account."""
+    result = {}
+    for name, account in ACCOUNTS.items():
+        values = connection.hgetall(COUNTERS.format(name))
+        values = {k.decode(): float(v) for k, v in values.items()}
+        limiter = account.limiter(connection)
+        values.update(inflight=limiter.inflight(), limit=limiter.limit)
+        if values.get("download_seconds"):
+            values["bytes_per_second"] = values["bytes"] / values["download_seconds"]
+        if values.get("started"):
+            values["mean_queue_seconds"] = values["queue_seconds"] / values["started"]
+        result[name] = values
+    return result
+
+
+if __name__ == "__main__":
+    import json
+
+    from redis import Redis
+
+    connection = Redis(
+        host=os.environ.get("REDIS_HOST", "redis"),
+        port=int(os.environ.get("REDIS_PORT", 6379)),
+    )
+    print(json.dumps(stats(connection), indent=2))
@@ -0,0 +1,265 @@
+# -- coding: utf-8 --
+"""Asyncio worker running many retrievals within a single process.
+
+A classic RQ worker forks a work horse per job and blocks it for the whole
+submit, queue and download cycle of a CDS request. This worker takes jobs
+from the same queues but keeps up to `concurrency` of them in flight at
+once. Retrieval jobs (`get_data`, `submit` and `download`) run natively on
+the event loop: submissions and state requests of all accounts share a
+single aiohttp connection pool. Results are downloaded by `transfer.fetch`
+(resumed, verified and segmented as by the other workers) in a pool of
+threads over the connection pool of each account (see `accounts`), at most
+`CDS_POOL_SIZE // DOWNLOAD_SEGMENTS` at once. All other jobs (e.g.
+`merge`) are performed in a thread pool. Failed retrievals are retried or
+split (see `failures`); the worker enqueues due retries itself.
+
+    python -m datarequests.aio [queue ...]  # default: all queues
+"""
+
+import asyncio
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from redis import Redis
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.registry import (
+    FailedJobRegistry,
+    FinishedJobRegistry,
+    ScheduledJobRegistry,
+    StartedJobRegistry,
+)
+from rq.utils import utcnow
+
+from . import accounts
+from . import failures
+from . import metrics
+from . import scheduler
+from . import space
+from . import tasks
+from . import transfer
+
+CONCURRENCY = int(os.environ.get("AIO_CONCURRENCY", 64))
+SLEEP_MAX = 120
+# Downloads at once, their segments must fit into the pool of an account
+DOWNLOADS = max(1, accounts.POOL_SIZE // transfer.SEGMENTS)
+
+
+class CDS:
+    """Minimal asynchronous client for the CDS API (v2)."""
+
+    def __init__(self, session, account):
+        self.account = account
+        self.url = account.url
+        self.session = session
+        self.auth = aiohttp.BasicAuth(*account.key.split(":", 1))
+        self.ssl = None if account.verify else False
+
+    async def _json(self, method, url, **kwargs):
+        async with self.session.request(
+            method, url, auth=self.auth, ssl=self.ssl, **kwargs
+        ) as r:
+            reply = await r.json(content_type=None)
+            if r.status >= 400:
+                raise Exception(reply.get("message", r.reason))
+            return reply
+
+    async def submit(self, name, params):
+        return await self._json("POST", f"{self.url}/resources/{name}", json=params)
+
+    async def state(self, request_id):
+        return await self._json("GET", f"{self.url}/tasks/{request_id}")
+
+    async def wait(self, reply, limiter, job):
+        connection = limiter.connection
+        submitted, started, sleep = time.time(), None, 1
+        while reply["state"] in ("queued", "running"):
+            await asyncio.sleep(sleep)
+            sleep = min(sleep * 1.5, SLEEP_MAX)
+            state, reply = reply["state"], await self.state(reply["request_id"])
+            if state == "queued" and reply["state"] != "queued":
+                started = time.time()
+                tasks._started(connection, self.account, limiter, started - submitted)
+        accounts.count(connection, self.account, **{reply["state"]: 1})
+        finished = time.time()
+        started = started or finished
+        metrics.add(
+            job, cds_queue=started - submitted, cds_processing=finished - started
+        )
+        return reply
+
+
+class Worker:
+    """Work on up to `concurrency` jobs of `queues` at the same time."""
+
+    def __init__(self, queues, concurrency=CONCURRENCY):
+        self.queues = queues
+        self.connection = queues[0].connection
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max(4, concurrency // 8))
+        self.downloads = ThreadPoolExecutor(min(concurrency, DOWNLOADS))
+
+    def work(self, burst=False):
+        asyncio.run(self.run(burst))
+
+    async def run(self, burst=False):
+        slots = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            cds = {name: CDS(session, a) for name, a in accounts.ACCOUNTS.items()}
+            running = set()
+            while True:
+                await slots.acquire()
+                dequeued = Queue.dequeue_any(self.queues, None, self.connection)
+                if dequeued is None:
+                    slots.release()
+                    self.enqueue_scheduled()
+                    if burst and not running:
+                        return
+                    await asyncio.sleep(0.1 if running else 1)
+                    continue
+                task = asyncio.create_task(self.perform(cds, *dequeued))
+                running.add(task)
+                task.add_done_callback(running.discard)
+                task.add_done_callback(lambda _: slots.release())
+
+    async def perform(self, cds, job, queue):
+        loop = asyncio.get_running_loop()
+        started = StartedJobRegistry(queue=queue)
+        job.started_at = utcnow()
+        job.set_status(JobStatus.STARTED)
+        started.add(job, -1)
+        try:
+            native = {
+                f"{tasks.__name__}.get_data": self._get_data,
+                f"{tasks.__name__}.submit": self._submit,
+                f"{tasks.__name__}.download": self._download,
+            }.get(job.func_name)
+            if native is not None:
+                scheduler.observe(job)
+                result = await native(cds, job, **job.kwargs)
+            else:
+                result = await loop.run_in_executor(self.executor, job.perform)
+        except Exception:
+            job.ended_at = utcnow()
+            error = traceback.format_exc()
+            job._exc_info = error
+            job.set_status(JobStatus.FAILED)
+            job.save()
+            FailedJobRegistry(queue=queue).add(job, job.failure_ttl, exc_string=error)
+            failures.handle(job, *sys.exc_info())
+            queue.enqueue_dependents(job)  # e.g. cleanups allowing failures
+        else:
+            job.ended_at = utcnow()
+            job._result = result
+            job.set_status(JobStatus.FINISHED)
+            job.save()
+            FinishedJobRegistry(queue=queue).add(job, job.result_ttl or 500)
+            queue.enqueue_dependents(job)
+        finally:
+            started.remove(job)
+
+    def enqueue_scheduled(self):
+        """Enqueue scheduled jobs that are due, e.g. retries (see `failures`)."""
+        for queue in self.queues:
+            registry = ScheduledJobRegistry(queue=queue)
+            for job_id in registry.get_jobs_to_schedule():
+                if self.connection.zrem(registry.key, job_id):  # by one worker only
+                    queue.enqueue_job(Job.fetch(job_id, connection=self.connection))
+
+    async def _get_data(self, cds, job, request):
+        name, params, target = tasks.split(request)
+        await self._reserve(job, target, space.predict(params))
+        try:
+            account = await self._acquire(job.id)
+            limiter = account.limiter(self.connection)
+            try:
+                reply = await self._submit_to(cds[account.name], limiter, name, params)
+                reply = await cds[account.name].wait(reply, limiter, job)
+            finally:
+                limiter.release(job.id)
+            source = tasks._source(params, target)
+            await self._fetch(cds[account.name], job, reply, source)
+            await self._decode(job, params, target)
+        finally:
+            space.release(self.connection, job.id, target)
+        metrics.record(job, name, params)
+        await self._finalise(request)
+
+    async def _submit(self, cds, job, request, download_id):
+        name, params, _ = tasks.split(request)
+        account = await self._acquire(download_id)
+        limiter = account.limiter(self.connection)
+        try:
+            reply = await self._submit_to(cds[account.name], limiter, name, params)
+        except Exception:
+            limiter.release(download_id)
+            raise
+        job.meta.update(request_id=reply["request_id"], account=account.name)
+        job.save_meta()
+        tasks.pending(self.connection, reply["request_id"], download_id, account)
+        return reply["request_id"]
+
+    async def _reserve(self, job, target, size):
+        while not space.try_reserve(self.connection, job.id, target, size):
+            await asyncio.sleep(30)
+
+    async def _acquire(self, token):
+        while True:
+            account = accounts.try_acquire(self.connection, token)
+            if account is not None:
+                return account
+            await asyncio.sleep(5)
+
+    async def _submit_to(self, cds, limiter, name, params):
+        try:
+            reply = await cds.submit(name, params)
+        except Exception:
+            limiter.observe(error=True)
+            accounts.count(self.connection, cds.account, errors=1)
+            raise
+        accounts.count(self.connection, cds.account, submitted=1)
+        return reply
+
+    async def _download(self, cds, job, request):
+        name, params, target = tasks.split(request)
+        if job.meta["cds"]["state"] == "completed":
+            size = int(job.meta["cds"]["content_length"])
+            await self._reserve(job, target, size)
+        try:
+            source = tasks._source(params, target)
+            await self._fetch(cds[job.meta["account"]], job, job.meta["cds"], source)
+            await self._decode(job, params, target)
+        finally:
+            space.release(self.connection, job.id, target)
+        metrics.record(job, name, params)
+        await self._finalise(request)
+
+    async def _fetch(self, cds, job, reply, target):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.downloads, tasks._download, cds.account, reply, target, job
+        )
+
+    async def _decode(self, job, params, target):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, tasks._decode, job, params, target)
+
+    async def _finalise(self, request):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor, tasks._finalise, request, self.connection
+        )
+
+
+if __name__ == "__main__":
+    connection = Redis(
+        host=os.environ.get("REDIS_HOST", "redis"),
+        port=int(os.environ.get("REDIS_PORT", 6379)),
+    )
+    names = sys.argv[1:] or scheduler.QUEUES
+    Worker([Queue(name, connection=connection) for name in names]).work()
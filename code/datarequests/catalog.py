@@ -0,0 +1,242 @@
+# -- coding: utf-8 --
+"""Local catalog of the data already downloaded.
+
+Every finished file is recorded with the hypercube it covers, except
+intermediate files (chunks and combined retrievals, flagged `intermediate`
+in their request dict) which are removed soon. A cell of the cube is
+identified by dataset, area, variable, level and date; the hours of a cell
+are stored as a 24 bit mask to keep the number of rows small. The catalog lives next to the Redis dump in `rstore` which is
+shared by the `code` and `worker` containers.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+
+PATH = os.environ.get(
+    "DATAREQUESTS_CATALOG",
+    os.path.join(os.path.dirname(__file__), "..", "rstore", "catalog.sqlite"),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    dataset TEXT NOT NULL,
+    north REAL NOT NULL,
+    west REAL NOT NULL,
+    south REAL NOT NULL,
+    east REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cells (
+    file INTEGER NOT NULL REFERENCES files(id) ON DELETE CASCADE,
+    variable TEXT NOT NULL,
+    level INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    hours INTEGER NOT NULL,
+    PRIMARY KEY (variable, date, level, file)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cells_file ON cells (file);
+CREATE TABLE IF NOT EXISTS refs (
+    file INTEGER PRIMARY KEY REFERENCES files(id) ON DELETE CASCADE,
+    refs TEXT NOT NULL
+);
+"""
+
+SURFACE = 0  # level of single level variables
+
+
+def connect(path=None):
+    path = path or PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA foreign_keys=ON")
+    db.executescript(SCHEMA)
+    return db
+
+
+def dates(params):
+    """Valid dates of a request (e.g. skipping the 31st of February)."""
+    for y in params["year"]:
+        for m in params["month"]:
+            for d in params.get("day", ["01"]):
+                try:
+                    yield datetime.date(int(y), int(m), int(d)).isoformat()
+                except ValueError:
+                    continue
+
+
+def levels(params):
+    return [int(x) for x in params.get("pressure_level", [SURFACE])]
+
+
+def hours(params):
+    mask = 0
+    for t in params["time"]:
+        mask |= 1 << int(t[:2])
+    return mask
+
+
+def record(name, params, path, db=None):
+    """Record the cube covered by the file at `path`."""
+    db = db or connect()
+    north, west, south, east = params["area"]
+    mask = hours(params)
+    with db:
+        db.execute("DELETE FROM files WHERE path = ?", (path,))
+        file = db.execute(
+            "INSERT INTO files (path, dataset, north, west, south, east)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (path, name, north, west, south, east),
+        ).lastrowid
+        db.executemany(
+            "INSERT INTO cells VALUES (?, ?, ?, ?, ?)",
+            (
+                (file, v, level, date, mask)
+                for v in params["variable"]
+                for level in levels(params)
+                for date in dates(params)
+            ),
+        )
+
+
+def forget(paths, db=None):
+    db = db or connect()
+    with db:
+        db.executemany("DELETE FROM files WHERE path = ?", ((p,) for p in paths))
+
+
+def covered(name, params, db=None):
+    """Map of `(variable, level, date)` to the hours covered as bit mask."""
+    db = db or connect()
+    dd = sorted(dates(params))
+    if not dd:
+        return {}
+    rows = db.execute(
+        f"""
+        SELECT c.variable, c.level, c.date, c.hours FROM cells c
+        JOIN files f ON f.id = c.file
+        WHERE f.dataset = ? AND f.north = ? AND f.west = ? AND f.south = ?
+        AND f.east = ? AND c.variable IN ({",".join("?" * len(params["variable"]))})
+        AND c.date BETWEEN ? AND ?
+        """,
+        (name, *params["area"], *params["variable"], dd[0], dd[-1]),
+    )
+    result = {}
+    for variable, level, date, mask in rows:
+        key = (variable, level, date)
+        result[key] = result.get(key, 0) | mask
+    return result
+
+
+def files(name, params, db=None):
+    """Files of the requested area covering any cell of the request."""
+    db = db or connect()
+    rows = db.execute(
+        """
+        SELECT DISTINCT f.path FROM files f JOIN cells c ON c.file = f.id
+        WHERE f.dataset = :name AND f.north = :north AND f.west = :west
+        AND f.south = :south AND f.east = :east
+        AND c.variable IN (SELECT value FROM json_each(:variables))
+        AND c.level IN (SELECT value FROM json_each(:levels))
+        AND c.date IN (SELECT value FROM json_each(:dates))
+        AND c.hours & :hours != 0
+        ORDER BY f.id
+        """,
+        dict(
+            zip(("north", "west", "south", "east"), params["area"]),
+            name=name,
+            variables=json.dumps(params["variable"]),
+            levels=json.dumps(levels(params)),
+            dates=json.dumps(sorted(set(dates(params)))),
+            hours=hours(params),
+        ),
+    )
+    return [p for (p,) in rows if os.path.exists(p)]
+
+
+def superset(name, params, exact_variables=False, db=None):
+    """Smallest single file containing the whole request (or `None`).
+
+    The area of the file must contain the requested area and the file must
+    cover all requested cells and hours. With `exact_variables` the file
+    must not contain any other variable.
+    """
+    db = db or connect()
+    north, west, south, east = params["area"]
+    cells = len(params["variable"]) * len(levels(params)) * len(set(dates(params)))
+    if not cells:
+        return None
+    others = """
+        AND NOT EXISTS (SELECT 1 FROM cells o WHERE o.file = f.id
+        AND o.variable NOT IN (SELECT value FROM json_each(:variables)))
+    """
+    rows = db.execute(
+        f"""
+        SELECT f.path FROM files f JOIN cells c ON c.file = f.id
+        WHERE f.dataset = :name AND f.north >= :north AND f.west <= :west
+        AND f.south <= :south AND f.east >= :east
+        AND c.variable IN (SELECT value FROM json_each(:variables))
+        AND c.level IN (SELECT value FROM json_each(:levels))
+        AND c.date IN (SELECT value FROM json_each(:dates))
+        AND c.hours & :hours = :hours {others if exact_variables else ""}
+        GROUP BY f.id HAVING COUNT(*) = :cells
+        ORDER BY (f.north - f.south) * (f.east - f.west)
+        """,
+        dict(
+            name=name,
+            north=north,
+            west=west,
+            south=south,
+            east=east,
+            variables=json.dumps(params["variable"]),
+            levels=json.dumps(levels(params)),
+            dates=json.dumps(sorted(set(dates(params)))),
+            hours=hours(params),
+            cells=cells,
+        ),
+    )
+    for (path,) in rows:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def remainder(name, params, db=None):
+    """Reduce `params` to the part not yet covered by the catalog.
+
+    Slices along variable, level, year, month, day and time that are fully
+    covered are removed. The result is the smallest cube containing all
+    uncovered cells or `None` if everything is covered already.
+    """
+    cover = covered(name, params, db)
+    needed = hours(params)
+    params = dict(params)
+    cells = [
+        (v, level, date)
+        for v in params["variable"]
+        for level in levels(params)
+        for date in dates(params)
+        if cover.get((v, level, date), 0) & needed != needed
+    ]
+    if not cells:
+        return None
+    params["variable"] = [v for v in params["variable"] if v in {c[0] for c in cells}]
+    if "pressure_level" in params:
+        missing = {c[1] for c in cells}
+        params["pressure_level"] = [
+            x for x in params["pressure_level"] if int(x) in missing
+        ]
+    # Values without any valid date (e.g. day 31 in February) are kept
+    valid, missing = set(dates(params)), {c[2] for c in cells}
+    for axis, a, b in (("year", 0, 4), ("month", 5, 7), ("day", 8, 10)):
+        if axis in params:
+            covered_only = {d[a:b] for d in valid} - {d[a:b] for d in missing}
+            params[axis] = [x for x in params[axis] if x not in covered_only]
+    absent = 0
+    for c in cells:
+        absent |= needed & ~cover.get(c, 0)
+    params["time"] = [t for t in params["time"] if absent & 1 << int(t[:2])]
+    return params
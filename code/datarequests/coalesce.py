@@ -0,0 +1,69 @@
+# -- coding: utf-8 --
+"""Coalesce many small requests into fewer CDS retrievals.
+
+Every CDS request pays the queueing latency of the CDS broker. Requests
+that only differ along a single axis (e.g. same variable, adjacent months)
+are therefore combined into one retrieval. The members keep their own
+selection so that the combined file can be split up locally afterwards.
+"""
+
+import json
+
+from . import planner
+from . import variables
+
+AXES = ("month", "year", "day", "time", "pressure_level", "variable")
+
+
+def group(pairs, max_fields=None):
+    """Group `(request, output)` pairs into combined retrievals.
+
+    Returns a list of `(combined, members)` tuples. `members` holds the
+    original `(request, output)` pairs served by the `combined` request.
+    """
+    max_fields = max_fields or planner.MAX_FIELDS
+    groups = [(req, [(req, output)]) for req, output in pairs]
+    for axis in AXES:
+        keyed = {}
+        for combined, members in groups:
+            keyed.setdefault(_key(combined, axis), []).append((combined, members))
+        groups = []
+        for items in keyed.values():
+            groups.extend(_combine(items, axis, max_fields))
+    return groups
+
+
+def _key(request, axis):
+    if not hasattr(request, axis) or not _mergeable(request, axis):
+        return id(request)
+    others = {
+        k: sorted(v) if k != "area" and isinstance(v, list) else v
+        for k, v in request._request.items()
+        if k != axis
+    }
+    return json.dumps([request.name, others], sort_keys=True)
+
+
+def _mergeable(request, axis):
+    if axis != "variable":
+        return True
+    return all(v in variables.SHORT_NAMES for v in request.variable)
+
+
+def _combine(items, axis, max_fields):
+    if len(items) == 1:  # e.g. no such axis (see `_key`)
+        return items
+    items = sorted(items, key=lambda item: sorted(getattr(item[0], axis)))
+    combined, members = items[0][0], list(items[0][1])
+    result = []
+    for request, more in items[1:]:
+        values = sorted(set(getattr(combined, axis)) | set(getattr(request, axis)))
+        candidate = planner.derive(combined, **{axis: values})
+        if planner.fields(candidate) > max_fields:
+            result.append((combined, members))
+            combined, members = request, list(more)
+        else:
+            combined = candidate
+            members.extend(more)
+    result.append((combined, members))
+    return result
@@ -0,0 +1,104 @@
+# -- coding: utf-8 --
+"""Consolidate finished files into one time series store per variable.
+
+With `CONSOLIDATE_ROOT` set, every finished file is appended along the time
+axis to a Zarr store per dataset, variable, area and pressure levels below
+that folder. Only time steps missing in the store are written, existing
+data is never rewritten. A Redis lock per store serialises the appends of
+concurrent workers. Months finishing out of order are appended as well;
+`open_dataset` sorts the time axis lazily.
+
+    from datarequests import consolidate
+    ds = consolidate.open_dataset("reanalysis-era5-single-levels", "2m_temperature")
+"""
+
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import xarray as xr
+
+from . import conversion
+from . import variables
+
+ROOT = os.environ.get("CONSOLIDATE_ROOT")
+CHUNKS = os.environ.get(
+    "CONSOLIDATE_CHUNKS", "time:744,level:1,latitude:32,longitude:32"
+)
+LOCK = "datarequests:consolidate:{}"
+LOCK_TIMEOUT = 6 * 3600
+AREA = [90, -180, -90, 180]
+
+
+def path(name, variable, area=None, pressure_level=None, root=None):
+    """Store of a variable for an area and set of pressure levels."""
+    levels = sorted(int(x) for x in pressure_level or [])
+    key = json.dumps([area or AREA, levels])
+    key = hashlib.md5(key.encode("utf-8")).hexdigest()[:8]
+    return os.path.join(root or ROOT, name, f"{variable}.{key}.zarr")
+
+
+def append(connection, name, params, source, root=None):
+    """Append all variables of `source` to their stores; returns new steps."""
+    appended = {}
+    with xr.open_dataset(source) as ds:
+        for variable in params["variable"]:
+            short = variables.SHORT_NAMES.get(variable)
+            if short not in ds.data_vars:
+                if len(ds.data_vars) != 1:
+                    continue
+                short = list(ds.data_vars)[0]
+            store = path(
+                name, variable, params["area"], params.get("pressure_level"), root
+            )
+            lock = connection.lock(LOCK.format(store), timeout=LOCK_TIMEOUT)
+            with lock:
+                appended[store] = _append(ds[[short]], store)
+    return appended
+
+
+def _append(ds, store):
+    ds = conversion.unpacked(ds)  # months are packed with different scales
+    if not os.path.exists(store):
+        os.makedirs(os.path.dirname(store), exist_ok=True)
+        sizes = dict(conversion.chunk_sizes(ds, CHUNKS), time=_step())
+        encoding = conversion.encodings(ds, sizes, "zarr")
+        ds.chunk(sizes).to_zarr(store, mode="w-", encoding=encoding, consolidated=True)
+        return ds.sizes["time"]
+    with xr.open_zarr(store) as existing:
+        known = existing.time.values
+        variable = next(iter(existing.data_vars.values()))
+        step = variable.encoding["chunks"][variable.dims.index("time")]
+    ds = ds.sel(time=~np.isin(ds.time.values, known))
+    if not ds.sizes["time"]:
+        return 0
+    # Align the dask chunks with the chunks of the store: the first one only
+    # fills up the last (partial) chunk of the store.
+    first = (step - len(known) % step) % step or step
+    rest = ds.sizes["time"] - first
+    time = (min(first, ds.sizes["time"]),) + (step,) * (rest // step)
+    if rest > 0 and rest % step:
+        time += (rest % step,)
+    sizes = conversion.chunk_sizes(ds, CHUNKS)
+    ds.chunk(dict(sizes, time=time)).to_zarr(
+        store, append_dim="time", consolidated=True
+    )
+    return ds.sizes["time"]
+
+
+def _step():
+    return conversion.chunks(CHUNKS).get("time", 744)
+
+
+def stores(name, root=None):
+    return sorted(glob.glob(os.path.join(root or ROOT, name, "*.zarr")))
+
+
+def open_dataset(name, variable, area=None, pressure_level=None, root=None, **kwargs):
+    """Open the store of a variable as one lazy dataset sorted by time."""
+    ds = xr.open_zarr(path(name, variable, area, pressure_level, root), **kwargs)
+    if not ds.indexes["time"].is_monotonic_increasing:
+        ds = ds.sortby("time")
+    return ds
@@ -0,0 +1,153 @@
+# -- coding: utf-8 --
+"""Rechunk and compress downloaded files into Zarr or NetCDF4.
+
+CDS delivers NetCDF3 files laid out for reading whole fields. With
+`CONVERT_FORMAT=zarr` or `CONVERT_FORMAT=netcdf4` every finished file is
+converted by a separate job into a chunked and compressed copy next to it
+(`.zarr` or `.nc4`). The chunk layout is set with `CONVERT_CHUNKS`, either
+a preset of `LAYOUTS` or explicit sizes, e.g. `time:744,latitude:32`
+(`-1` for the full dimension). The copy is compared with the original
+before it replaces the original in the catalog; with `CONVERT_REMOVE=1`
+the original is deleted afterwards.
+"""
+
+import os
+import shutil
+import time
+
+import xarray as xr
+
+FORMAT = os.environ.get("CONVERT_FORMAT")  # "zarr", "netcdf4" or unset
+CHUNKS = os.environ.get("CONVERT_CHUNKS", "time")
+LEVEL = int(os.environ.get("CONVERT_LEVEL", 4))
+REMOVE = os.environ.get("CONVERT_REMOVE", "0") == "1"
+LAYOUTS = {
+    # point and regional time series
+    "time": dict(time=-1, level=1, latitude=32, longitude=32),
+    # whole fields of single time steps (the layout of the downloads)
+    "space": dict(time=1, level=1, latitude=-1, longitude=-1),
+}
+SUFFIXES = {"zarr": ".zarr", "netcdf4": ".nc4"}
+PACKING = ("dtype", "scale_factor", "add_offset", "_FillValue", "missing_value")
+
+
+def chunks(layout=None):
+    """Chunk sizes per dimension of a preset or `dim:size,...` layout."""
+    layout = layout or CHUNKS
+    if layout in LAYOUTS:
+        return dict(LAYOUTS[layout])
+    sizes = (item.split(":") for item in layout.split(",") if item)
+    return {dim.strip(): int(size) for dim, size in sizes}
+
+
+def target(source, fmt=None):
+    return os.path.splitext(source)[0] + SUFFIXES[fmt or FORMAT]
+
+
+def open_dataset(path, **kwargs):
+    """Open a downloaded or converted file."""
+    if path.endswith(SUFFIXES["zarr"]):
+        return xr.open_zarr(path, **kwargs)
+    return xr.open_dataset(path, **kwargs)
+
+
+def size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(
+        os.path.getsize(os.path.join(folder, name))
+        for folder, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def convert(source, fmt=None, layout=None, level=LEVEL):
+    """Convert `source` and verify the copy; returns statistics."""
+    fmt = fmt or FORMAT
+    output = target(source, fmt)
+    partial = "{0}.part{1}".format(*os.path.splitext(output))
+    discard(partial)
+    start = time.time()
+    with xr.open_dataset(source) as ds:
+        sizes = chunk_sizes(ds, layout)
+        ds = ds.chunk(sizes)
+        encoding = encodings(ds, sizes, fmt, level)
+        if fmt == "zarr":
+            ds.to_zarr(partial, mode="w", encoding=encoding, consolidated=True)
+        else:
+            ds.to_netcdf(partial, format="NETCDF4", engine="netcdf4", encoding=encoding)
+    if not same(source, partial, sizes):
+        discard(partial)
+        raise Exception(f"Conversion of {source} differs from the original")
+    discard(output)
+    os.replace(partial, output)
+    seconds = time.time() - start
+    stats = dict(source=source, target=output, seconds=seconds)
+    stats.update(source_bytes=size(source), target_bytes=size(output))
+    stats["ratio"] = stats["source_bytes"] / stats["target_bytes"]
+    stats["bytes_per_second"] = stats["source_bytes"] / seconds
+    return stats
+
+
+def same(source, copy, sizes):
+    """Whether `copy` equals `source`, compared chunk by chunk of `sizes`."""
+    with xr.open_dataset(source, chunks=sizes) as original:
+        with open_dataset(copy, chunks=sizes) as converted:
+            return original.equals(converted)
+
+
+def unpacked(ds):
+    """`ds` written as float32 instead of with the packing of its source.
+
+    CDS packs every file with its own scale and offset, which must not be
+    reused for data of other files (merged or appended).
+    """
+    ds = ds.copy()
+    for variable in ds.data_vars.values():
+        variable.encoding = {
+            k: v for k, v in variable.encoding.items() if k not in PACKING
+        }
+        if variable.dtype.kind == "f":
+            variable.encoding["dtype"] = "float32"
+    return ds
+
+
+def chunk_sizes(ds, layout=None):
+    """Chunk sizes of a layout for the dimensions of `ds`."""
+    return {
+        dim: ds.sizes[dim] if n < 0 else min(n, ds.sizes[dim])
+        for dim, n in chunks(layout).items()
+        if dim in ds.dims
+    }
+
+
+def encodings(ds, sizes, fmt=None, level=LEVEL):
+    """Chunked and compressed encoding keeping the packing of CDS."""
+    encoding = {}
+    for name, variable in ds.data_vars.items():
+        packing = {k: v for k, v in variable.encoding.items() if k in PACKING}
+        shape = tuple(sizes.get(dim, ds.sizes[dim]) for dim in variable.dims)
+        encoding[name] = dict(packing, **_compression(fmt or FORMAT, shape, level))
+    return encoding
+
+
+def _compression(fmt, shape, level):
+    if fmt == "zarr":
+        import zarr
+
+        if zarr.__version__.startswith("2."):
+            from numcodecs import Blosc
+
+            compressor = Blosc("zstd", clevel=level, shuffle=Blosc.SHUFFLE)
+            return dict(compressor=compressor, chunks=shape)
+        compressor = zarr.codecs.BloscCodec(cname="zstd", clevel=level)
+        return dict(compressors=[compressor], chunks=shape)
+    return dict(zlib=True, complevel=level, shuffle=True, chunksizes=shape)
+
+
+def discard(path):
+    """Remove a file or Zarr store if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,253 @@
+# -- coding: utf-8 --
+"""Derived variables computed from downloaded files.
+
+`DERIVED` registers products computed from ERA5 variables, e.g. wind speed
+from its u and v components. With `DERIVED_ROOT` set, every finished file
+triggers the products one of its variables is an input of: as soon as the
+catalog holds all inputs for the same area, levels, dates and hours, a
+`derive` job computes the product into a NetCDF4 file below `DERIVED_ROOT`
+and records it in the catalog under the product's name.
+
+Inputs are read and the product is written chunk by chunk along time, at
+most `DERIVED_MEMORY` bytes of inputs at once. Daily products reduce whole
+days (over the hours available) and are therefore chunked by days. Derived
+files are found in the catalog like downloads, e.g.
+
+    catalog.superset(name, dict(params, variable=["10m_wind_speed"]))
+"""
+
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from typing import Callable
+
+import numpy as np
+
+from . import catalog
+from . import conversion
+from . import grib
+from . import schema
+from . import variables
+
+ROOT = os.environ.get("DERIVED_ROOT")
+MEMORY = int(os.environ.get("DERIVED_MEMORY", 256 << 20))
+GUARD = "datarequests:derived:{}"  # set while a product is derived
+GUARD_TIMEOUT = 24 * 3600
+CUBE = ("year", "month", "day", "time", "pressure_level", "area")
+
+
+@dataclass(frozen=True)
+class Derived:
+    """A product computed from `inputs` (CDS variable names) by `compute`.
+
+    `compute` takes the arrays of the inputs in order (and the pressure in
+    Pa of each level with `pressure`). `daily` reduces the hourly values of
+    each day with `np.nanmean`, `np.nanmax`, ...
+    """
+
+    inputs: tuple
+    short_name: str
+    units: str
+    compute: Callable
+    pressure: bool = False
+    daily: Callable = None
+
+
+def wind_speed(u, v):
+    return np.hypot(u, v)
+
+
+def wind_direction(u, v):
+    """Direction the wind blows from in degrees (meteorological convention)."""
+    return np.mod(180 + np.degrees(np.arctan2(u, v)), 360)
+
+
+def _saturation(t):
+    """Saturation vapour pressure over water in Pa (Magnus) of `t` in K."""
+    return 610.94 * np.exp(17.625 * (t - 273.15) / (t - 30.11))
+
+
+def relative_humidity_from_dewpoint(t, td):
+    return 100 * _saturation(td) / _saturation(t)
+
+
+def relative_humidity_from_specific_humidity(t, q, pressure):
+    vapour = q * pressure / (0.622 + 0.378 * q)
+    return 100 * vapour / _saturation(t)
+
+
+def identity(x):
+    return x
+
+
+DERIVED = {
+    "wind_speed": Derived(
+        ("u_component_of_wind", "v_component_of_wind"), "ws", "m s**-1", wind_speed
+    ),
+    "wind_direction": Derived(
+        ("u_component_of_wind", "v_component_of_wind"), "wdir", "degree", wind_direction
+    ),
+    "10m_wind_speed": Derived(
+        ("10m_u_component_of_wind", "10m_v_component_of_wind"),
+        "si10",
+        "m s**-1",
+        wind_speed,
+    ),
+    "10m_wind_direction": Derived(
+        ("10m_u_component_of_wind", "10m_v_component_of_wind"),
+        "wdir10",
+        "degree",
+        wind_direction,
+    ),
+    "100m_wind_speed": Derived(
+        ("100m_u_component_of_wind", "100m_v_component_of_wind"),
+        "si100",
+        "m s**-1",
+        wind_speed,
+    ),
+    "2m_relative_humidity": Derived(
+        ("2m_temperature", "2m_dewpoint_temperature"),
+        "r2",
+        "%",
+        relative_humidity_from_dewpoint,
+    ),
+    "relative_humidity_from_specific_humidity": Derived(
+        ("temperature", "specific_humidity"),
+        "rq",
+        "%",
+        relative_humidity_from_specific_humidity,
+        pressure=True,
+    ),
+    "daily_mean_2m_temperature": Derived(
+        ("2m_temperature",), "t2m_mean", "K", identity, daily=np.nanmean
+    ),
+    "daily_mean_10m_wind_speed": Derived(
+        ("10m_u_component_of_wind", "10m_v_component_of_wind"),
+        "si10_mean",
+        "m s**-1",
+        wind_speed,
+        daily=np.nanmean,
+    ),
+}
+
+
+def ready(name, params, db=None):
+    """Products of the variables in `params` whose inputs are all downloaded.
+
+    Returns a list of `(product, cube)` for the products not derived yet over
+    the cube (area, levels, dates and hours) of `params`.
+    """
+    allowed = schema.SCHEMAS[name].axes["variable"] if name in schema.SCHEMAS else ()
+    cube = {k: params[k] for k in CUBE if k in params}
+    found = []
+    for product, spec in DERIVED.items():
+        if not set(spec.inputs) & set(params["variable"]):
+            continue
+        if not set(spec.inputs) <= set(allowed):
+            continue
+        if catalog.superset(name, dict(cube, variable=[product]), db=db):
+            continue
+        if sources(name, product, cube, db) is not None:
+            found.append((product, cube))
+    return found
+
+
+def sources(name, product, cube, db=None):
+    """File of each input of `product` over `cube` (`None` if any is missing)."""
+    found = []
+    for v in DERIVED[product].inputs:
+        params = {k: cube[k] for k in CUBE if k in cube}
+        source = catalog.superset(name, dict(params, variable=[v]), db=db)
+        if source is None:
+            return None
+        found.append(source)
+    return found
+
+
+def target(name, product, cube, root=None):
+    """File of a product over a cube, e.g. `1987-01-01_1987-01-31.1f3e9a2b.nc`."""
+    key = json.dumps(cube, sort_keys=True)
+    key = hashlib.md5(key.encode("utf-8")).hexdigest()[:8]
+    dates = sorted(catalog.dates(cube))
+    return os.path.join(root or ROOT, name, product, f"{dates[0]}_{dates[-1]}.{key}.nc")
+
+
+def guard(connection, path):
+    """Whether `path` is not being derived yet (and is now)."""
+    return bool(connection.set(_guard(path), 1, nx=True, ex=GUARD_TIMEOUT))
+
+
+def release(connection, path):
+    """Allow `path` to be derived again (e.g. after its job failed)."""
+    connection.delete(_guard(path))
+
+
+def _guard(path):
+    return GUARD.format(hashlib.md5(path.encode("utf-8")).hexdigest())
+
+
+def compute(product, sources, params, target):
+    """Compute `product` over `params` from one source file per input."""
+    from . import tasks
+
+    spec = DERIVED[product]
+    datasets = [conversion.open_dataset(s) for s in sources]
+    try:
+        inputs = [
+            tasks.select(ds, dict(params, variable=[v]))[variables.SHORT_NAMES[v]]
+            for ds, v in zip(datasets, spec.inputs)
+        ]
+        first = inputs[0]
+        times = first.time.values
+        levels = first.level.values if "level" in first.dims else np.array([], "i4")
+        days = times.astype("datetime64[D]")
+        layout = dict(
+            variables={
+                spec.short_name: dict(
+                    name=product, units=spec.units, levels=set(levels.tolist())
+                )
+            },
+            time=np.unique(days).astype("datetime64[m]") if spec.daily else times,
+            level=levels,
+            latitude=first.latitude.values,
+            longitude=first.longitude.values,
+        )
+        extra = {}
+        if spec.pressure:
+            extra["pressure"] = 100.0 * levels.reshape(-1, 1, 1)
+        step = sum(x[:1].nbytes for x in inputs) or 1
+        partial = "{0}.part{1}".format(*os.path.splitext(target))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        written = 0
+        with grib._NetCDF(partial, layout) as out:
+            for chunk in _chunks(days, max(1, MEMORY // step), spec.daily):
+                arrays = [x.isel(time=chunk).values.astype("f4") for x in inputs]
+                values = spec.compute(*arrays, **extra).astype("f4")
+                if spec.daily:
+                    _, starts = np.unique(days[chunk], return_index=True)
+                    values = np.stack(
+                        [spec.daily(v, axis=0) for v in np.split(values, starts[1:])]
+                    )
+                out.write(
+                    spec.short_name, (slice(written, written + len(values)),), values
+                )
+                written += len(values)
+    finally:
+        for ds in datasets:
+            ds.close()
+    os.replace(partial, target)
+
+
+def _chunks(days, steps, daily):
+    """Slices of at most `steps` time steps (of whole days if `daily`)."""
+    if not daily:
+        for start in range(0, len(days), steps):
+            yield slice(start, start + steps)
+        return
+    starts = list(np.flatnonzero(np.diff(days)) + 1) + [len(days)]
+    start = 0
+    for end, following in zip(starts, starts[1:] + [None]):
+        if following is None or following - start > steps:
+            yield slice(start, end)
+            start = end
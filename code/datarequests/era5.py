@@ -2,11 +2,24 @@ from dataclasses import dataclass, field
 from . import variables
 from . import defaults
 from . import tasks
+from . import planner
+from . import postprocess
+from . import coalesce
+from . import catalog
+from . import failures
+from . import ledger
+from . import scheduler
+from . import schema
+from . import store
+import collections
 import hashlib
+import itertools
 import os
 import json
+import warnings
 from rq import Queue, exceptions
-from rq.job import Job
+from rq.job import Dependency, Job, JobStatus
+from rq.registry import DeferredJobRegistry
 from redis import Redis
 
 REDIS_CONNECTION = Redis(host="redis")
@@ -14,6 +27,295 @@ QUE = Queue(
     connection=REDIS_CONNECTION,
     default_timeout="1h",
 )
+FORMATS = ("netcdf", "grib")
+# Submit to CDS, poll and download in separate stages (see `tasks.poll`)
+STAGED = os.environ.get("DATAREQUESTS_STAGED", "1") == "1"
+
+
+def _enqueue(func, job_id, description, queue=None, **kwargs):
+    return (queue or QUE).enqueue(func, **_job_options(job_id, description), **kwargs)
+
+
+def _job_options(job_id, description):
+    return dict(
+        result_ttl=31536000,  # 1 year
+        failure_ttl=31536000,  # 1 year
+        job_id=job_id,
+        description=description,
+    )
+
+
+def _queue(req):
+    """Queue of the cost tier of `req` (see `scheduler`)."""
+    _, params, _ = tasks.split(req)
+    return scheduler.queue(params, REDIS_CONNECTION, default_timeout="1h")
+
+
+def _enqueue_download(req, job_id, description, queue=None, **kwargs):
+    """Enqueue the retrieval of `req` under `job_id`.
+
+    In staged mode a `-submit` job hands the request over to CDS and the job
+    with `job_id` stays deferred until the poller found the CDS request
+    completed. Only then a worker is busy with downloading the result.
+    Without a `queue` the job is put into the queue of its cost tier.
+    """
+    queue = queue or _queue(req)
+    if not STAGED:
+        return _enqueue(
+            tasks.get_data,
+            job_id,
+            description,
+            queue,
+            kwargs={"request": req},
+            **kwargs,
+        )
+    with queue.connection.pipeline() as pipe:
+        job = _defer_download(req, job_id, description, queue, pipe)
+        queue.enqueue_many([_submit_data(req, job_id, description)], pipeline=pipe)
+        pipe.execute()
+    return job
+
+
+def _defer_download(req, job_id, description, queue, pipeline):
+    options = _job_options(job_id, description)
+    job = Job.create(
+        tasks.download,
+        kwargs={"request": req},
+        connection=queue.connection,
+        origin=queue.name,
+        status=JobStatus.DEFERRED,
+        id=options.pop("job_id"),
+        **options,
+    )
+    job.save(pipeline=pipeline)
+    DeferredJobRegistry(queue=queue).add(job, ttl=-1, pipeline=pipeline)
+    return job
+
+
+def _submit_data(req, job_id, description):
+    return Queue.prepare_data(
+        tasks.submit,
+        kwargs={"request": req, "download_id": job_id},
+        **_job_options(f"{job_id}-submit", description),
+    )
+
+
+def _job_statuses(job_ids, connection=None):
+    """Status of many jobs with a single round-trip to Redis.
+
+    Jobs no longer in Redis are looked up in the ledger (see `ledger`).
+    """
+    with (connection or REDIS_CONNECTION).pipeline() as pipe:
+        for job_id in job_ids:
+            pipe.hget(Job.key_for(job_id), "status")
+        statuses = [s.decode() if s is not None else None for s in pipe.execute()]
+    missing = [job_id for job_id, s in zip(job_ids, statuses) if s is None]
+    if missing:
+        archived = dict(zip(missing, ledger.statuses(missing)))
+        statuses = [s or archived[job_id] for job_id, s in zip(job_ids, statuses)]
+    return statuses
+
+
+def _reenter(job_id, connection=None):
+    """Forget a failed job if its request may be sent again (see `failures`)."""
+    try:
+        job = Job.fetch(job_id, connection=connection or REDIS_CONNECTION)
+    except exceptions.NoSuchJobError:
+        archived = ledger.get(job_id)
+        if not failures.retriable(archived["meta"], archived["error"]):
+            return False
+        ledger.forget(job_id)
+        return True
+    if not failures.retriable(job.meta, job.exc_info):
+        return False
+    job.delete()
+    return True
+
+
+def send_requests(pairs, queue=None, batch_size=1000):
+    """Send many `(request, output)` pairs in batches.
+
+    Job statuses of a batch are fetched in one pipelined call and all new
+    jobs of a batch are enqueued within a single Redis pipeline. Returns a
+    summary of the job statuses, e.g. `{"queued": 12, "finished": 3}`.
+    Without a `queue` every job is put into the queue of its cost tier.
+    Failed jobs are sent again unless their failure is permanent. The
+    `(request, output, job_id)` triples of `expand` are accepted as well.
+    With a store, outputs are linked to the stored files (see `store`).
+    Requests (partly) covered by downloaded files are served from them as
+    by `send_request`.
+    """
+    connection = queue.connection if queue else REDIS_CONNECTION
+    db = catalog.connect()
+    summary = collections.Counter()
+    pairs = iter(pairs)
+    folders = set()
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            return summary
+        job_ids = [item[2] if len(item) > 2 else item[0].job_id for item in batch]
+        outputs = store.add(
+            connection, [(i, item[1]) for i, item in zip(job_ids, batch)]
+        )
+        statuses = _job_statuses(job_ids, connection)
+        new, seen = [], set()
+        for (request, *_), output, job_id, status in zip(
+            batch, outputs, job_ids, statuses
+        ):
+            if status == "failed" and _reenter(job_id, connection):
+                status = None
+            if status is not None or job_id in seen:
+                summary[status or "queued"] += 1
+                continue
+            seen.add(job_id)
+            folder = os.path.dirname(output)
+            if folder not in folders:
+                os.makedirs(folder, exist_ok=True)
+                folders.add(folder)
+            job = request._send_covered(output, db)
+            if job is not None:
+                summary[job if isinstance(job, str) else job.get_status()] += 1
+                continue
+            if planner.fields(request) > planner.MAX_FIELDS:
+                request._send_chunks(output)
+                summary["deferred"] += 1
+                continue
+            new.append((request.request(output), job_id, output))
+        queues, tiers = {}, collections.defaultdict(list)
+        for item in new:
+            q = queue or _queue(item[0])
+            queues[q.name] = q
+            tiers[q.name].append(item)
+        with connection.pipeline() as pipe:
+            for name, items in tiers.items():
+                _enqueue_batch(items, queues[name], pipe)
+            pipe.execute()
+        summary["deferred" if STAGED else "queued"] += len(new)
+
+
+def _enqueue_batch(items, queue, pipeline):
+    """Enqueue `(req, job_id, output)` retrievals within `pipeline`."""
+    if STAGED:
+        for req, job_id, output in items:
+            _defer_download(req, job_id, output, queue, pipeline)
+        data = [_submit_data(*item) for item in items]
+    else:
+        data = [
+            Queue.prepare_data(
+                tasks.get_data,
+                kwargs={"request": req},
+                **_job_options(job_id, output),
+            )
+            for req, job_id, output in items
+        ]
+    queue.enqueue_many(data, pipeline=pipeline)
+
+
+def send_coalesced(pairs):
+    """Send `(request, output)` pairs as few combined CDS retrievals.
+
+    Each combined file is split into the original outputs by one job per
+    member. These jobs carry the member's own `job_id`, hence the status of
+    each original request can be queried as usual. Returns the job or, if
+    known already, the job status of each pair. Failed jobs are sent again
+    unless their failure is permanent (as by `send_request`).
+    """
+    pairs = list(pairs)
+    job_ids = [r.job_id for r, _ in pairs]
+    jobs, pending = {}, []
+    for (request, output), job_id, status in zip(
+        pairs, job_ids, _job_statuses(job_ids)
+    ):
+        if job_id in jobs:
+            continue
+        if status == "failed" and _reenter(job_id):
+            status = None
+        jobs[job_id] = status
+        if status is None:
+            pending.append((request, output))
+    for combined, members in coalesce.group(pending):
+        if len(members) == 1:
+            request, output = members[0]
+            jobs[request.job_id] = request.send_request(output)
+            continue
+        outputs = store.add(REDIS_CONNECTION, [(r.job_id, o) for r, o in members])
+        source = os.path.join(os.path.dirname(outputs[0]), f".{combined.job_id}.nc")
+        os.makedirs(os.path.dirname(source), exist_ok=True)
+        retrieval = _enqueue_download(
+            dict(combined.request(source), intermediate=True), combined.job_id, source
+        )
+        extracts = []
+        for (request, _), output in zip(members, outputs):
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            extracts.append(
+                _enqueue(
+                    tasks.extract,
+                    job_id=request.job_id,
+                    description=output,
+                    depends_on=retrieval,
+                    kwargs={"source": source, "request": request.request(output)},
+                )
+            )
+        _enqueue(
+            tasks.remove,
+            job_id=f"{combined.job_id}-cleanup",
+            description=source,
+            # Also after failed extracts, the combined file is of no use then
+            depends_on=Dependency(jobs=extracts, allow_failure=True),
+            args=(source,),
+        )
+        print(f"{retrieval.get_status()} ({len(members)} requests coalesced)")
+        jobs.update((r.job_id, job) for (r, _), job in zip(members, extracts))
+    return [jobs[job_id] for job_id in job_ids]
+
+
+def expand(dataset, output, split=("variable", "year", "month"), **axes):
+    """Expand a campaign into `(request, output, job_id)` triples lazily.
+
+    `axes` are the parameters of the requests of `dataset`, each a list or a
+    range (e.g. `year=range(1979, 2021)`); axes not given cover all allowed
+    values. One request is generated per combination of values of the
+    `split` axes, the other axes are requested whole. `output` is formatted
+    with the values of the split axes, e.g. `"{variable}/{year}/{month}.nc"`.
+    All values are validated per axis up front (see `schema`), hence only one
+    request is constructed and all others are derived from it; their job ids
+    are hashed from precompiled JSON fragments. The triples can be passed to
+    `send_requests` directly.
+    """
+    compiled = schema.SCHEMAS[dataset]
+    split = [a for a in split if a in compiled.axes]
+    values = {
+        a: compiled.canonical(a, list(v)) for a, v in axes.items() if a in compiled.axes
+    }
+    for axis in split:
+        values.setdefault(axis, list(compiled.axes[axis]))
+        if not values[axis]:
+            return
+    first = {a: values[a][:1] for a in split}
+    template = DATASETS[dataset](**{**axes, **values, **first})
+    cls, state = type(template), template.__dict__
+    params = template._key
+    # JSON of `job_id` with a placeholder for each split axis
+    pattern = "{%s}" % ", ".join(
+        (
+            "%s"
+            if k in split
+            else f"{json.dumps(k)}: {json.dumps(params[k], sort_keys=True)}"
+        )
+        for k in sorted(params)
+    ).replace("%", "%%").replace("%%s", "%s")
+    order = sorted(range(len(split)), key=lambda i: split[i])
+    choices = [
+        [([v], f"{json.dumps(a)}: {json.dumps([v])}") for v in values[a]] for a in split
+    ]
+    for combination in itertools.product(*choices):
+        text = pattern % tuple([combination[i][1] for i in order])
+        chosen = {a: c[0] for a, c in zip(split, combination)}
+        request = cls.__new__(cls)  # as `planner.derive`, without copying
+        request.__dict__.update(state, **chosen)
+        path = output.format(**{a: v[0] for a, v in chosen.items()})
+        yield request, path, hashlib.md5(text.encode("utf-8")).hexdigest()
 
 
 @dataclass
@@ -28,6 +330,13 @@ class _ECMWF:
     - Year                              (optional; [1979;2020])
     - Month                             (optional; [1;12])
     - Time                              (optional; [00:00, 01:00, ..., 23:00])
+    - Format                            (optional; netcdf or grib)
+    - Postprocess                       (optional; see `postprocess`)
+
+    GRIB results are decoded locally into the output (see `grib`) unless
+    its name ends in `.grib`. With `postprocess` the output is regridded
+    and/or aggregated in time on the workers; the spec is part of the
+    `job_id` but not of the request sent to CDS.
     """
 
     variable: list
@@ -37,14 +346,19 @@ class _ECMWF:
     year: list = field(default_factory=defaults.year)
     month: list = field(default_factory=defaults.month)
     time: list = field(default_factory=defaults.time)
+    format: str = "netcdf"
+    postprocess: dict = None
 
     def __post_init__(self):
-        self.format = "netcdf"
+        if self.format not in FORMATS:
+            raise KeyError(f"Format {self.format} not in {FORMATS}")
+        if self.postprocess is not None:
+            self.postprocess = postprocess.check(self.postprocess)
         self.product_type = "reanalysis"
         self._check_area()
-        self.month = self._check_range(self.month, 1, 13, "month", "{:02}")
-        self.year = self._check_range(self.year, 1979, 2021, "year", "{:04}")
-        self.time = self._check_membership(self.time, defaults.time(), "time")
+        self.month = self._check_range(self.month, "month")
+        self.year = self._check_range(self.year, "year")
+        self.time = self._check_membership(self.time, "time")
 
     def _check_area(self):
         self.area = [90, -180, -90, 180]
@@ -57,47 +371,156 @@ class _ECMWF:
             self.area[1] = min(self.lon_boundary)
             self.lon_boundary = None
 
-    @staticmethod
-    def _check_membership(candidates, allowed_list, name):
-        allowed = set(allowed_list)
-        if not allowed.issuperset(candidates):
-            result = allowed.intersection(candidates)
+    @property
+    def _schema(self):
+        return schema.SCHEMAS[self.name]
+
+    def _check_membership(self, candidates, axis, name=None):
+        name = name or axis
+        result = self._schema.valid(axis, candidates)
+        if len(result) < len(candidates):
             if not result:
                 raise KeyError(f"None of the {name} are allowed")
-            print(f"Not all {name} allowed.")
-            print(f"Changed {name} list to: {result}")
-            return list(result)
-        return list(candidates)
+            warnings.warn(f"Not all {name} allowed, changed {name} list to: {result}")
+        return result
 
-    @staticmethod
-    def _check_range(candidates, minimum, maximum, name, formatting):
-        msg = f"{name} are wrong: {candidates}"
-        assert all([int(x) >= minimum and int(x) < maximum for x in candidates]), msg
-        return [formatting.format(int(x)) for x in candidates]
+    def _check_range(self, candidates, name):
+        try:
+            return self._schema.canonical(name, candidates)
+        except KeyError:
+            raise AssertionError(f"{name} are wrong: {candidates}") from None
 
     @property
     def _request(self):
-        return {k: v for k, v in self.__dict__.items() if v is not None}
+        return {
+            k: v
+            for k, v in self.__dict__.items()
+            if v is not None and k != "postprocess"
+        }
+
+    @property
+    def _key(self):
+        """Parameters identifying the request (hashed into `job_id`)."""
+        if self.postprocess is None:
+            return self._request
+        return dict(self._request, postprocess=self.postprocess)
+
+    @property
+    def _options(self):
+        """Keys of the request dict handled by the workers only."""
+        if self.postprocess is None:
+            return {}
+        return {"postprocess": self.postprocess}
 
     def request():
         raise NotImplementedError("Not implemented for base class")
 
     def send_request(self, output):
-        os.makedirs(os.path.dirname(output))
-        req = self.request(output)
-        if self.job_status in ("finished", "failed", "queued"):  # TODO Check why it failed and reenter automatically if possible
-            print(self.job_status)
-            return self.job_status
-        job = QUE.enqueue(
-            tasks.get_data,
-            result_ttl=31536000,  # 1 year
-            failure_ttl=31536000,  # 1 year
+        output = store.add(REDIS_CONNECTION, [(self.job_id, output)])[0]
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        status = self.job_status
+        if status == "failed" and _reenter(self.job_id):
+            status = None  # e.g. failed before retries existed
+        if status is not None:  # e.g. "started": never retrieve twice
+            print(status)
+            return status
+        job = self._send_covered(output)
+        if job is not None:
+            return job
+        if planner.fields(self) > planner.MAX_FIELDS:
+            return self._send_chunks(output)
+        job = _enqueue_download(self.request(output), self.job_id, output)
+        print(job.get_status())
+        return job
+
+    def _send_covered(self, output, db=None):
+        """Write `output` from downloaded files as far as the catalog covers it.
+
+        A request contained in a single file is sliced from it by an
+        `extract` job. A request covered by several files, or only partly
+        covered, is combined from them by an `assemble` job after the missing
+        remainder was retrieved into a hidden folder. Both jobs run under the
+        request's `job_id`. Returns `None` if nothing is covered, `"covered"`
+        if `output` itself holds the request already.
+        """
+        source = self._superset(db)
+        if source is not None and os.path.abspath(source) == os.path.abspath(output):
+            print("covered")
+            return "covered"
+        if source is not None:
+            job = _enqueue(
+                tasks.extract,
+                job_id=self.job_id,
+                description=output,
+                kwargs={"source": source, "request": self.request(output)},
+            )
+            print(f"{job.get_status()} (from {source})")
+            return job
+        remainder = self._remainder(db)
+        if remainder is self:
+            return None
+        retrievals, sources = [], []
+        if remainder is not None:
+            parts = os.path.join(os.path.dirname(output), f".{self.job_id}")
+            retrievals, sources = remainder._retrievals(parts, self.job_id)
+        job = _enqueue(
+            tasks.assemble,
             job_id=self.job_id,
             description=output,
-            kwargs={"request": req},
-            meta=req,
+            depends_on=retrievals or None,
+            kwargs={"sources": sources, "request": self.request(output)},
         )
-        print(job.get_status())
+        covered = f"{len(retrievals)} retrievals" if retrievals else "covered"
+        print(f"{job.get_status()} (assembled, {covered})")
+        return job
+
+    def _superset(self, db=None):
+        """Downloaded file the request can be sliced from locally."""
+        exact = not all(v in variables.SHORT_NAMES for v in self.variable)
+        return catalog.superset(self.name, self._request, exact, db)
+
+    def _remainder(self, db=None):
+        """Part of the request not yet covered by already downloaded files."""
+        remainder = catalog.remainder(self.name, self._request, db)
+        if remainder is None:
+            return None
+        if remainder == self._request:
+            return self
+        return planner.derive(
+            self, **{k: v for k, v in remainder.items() if v != self._request[k]}
+        )
+
+    def _retrievals(self, parts, job_id):
+        """Retrieve the request into `parts` in chunks below `MAX_FIELDS`.
+
+        Returns the jobs and their targets; the jobs are `job_id-0000`, ...
+        """
+        os.makedirs(parts, exist_ok=True)
+        jobs, sources = [], []
+        for n, chunk in enumerate(planner.split(self)):
+            target = os.path.join(parts, f"{n:04}.nc")
+            jobs.append(
+                _enqueue_download(
+                    dict(chunk.request(target), intermediate=True),
+                    f"{job_id}-{n:04}",
+                    target,
+                )
+            )
+            sources.append(target)
+        return jobs, sources
+
+    def _send_chunks(self, output):
+        """Fan out an oversized request and merge the chunks into `output`."""
+        parts = os.path.join(os.path.dirname(output), f".{self.job_id}")
+        jobs, sources = self._retrievals(parts, self.job_id)
+        job = _enqueue(
+            tasks.merge,
+            job_id=self.job_id,
+            description=output,
+            depends_on=jobs,
+            kwargs={"sources": sources, "request": self.request(output)},
+        )
+        print(f"{job.get_status()} ({len(jobs)} chunks)")
         return job
 
     @property
@@ -105,14 +528,15 @@ class _ECMWF:
         try:
             j = Job.fetch(self.job_id, connection=REDIS_CONNECTION)
         except exceptions.NoSuchJobError as e:
-            return None  # Apparently job is not in queue, hence no status
+            # Apparently job is not in queue, hence archived or no status
+            return ledger.statuses([self.job_id])[0]
         else:
             return j.get_status()
 
     @property
     def job_id(self):
         return hashlib.md5(
-            json.dumps(self._request, sort_keys=True).encode("utf-8")
+            json.dumps(self._key, sort_keys=True).encode("utf-8")
         ).hexdigest()
 
 
@@ -135,29 +559,20 @@ class ERA5PressureLevelsRequest(_ECMWF):
 
     def __post_init__(self):
         super(ERA5PressureLevelsRequest, self).__post_init__()
-        self._check_pl()
-        self.day = self._check_range(self.day, 1, 32, "day", "{:02}")
-        self.variable = self._check_membership(
-            self.variable, variables.PRESSURE_LEVELS, "variables"
+        self.pressure_level = self._check_membership(
+            self.pressure_level, "pressure_level", "pressure levels"
         )
-
-    def _check_pl(self):
-        allowed = set(defaults.pl())
-        if not allowed.issuperset([str(x) for x in self.pressure_level]):
-            result = allowed.intersection(self.pressure_level)
-            if not result:
-                raise KeyError("None of the pressure levels are allowed")
-            self.pressure_level = list(result)
-            print("Not all pressure levels allowed.")
-            print(f"Changed variables list to: {self.pressure_level}")
-        self.pressure_level = [str(x) for x in self.pressure_level]
+        self.day = self._check_range(self.day, "day")
+        self.variable = self._check_membership(self.variable, "variable", "variables")
 
     @property
     def name(self):
         return "reanalysis-era5-pressure-levels"
 
     def request(self, filepath):
-        return dict(name=self.name, request=self._request, target=filepath)
+        return dict(
+            name=self.name, request=self._request, target=filepath, **self._options
+        )
 
 
 @dataclass
@@ -178,14 +593,18 @@ class ERA5SingleLevelsRequest(_ECMWF):
 
     def __post_init__(self):
         super(ERA5SingleLevelsRequest, self).__post_init__()
-        self.day = self._check_range(self.day, 1, 32, "day", "{:02}")
-        self.variable = self._check_membership(
-            self.variable, variables.SINGLE_LEVELS, "variables"
-        )
+        self.day = self._check_range(self.day, "day")
+        self.variable = self._check_membership(self.variable, "variable", "variables")
 
     @property
     def name(self):
         return "reanalysis-era5-single-levels"
 
     def request(self, filepath):
-        return dict(name=self.name, **self._request, target=filepath)
+        return dict(name=self.name, **self._request, target=filepath, **self._options)
+
+
+DATASETS = {
+    schema.SINGLE_LEVELS.name: ERA5SingleLevelsRequest,
+    schema.PRESSURE_LEVELS.name: ERA5PressureLevelsRequest,
+}
@@ -0,0 +1,246 @@
+# -- coding: utf-8 --
+"""Classify failed retrievals and retry or split them automatically.
+
+Failures of retrieval jobs (`get_data`, `submit` and `download`) fall into
+one of these classes:
+
+- `transient`: network errors, server errors and incomplete downloads
+- `timeout`: the job timed out while the request waited in the CDS queue
+- `too_large`: CDS rejected the request as too large
+- `invalid`: invalid parameters or no data for the request
+- `unknown`: anything else (e.g. a bug), not retried
+
+Transient failures and timeouts are retried up to `FAILURE_RETRIES` times
+with exponential backoff and jitter. Oversized requests are split in two
+along the first axis with several values; the halves are retrieved as
+chunks and merged into the original target under the original job id.
+Requests failed in CDS are resubmitted by the poller (see `tasks.poll`),
+all other failures are handled by the worker's exception handler
+
+    rq worker --with-scheduler --exception-handler datarequests.failures.handle
+
+Delayed retries are put into RQ's scheduled job registry, hence a worker
+must run with `--with-scheduler` (the asyncio worker schedules by itself).
+"""
+
+import asyncio
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+import requests
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.registry import DeferredJobRegistry, FailedJobRegistry
+from rq.timeouts import JobTimeoutException
+
+from . import planner
+from . import scheduler
+from . import space
+
+TRANSIENT, TIMEOUT, TOO_LARGE, INVALID, UNKNOWN = (
+    "transient",
+    "timeout",
+    "too_large",
+    "invalid",
+    "unknown",
+)
+RETRIES = int(os.environ.get("FAILURE_RETRIES", 5))
+BACKOFF = {  # seconds before the first retry
+    TRANSIENT: float(os.environ.get("FAILURE_BACKOFF", 60)),
+    TIMEOUT: float(os.environ.get("FAILURE_TIMEOUT_BACKOFF", 900)),
+}
+BACKOFF_MAX = float(os.environ.get("FAILURE_BACKOFF_MAX", 6 * 3600))
+RETRIEVALS = tuple(
+    f"datarequests.tasks.{f}" for f in ("get_data", "submit", "download")
+)
+NETWORK = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+    ConnectionError,
+    TimeoutError,
+)
+# Checked in this order against the error message (lower case)
+PATTERNS = (
+    (TOO_LARGE, ("too large", "cost limits exceeded", "limit is")),
+    (INVALID, ("not valid", "invalid", "no data", "not available", "not found")),
+    (TIMEOUT, ("jobtimeoutexception", "queue timeout", "timed out in queue")),
+    (
+        TRANSIENT,
+        (
+            "connectionerror",
+            "connection reset",
+            "connection aborted",
+            "timed out",
+            "download failed",
+            "download incomplete",
+            "checksum mismatch",
+            "internal server error",
+            "bad gateway",
+            "service unavailable",
+            "gateway time",
+            "temporarily",
+            "try again",
+        ),
+    ),
+)
+
+
+class RequestFailed(Exception):
+    """A CDS request ended in the `failed` state."""
+
+    def __init__(self, error):
+        self.error = error
+        super().__init__(f"{error.get('message')}. {error.get('reason')}.")
+
+
+def classify(error):
+    """Class of an exception or of the traceback text of a failed job."""
+    if isinstance(error, JobTimeoutException):
+        return TIMEOUT
+    if isinstance(error, NETWORK):
+        return TRANSIENT
+    response = getattr(error, "response", None)
+    if isinstance(error, requests.HTTPError) and response is not None:
+        if response.status_code >= 500 or response.status_code == 429:
+            return TRANSIENT
+    lines = str(error).strip().lower().splitlines()
+    text = lines[-1] if lines else ""  # message of a traceback only
+    for kind, patterns in PATTERNS:
+        if any(p in text for p in patterns):
+            return kind
+    return UNKNOWN
+
+
+def delay(kind, attempt):
+    """Exponential backoff with jitter, between half and all of the step."""
+    step = min(BACKOFF[kind] * 2**attempt, BACKOFF_MAX)
+    return random.uniform(step / 2, step)
+
+
+def handle(job, exc_type, exc_value, traceback):
+    """RQ exception handler retrying or splitting failed retrievals."""
+    from . import accounts
+
+    if job.func_name not in RETRIEVALS:
+        return True
+    if job.func_name.endswith(".download") and isinstance(exc_value, RequestFailed):
+        return True  # handled by the poller already (see `resubmit`)
+    for held, seconds in ((space.Full, space.HOLD), (accounts.Busy, accounts.WAIT)):
+        if isinstance(exc_value, held):
+            retry(job, "held", timedelta(seconds=seconds))  # not a failure
+            return True
+    kind = classify(exc_value)
+    _record(job, kind)
+    if kind == TOO_LARGE:
+        target = job
+        if job.func_name.endswith(".submit"):
+            target = Job.fetch(job.kwargs["download_id"], connection=job.connection)
+        split(target)
+    elif kind in BACKOFF and job.meta.get("retries", 0) <= RETRIES:
+        retry(job, kind)
+    return True
+
+
+def retry(job, kind, wait=None):
+    """Schedule a failed job again after a backoff (or `wait`)."""
+    queue = Queue(job.origin, connection=job.connection)
+    wait = wait or timedelta(seconds=delay(kind, job.meta["retries"] - 1))
+    with job.connection.pipeline() as pipe:
+        FailedJobRegistry(queue=queue).remove(job, pipeline=pipe)
+        job.set_status(JobStatus.SCHEDULED, pipeline=pipe)
+        queue.schedule_job(job, datetime.now(timezone.utc) + wait, pipeline=pipe)
+        pipe.execute()
+    print(f"{job.id} failed ({kind}), retry in {wait}")
+
+
+def resubmit(job, error):
+    """Submit the request of a deferred download job again after CDS failed it.
+
+    Returns whether the failure was handled; otherwise the download job is
+    released and fails with the error of CDS.
+    """
+    from . import era5
+    from . import tasks
+
+    kind = classify(RequestFailed(error))
+    _record(job, kind)
+    if kind == TOO_LARGE:
+        return split(job)
+    if kind not in BACKOFF or job.meta["retries"] > RETRIES:
+        return False
+    queue = Queue(job.origin, connection=job.connection)
+    wait = timedelta(seconds=delay(kind, job.meta["retries"] - 1))
+    queue.enqueue_in(
+        wait,
+        tasks.submit,
+        kwargs={"request": job.kwargs["request"], "download_id": job.id},
+        **era5._job_options(f"{job.id}-submit", job.description),
+    )
+    print(f"{job.id} failed in CDS ({kind}), resubmit in {wait}")
+    return True
+
+
+def split(job):
+    """Replace a retrieval job by two chunks and a merge under its job id."""
+    from . import era5
+    from . import tasks
+
+    request = job.kwargs["request"]
+    _, params, target = tasks.split(request)
+    try:
+        halves = planner.halves(params)
+    except ValueError as e:
+        print(f"{job.id} is too large: {e}")
+        return False
+    queue = Queue(job.origin, connection=job.connection)
+    FailedJobRegistry(queue=queue).remove(job)
+    DeferredJobRegistry(queue=queue).remove(job)
+    # Created by the downloads, `split` may run in the poller (see `tasks.poll`)
+    parts = os.path.join(os.path.dirname(target), f".{job.id}")
+    chunks, sources = [], []
+    for n, half in enumerate(halves):
+        source = os.path.join(parts, f"{n:04}.nc")
+        chunk = _request(request, half, source)
+        chunks.append(
+            era5._enqueue_download(
+                chunk,
+                f"{job.id}-{n:04}",
+                source,
+                scheduler.queue(half, job.connection, default_timeout="1h"),
+            )
+        )
+        sources.append(source)
+    era5._enqueue(
+        tasks.merge,
+        job_id=job.id,
+        description=target,
+        queue=Queue(connection=job.connection, default_timeout="1h"),
+        depends_on=chunks,
+        kwargs={"sources": sources, "request": request},
+    )
+    print(f"{job.id} is too large, split into {len(chunks)} chunks")
+    return True
+
+
+def retriable(meta, error):
+    """Whether a failed job may be sent again (see `era5._ECMWF.send_request`)."""
+    kind = meta.get("failure") or classify(error or "")
+    return kind not in (INVALID, UNKNOWN)
+
+
+def _record(job, kind):
+    job.meta["failure"] = kind
+    job.meta["retries"] = job.meta.get("retries", 0) + 1
+    job.save_meta()
+
+
+def _request(request, params, target):
+    """Intermediate request dict of the same shape as `request` for `params`."""
+    if "request" in request:
+        return dict(request, request=params, target=target, intermediate=True)
+    return dict(name=request["name"], **params, target=target, intermediate=True)
@@ -0,0 +1,218 @@
+# -- coding: utf-8 --
+"""Decode GRIB results into NetCDF or Zarr on our own workers.
+
+CDS converts its native GRIB to NetCDF on request, which costs queue time
+and bandwidth. Requests with `format="grib"` are retrieved as GRIB and
+decoded locally. A first pass reads the keys of all messages (without
+their values) to lay out the output; the second pass writes the values
+message by message, so only one field is held in memory at any time.
+Targets ending in `.zarr` are written as Zarr, all others as NetCDF4.
+Variables are named as in the NetCDF files of CDS (e.g. `t2m` for the
+GRIB `2t`, see `variables.SHORT_NAMES`).
+"""
+
+import os
+
+import numpy as np
+
+from . import conversion
+
+KEYS = (
+    "shortName",
+    "name",
+    "units",
+    "typeOfLevel",
+    "level",
+    "validityDate",
+    "validityTime",
+    "Ni",
+    "Nj",
+    "latitudeOfFirstGridPointInDegrees",
+    "longitudeOfFirstGridPointInDegrees",
+    "iDirectionIncrementInDegrees",
+    "jDirectionIncrementInDegrees",
+    "jScansPositively",
+)
+EXTENSIONS = (".grib", ".grb", ".grib1", ".grib2")
+MISSING = 9999.0
+EPOCH = np.datetime64("1900-01-01T00:00")
+# GRIB `shortName` of variables named differently in the NetCDF files of CDS
+NETCDF_NAMES = {
+    "2t": "t2m",
+    "2d": "d2m",
+    "10u": "u10",
+    "10v": "v10",
+    "100u": "u100",
+    "100v": "v100",
+    "10si": "si10",
+    "10fg": "fg10",
+}
+
+
+def messages(path, values=False):
+    """Keys (and values) of the messages of a GRIB file one at a time."""
+    import eccodes
+
+    with open(path, "rb") as f:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(f)
+            if gid is None:
+                return
+            try:
+                message = {k: eccodes.codes_get(gid, k) for k in KEYS}
+                if values:
+                    eccodes.codes_set(gid, "missingValue", MISSING)
+                    data = eccodes.codes_get_values(gid).astype("f4")
+                    data[data == MISSING] = np.nan
+                    message["values"] = data.reshape(message["Nj"], message["Ni"])
+                yield message
+            finally:
+                eccodes.codes_release(gid)
+
+
+def _name(message):
+    return NETCDF_NAMES.get(message["shortName"], message["shortName"])
+
+
+def _time(message):
+    date, time = str(message["validityDate"]), int(message["validityTime"])
+    day = np.datetime64(f"{date[:4]}-{date[4:6]}-{date[6:]}T00:00")
+    return day + np.timedelta64(time // 100, "h") + np.timedelta64(time % 100, "m")
+
+
+def scan(path):
+    """Variables, levels, times and grid of a GRIB file."""
+    variables, times, grid = {}, set(), None
+    for message in messages(path):
+        variable = variables.setdefault(
+            _name(message),
+            dict(name=message["name"], units=message["units"], levels=set()),
+        )
+        if message["typeOfLevel"] == "isobaricInhPa":
+            variable["levels"].add(int(message["level"]))
+        times.add(_time(message))
+        grid = grid or message
+    if grid is None:
+        raise ValueError(f"No GRIB messages in {path}")
+    nj, ni = grid["Nj"], grid["Ni"]
+    dj = grid["jDirectionIncrementInDegrees"] * (1 if grid["jScansPositively"] else -1)
+    lat = grid["latitudeOfFirstGridPointInDegrees"] + dj * np.arange(nj)
+    lon = grid["longitudeOfFirstGridPointInDegrees"]
+    lon = lon + grid["iDirectionIncrementInDegrees"] * np.arange(ni)
+    lon = np.where(lon > 180, lon - 360, lon)
+    levels = sorted(set().union(*(v["levels"] for v in variables.values())))
+    return dict(
+        variables=variables,
+        time=np.array(sorted(times)),
+        level=np.array(levels, "i4"),
+        latitude=lat.astype("f4"),
+        longitude=lon.astype("f4"),
+    )
+
+
+def decode(source, target):
+    """Decode the GRIB file `source` into `target`."""
+    layout = scan(source)
+    partial = "{0}.part{1}".format(*os.path.splitext(target))
+    writer = _Zarr if target.endswith(".zarr") else _NetCDF
+    with writer(partial, layout) as out:
+        times = {t: i for i, t in enumerate(layout["time"])}
+        levels = {int(x): i for i, x in enumerate(layout["level"])}
+        for message in messages(source, values=True):
+            index = [times[_time(message)]]
+            if layout["variables"][_name(message)]["levels"]:
+                index.append(levels[int(message["level"])])
+            out.write(_name(message), tuple(index), message["values"])
+    conversion.discard(target)
+    os.replace(partial, target)
+
+
+def _dims(variable):
+    if variable["levels"]:
+        return ("time", "level", "latitude", "longitude")
+    return ("time", "latitude", "longitude")
+
+
+class _NetCDF:
+    def __init__(self, path, layout):
+        import netCDF4
+
+        self.ds = netCDF4.Dataset(path, "w", format="NETCDF4")
+        for dim in ("time", "level", "latitude", "longitude"):
+            if len(layout[dim]):
+                self.ds.createDimension(
+                    dim, None if dim == "time" else len(layout[dim])
+                )
+        hours = (layout["time"] - EPOCH) // np.timedelta64(1, "h")
+        time = self.ds.createVariable("time", "i4", ("time",))
+        time.setncatts(
+            dict(units="hours since 1900-01-01 00:00:00.0", calendar="gregorian")
+        )
+        time[:] = hours
+        for dim, units in (
+            ("level", "millibars"),
+            ("latitude", "degrees_north"),
+            ("longitude", "degrees_east"),
+        ):
+            if len(layout[dim]):
+                self.ds.createVariable(dim, layout[dim].dtype, (dim,))[:] = layout[dim]
+                self.ds[dim].units = units
+        for short, variable in layout["variables"].items():
+            dims = _dims(variable)
+            chunks = [1] * (len(dims) - 2) + [len(layout[d]) for d in dims[-2:]]
+            v = self.ds.createVariable(
+                short, "f4", dims, zlib=True, chunksizes=chunks, fill_value=np.nan
+            )
+            v.setncatts(dict(units=variable["units"], long_name=variable["name"]))
+
+    def write(self, short, index, values):
+        self.ds[short][index] = values
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.ds.close()
+
+
+class _Zarr:
+    def __init__(self, path, layout):
+        import dask.array as da
+        import xarray as xr
+        import zarr
+
+        coords = {
+            k: layout[k]
+            for k in ("time", "level", "latitude", "longitude")
+            if len(layout[k])
+        }
+        data = {}
+        for short, variable in layout["variables"].items():
+            dims = _dims(variable)
+            shape = tuple(len(layout[d]) for d in dims)
+            chunks = (1,) * (len(dims) - 2) + shape[-2:]
+            array = da.full(shape, np.nan, dtype="f4", chunks=chunks)
+            data[short] = (
+                dims,
+                array,
+                dict(units=variable["units"], long_name=variable["name"]),
+            )
+        ds = xr.Dataset(data, coords)
+        sizes = dict(
+            time=1,
+            level=1,
+            latitude=ds.sizes["latitude"],
+            longitude=ds.sizes["longitude"],
+        )
+        encoding = conversion.encodings(ds, sizes, "zarr")
+        ds.to_zarr(path, mode="w", compute=False, encoding=encoding, consolidated=True)
+        self.group = zarr.open_group(path, mode="r+")
+
+    def write(self, short, index, values):
+        self.group[short][index] = values
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
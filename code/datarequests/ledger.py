@@ -0,0 +1,181 @@
+# -- coding: utf-8 --
+"""Compact on-disk ledger of finished and failed jobs.
+
+Redis holds the active work only. Jobs finished or failed more than
+`LEDGER_AGE` seconds ago are archived by the poller into a SQLite table
+keyed by `job_id` (status, function, target, timestamps, `meta` without
+the request and the error of failed jobs) and deleted from Redis. Jobs
+with dependents still waiting are kept, as RQ treats missing dependencies
+as met. `era5` looks up the status of jobs no longer in Redis here.
+
+    python -m datarequests.ledger  # archive now
+"""
+
+import json
+import os
+import sqlite3
+from datetime import timezone
+
+from redis import Redis
+from rq import Queue
+from rq.job import Job, JobStatus
+from rq.registry import FailedJobRegistry, FinishedJobRegistry
+from rq.utils import utcnow
+
+from . import scheduler
+
+PATH = os.environ.get(
+    "DATAREQUESTS_LEDGER",
+    os.path.join(os.path.dirname(__file__), "..", "rstore", "ledger.sqlite"),
+)
+AGE = int(os.environ.get("LEDGER_AGE", 24 * 3600))
+INTERVAL = int(os.environ.get("LEDGER_INTERVAL", 3600))  # see `tasks.poll_forever`
+BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    func TEXT,
+    description TEXT,
+    origin TEXT,
+    enqueued REAL,
+    started REAL,
+    ended REAL,
+    meta TEXT,
+    error TEXT
+) WITHOUT ROWID;
+"""
+
+
+def connect(path=None):
+    path = path or PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+def archive(connection, queues=scheduler.QUEUES, age=AGE, db=None):
+    """Move jobs ended more than `age` seconds ago from Redis into the ledger."""
+    db = db or connect()
+    archived = 0
+    for name in queues:
+        queue = Queue(name, connection=connection)
+        for registry in (
+            FinishedJobRegistry(queue=queue),
+            FailedJobRegistry(queue=queue),
+        ):
+            ids = registry.get_job_ids()
+            for i in range(0, len(ids), BATCH):
+                jobs = Job.fetch_many(ids[i : i + BATCH], connection=connection)
+                jobs = _done([j for j in jobs if j is not None], age, connection)
+                with db:
+                    db.executemany(
+                        f"INSERT OR REPLACE INTO jobs VALUES ({','.join('?' * 10)})",
+                        (_row(j) for j in jobs),
+                    )
+                with connection.pipeline() as pipe:
+                    for job in jobs:
+                        # `job.delete` would read the status of each job again
+                        registry.remove(job, pipeline=pipe)
+                        pipe.delete(job.key, job.dependents_key, job.dependencies_key)
+                    pipe.execute()
+                archived += len(jobs)
+    return archived
+
+
+def _done(jobs, age, connection):
+    """Jobs of `jobs` ended long enough ago without dependents waiting.
+
+    Dependents and their statuses are read with two round-trips to Redis.
+    """
+    now = utcnow()
+    jobs = [
+        j
+        for j in jobs
+        if j.ended_at is not None and (now - j.ended_at).total_seconds() >= age
+    ]
+    with connection.pipeline() as pipe:
+        for job in jobs:
+            pipe.smembers(job.dependents_key)
+        dependents = pipe.execute()
+    with connection.pipeline() as pipe:
+        for ids in dependents:
+            for dependent in ids:
+                pipe.hget(Job.key_for(dependent.decode()), "status")
+        statuses = iter(pipe.execute())
+    done = []
+    for job, ids in zip(jobs, dependents):
+        waiting = [next(statuses) for _ in ids]
+        if all(s is None or s.decode() != JobStatus.DEFERRED for s in waiting):
+            done.append(job)
+    return done
+
+
+def _row(job):
+    request = job.kwargs.get("request") or {}
+    meta = {k: v for k, v in job.meta.items() if k not in request}
+    status = job.get_status(refresh=False)  # as fetched in `archive`
+    error = None
+    if status == JobStatus.FAILED and job.exc_info:
+        error = job.exc_info.strip().splitlines()[-1]
+    return (
+        job.id,
+        status,
+        job.func_name,
+        job.description,
+        job.origin,
+        _timestamp(job.enqueued_at),
+        _timestamp(job.started_at),
+        _timestamp(job.ended_at),
+        json.dumps(meta, default=str),
+        error,
+    )
+
+
+def _timestamp(value):
+    """Seconds since the epoch of a naive UTC datetime of RQ."""
+    return None if value is None else value.replace(tzinfo=timezone.utc).timestamp()
+
+
+def statuses(job_ids, db=None):
+    """Archived status of each of `job_ids` (`None` if not archived)."""
+    db = db or connect()
+    found = {}
+    job_ids = list(job_ids)
+    for i in range(0, len(job_ids), BATCH):
+        rows = db.execute(
+            "SELECT id, status FROM jobs WHERE id IN (SELECT value FROM json_each(?))",
+            (json.dumps(job_ids[i : i + BATCH]),),
+        )
+        found.update(rows)
+    return [found.get(job_id) for job_id in job_ids]
+
+
+def get(job_id, db=None):
+    """Archived job as dict (or `None`)."""
+    db = db or connect()
+    cursor = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    row = dict(zip((c[0] for c in cursor.description), row))
+    row["meta"] = json.loads(row["meta"] or "{}")
+    return row
+
+
+def forget(job_id, db=None):
+    """Remove a job from the ledger, e.g. before it is sent again."""
+    db = db or connect()
+    with db:
+        db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+if __name__ == "__main__":
+    connection = Redis(
+        host=os.environ.get("REDIS_HOST", "redis"),
+        port=int(os.environ.get("REDIS_PORT", 6379)),
+    )
+    print(f"{archive(connection)} jobs archived")
@@ -0,0 +1,82 @@
+# -- coding: utf-8 --
+"""Limit the CDS requests in flight across all workers.
+
+Every CDS request holds a slot from submission until CDS completed or
+failed it. Slots are leases in a Redis sorted set (token -> expiry) per
+account, so slots of crashed workers are freed eventually. The limit per
+account is kept in Redis as well. In adaptive mode it is lowered when CDS
+queues requests longer than `CDS_TARGET_QUEUE` seconds or answers with
+errors and raised again while requests start quickly (AIMD).
+"""
+
+import os
+import time
+
+LIMIT = int(os.environ.get("CDS_MAX_INFLIGHT", 8))
+MIN_LIMIT = 1
+MAX_LIMIT = int(os.environ.get("CDS_MAX_INFLIGHT_CAP", 64))
+ADAPTIVE = os.environ.get("CDS_ADAPTIVE", "1") == "1"
+TARGET_QUEUE = float(os.environ.get("CDS_TARGET_QUEUE", 600))
+LEASE = 6 * 3600
+
+
+class Limiter:
+    """Distributed semaphore for the CDS requests of one account."""
+
+    def __init__(self, connection, account="default"):
+        self.connection = connection
+        self.account = account
+        self.key = f"datarequests:inflight:{account}"
+        self.limit_key = f"datarequests:limit:{account}"
+
+    @property
+    def limit(self):
+        limit = self.connection.get(self.limit_key)
+        return LIMIT if limit is None else int(limit)
+
+    def inflight(self):
+        return self.connection.zcount(self.key, time.time(), "+inf")
+
+    def try_acquire(self, token):
+        def acquire(pipe):
+            now = time.time()
+            limit = pipe.get(self.limit_key)
+            limit = LIMIT if limit is None else int(limit)
+            held = pipe.zscore(self.key, token) is not None
+            if not held and pipe.zcount(self.key, now, "+inf") >= limit:
+                return False
+            pipe.multi()
+            pipe.zremrangebyscore(self.key, "-inf", now)
+            pipe.zadd(self.key, {token: now + LEASE})
+            return True
+
+        return self.connection.transaction(
+            acquire, self.key, self.limit_key, value_from_callable=True
+        )
+
+    def acquire(self, token, poll=5):
+        """Block until a slot for `token` is available."""
+        while not self.try_acquire(token):
+            time.sleep(poll)
+
+    def release(self, token):
+        self.connection.zrem(self.key, token)
+
+    def observe(self, queue_seconds=None, error=False):
+        """Adapt the limit to a CDS queue time or an error response."""
+        if not ADAPTIVE:
+            return
+
+        def adapt(pipe):
+            limit = pipe.get(self.limit_key)
+            limit = LIMIT if limit is None else int(limit)
+            if error:
+                limit //= 2
+            elif queue_seconds > TARGET_QUEUE:
+                limit -= 1
+            elif pipe.zcount(self.key, time.time(), "+inf") >= limit:
+                limit += 1
+            pipe.multi()
+            pipe.set(self.limit_key, min(MAX_LIMIT, max(MIN_LIMIT, limit)))
+
+        self.connection.transaction(adapt, self.limit_key)
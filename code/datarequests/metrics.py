@@ -0,0 +1,150 @@
+# -- coding: utf-8 --
+"""Phase timings of retrievals and a Prometheus metrics endpoint.
+
+Retrieval jobs record how long they spent in each phase into their `meta`
+(`meta["timings"]` in seconds, `meta["bytes"]` downloaded):
+
+- `rq_wait`: waiting in the RQ queue
+- `cds_queue`: waiting in the CDS queue
+- `cds_processing`: CDS retrieving the data
+- `download`: transferring the result
+- `decode`: decoding GRIB locally (see `grib`)
+
+When a retrieval finished, its timings are added to histograms by dataset
+and request size (the cost tier of `scheduler`) and appended to a time
+series of the last `METRICS_RETENTION` seconds in Redis. The histograms
+and the counters of all accounts are served in the Prometheus text format
+
+    python -m datarequests.metrics [port]  # http://localhost:9100/metrics
+"""
+
+import json
+import math
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from . import accounts
+from . import scheduler
+
+PHASES = ("rq_wait", "cds_queue", "cds_processing", "download", "decode")
+SECONDS = (1, 5, 15, 60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 24 * 3600)
+BYTES = tuple(1 << n for n in range(20, 36, 2))  # 1 MiB to 16 GiB
+HISTOGRAMS = "datarequests:metrics:{}"  # field [labels..., le] -> count
+SERIES = "datarequests:metrics:series"  # sorted by time of completion
+RETENTION = int(os.environ.get("METRICS_RETENTION", 7 * 24 * 3600))
+PORT = int(os.environ.get("METRICS_PORT", 9100))
+
+
+def add(job, bytes=None, **timings):
+    """Add phase `timings` (and downloaded `bytes`) to the `meta` of `job`."""
+    job.meta.setdefault("timings", {}).update(timings)
+    if bytes is not None:
+        job.meta["bytes"] = job.meta.get("bytes", 0) + bytes
+    job.save_meta()
+
+
+def record(job, name, params):
+    """Add the timings of a finished retrieval to histograms and time series."""
+    if job.enqueued_at is not None and job.started_at is not None:
+        add(job, rq_wait=(job.started_at - job.enqueued_at).total_seconds())
+    timings = job.meta.get("timings", {})
+    size = scheduler.tier(params)
+    sample = dict(
+        job=job.id,
+        time=time.time(),
+        dataset=name,
+        size=size,
+        bytes=job.meta.get("bytes", 0),
+        **timings,
+    )
+    with job.connection.pipeline() as pipe:
+        for phase in PHASES:
+            if phase in timings:
+                labels = (phase, name, size)
+                _observe(pipe, "seconds", labels, timings[phase], SECONDS)
+        if sample["bytes"]:
+            _observe(pipe, "bytes", (name, size), sample["bytes"], BYTES)
+        pipe.zadd(SERIES, {json.dumps(sample): sample["time"]})
+        pipe.zremrangebyscore(SERIES, 0, sample["time"] - RETENTION)
+        pipe.execute()
+
+
+def _observe(pipe, histogram, labels, value, buckets):
+    le = next((b for b in buckets if value <= b), math.inf)
+    key = HISTOGRAMS.format(histogram)
+    pipe.hincrby(key, json.dumps([*labels, le]), 1)
+    pipe.hincrbyfloat(key, json.dumps([*labels, "sum"]), value)
+
+
+def series(connection, start=0, end=math.inf):
+    """Samples of the retrievals finished between `start` and `end`."""
+    return [json.loads(v) for v in connection.zrangebyscore(SERIES, start, end)]
+
+
+def render(connection):
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for histogram, labels, buckets, text in (
+        ("seconds", ("phase", "dataset", "size"), SECONDS, "Seconds per phase"),
+        ("bytes", ("dataset", "size"), BYTES, "Bytes per retrieval"),
+    ):
+        metric = f"datarequests_retrieval_{histogram}"
+        lines += [f"# HELP {metric} {text}.", f"# TYPE {metric} histogram"]
+        counts, sums = {}, {}
+        for field, value in connection.hgetall(HISTOGRAMS.format(histogram)).items():
+            *values, le = json.loads(field)
+            if le == "sum":
+                sums[tuple(values)] = float(value)
+            else:
+                counts.setdefault(tuple(values), {})[le] = int(value)
+        for values, count in sorted(counts.items()):
+            label = ",".join(f'{k}="{v}"' for k, v in zip(labels, values))
+            total = 0
+            for le in (*buckets, math.inf):
+                total += count.get(le, 0)
+                bound = "+Inf" if le == math.inf else le
+                lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {total}')
+            lines.append(f"{metric}_sum{{{label}}} {sums.get(values, 0)}")
+            lines.append(f"{metric}_count{{{label}}} {total}")
+    for name, values in accounts.stats(connection).items():
+        for key, value in sorted(values.items()):
+            metric = f"datarequests_account_{key}"
+            lines.append(f'{metric}{{account="{name}"}} {value}')
+    for name, values in scheduler.stats(connection).items():
+        lines.append(f'datarequests_queued{{queue="{name}"}} {values["queued"]}')
+    return "\n".join(lines) + "\n"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render(self.server.connection).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(connection, port=PORT):
+    server = ThreadingHTTPServer(("", port), Handler)
+    server.connection = connection
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    import sys
+
+    from redis import Redis
+
+    connection = Redis(
+        host=os.environ.get("REDIS_HOST", "redis"),
+        port=int(os.environ.get("REDIS_PORT", 6379)),
+    )
+    serve(connection, int(sys.argv[1]) if len(sys.argv) > 1 else PORT)
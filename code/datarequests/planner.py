@@ -0,0 +1,68 @@
+# -- coding: utf-8 --
+"""Split oversized ERA5 requests into chunks accepted by CDS.
+
+CDS limits a single retrieval by the number of fields it touches, i.e. the
+product of all request dimensions (variables, levels, days, months, years
+and times). The planner estimates that number and cuts a request along
+year, month and pressure level until every chunk is below the limit.
+"""
+
+import copy
+import os
+
+MAX_FIELDS = int(os.environ.get("CDS_MAX_FIELDS", 120000))
+SPLIT_AXES = ("year", "month", "pressure_level", "variable")
+
+
+def fields(request):
+    """Estimated number of fields touched by an `_ECMWF` request."""
+    n = len(request.variable) * len(request.year) * len(request.month)
+    n *= len(request.time)
+    n *= len(getattr(request, "day", [None]))
+    n *= len(getattr(request, "pressure_level", [None]))
+    return n
+
+
+def derive(request, **changes):
+    """Copy of an already validated request with some dimensions replaced."""
+    new = copy.copy(request)
+    for k, v in changes.items():
+        setattr(new, k, list(v))
+    return new
+
+
+def split(request, max_fields=None):
+    """Split `request` into a list of requests below `max_fields` each."""
+    max_fields = max_fields or MAX_FIELDS
+    total = fields(request)
+    if total <= max_fields:
+        return [request]
+    for axis in SPLIT_AXES:
+        values = getattr(request, axis, [])
+        if len(values) > 1:
+            break
+    else:
+        raise ValueError(f"Request can not be split below {max_fields} fields")
+    per_value = total // len(values)
+    size = max(1, max_fields // per_value)
+    chunks = []
+    for i in range(0, len(values), size):
+        part = derive(request, **{axis: values[i : i + size]})
+        chunks.extend(split(part, max_fields))
+    return chunks
+
+
+def halves(params):
+    """Split request parameters in two along the first axis with several values.
+
+    Used for requests CDS rejected although they are below `MAX_FIELDS`.
+    """
+    for axis in SPLIT_AXES + ("day", "time"):
+        values = params.get(axis, [])
+        if len(values) > 1:
+            half = (len(values) + 1) // 2
+            return [
+                dict(params, **{axis: values[:half]}),
+                dict(params, **{axis: values[half:]}),
+            ]
+    raise ValueError("Request can not be split any further")
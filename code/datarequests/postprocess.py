@@ -0,0 +1,227 @@
+# -- coding: utf-8 --
+"""Regrid and aggregate finished files on the workers.
+
+A request can carry a post-processing spec, e.g.
+
+    ERA5SingleLevelsRequest(..., postprocess=dict(grid=1.0, aggregate="daily"))
+
+- `grid`: resolution in degrees of the regular grid to regrid to
+- `method`: `conservative` (default, area weighted) or `bilinear`
+- `aggregate`: `daily` or `monthly` aggregation in time
+- `statistic`: `mean` (default), `sum`, `min` or `max` per period
+- `keep`: keep the full resolution file next to the reduced one
+
+After the download a `postprocess` job replaces the output by the reduced
+file (with `keep` the original stays next to it as `*.full.nc`). The file is
+read and written chunk by chunk along time in whole periods, at most
+`POSTPROCESS_MEMORY` bytes at once. On a regular latitude/longitude grid
+both methods are separable into a weight matrix per axis. The weights are
+cached in memory and in `POSTPROCESS_CACHE` for all files on the same grid.
+Reduced files are recorded in the catalog under a dataset of their own,
+e.g. `reanalysis-era5-single-levels/1.0deg.conservative.daily_mean`.
+"""
+
+import hashlib
+import os
+import warnings
+
+import numpy as np
+
+from . import conversion
+from . import derived
+from . import grib
+
+MEMORY = int(os.environ.get("POSTPROCESS_MEMORY", 256 << 20))
+CACHE = os.environ.get(
+    "POSTPROCESS_CACHE",
+    os.path.join(os.path.dirname(__file__), "..", "rstore", "weights"),
+)
+METHODS = ("conservative", "bilinear")
+PERIODS = {"daily": "datetime64[D]", "monthly": "datetime64[M]"}
+STATISTICS = {"mean": np.nanmean, "sum": np.nansum, "min": np.nanmin, "max": np.nanmax}
+DEFAULTS = dict(
+    grid=None, method="conservative", aggregate=None, statistic="mean", keep=False
+)
+FULL = ".full"  # suffix of the kept full resolution file
+
+_weights = {}
+
+
+def check(spec):
+    """Validated spec with all defaults filled in (part of the `job_id`)."""
+    unknown = set(spec) - set(DEFAULTS)
+    if unknown:
+        raise KeyError(f"Unknown post-processing options {sorted(unknown)}")
+    spec = {**DEFAULTS, **spec}
+    if spec["grid"] is not None:
+        spec["grid"] = float(spec["grid"])
+        if spec["grid"] <= 0:
+            raise KeyError(f"Grid {spec['grid']} must be positive")
+    if spec["method"] not in METHODS:
+        raise KeyError(f"Method {spec['method']} not in {METHODS}")
+    if spec["aggregate"] is not None and spec["aggregate"] not in PERIODS:
+        raise KeyError(f"Aggregation {spec['aggregate']} not in {tuple(PERIODS)}")
+    if spec["statistic"] not in STATISTICS:
+        raise KeyError(f"Statistic {spec['statistic']} not in {tuple(STATISTICS)}")
+    if spec["grid"] is None and spec["aggregate"] is None:
+        raise KeyError("Nothing to post-process without grid or aggregate")
+    spec["keep"] = bool(spec["keep"])
+    return spec
+
+
+def dataset(name, spec):
+    """Catalog dataset of files reduced according to `spec`."""
+    parts = []
+    if spec["grid"] is not None:
+        parts += [f"{spec['grid']}deg", spec["method"]]
+    if spec["aggregate"] is not None:
+        parts.append(f"{spec['aggregate']}_{spec['statistic']}")
+    return f"{name}/{'.'.join(parts)}"
+
+
+def full(target):
+    """Path the full resolution file is kept at."""
+    stem, extension = os.path.splitext(target)
+    return f"{stem}{FULL}{extension}"
+
+
+def apply(source, target, spec):
+    """Write `source` regridded and aggregated according to `spec` to `target`."""
+    with conversion.open_dataset(source) as ds:
+        names = [v for v in ds.data_vars if ds[v].dims[:1] == ("time",)]
+        lat, lon = ds.latitude.values, ds.longitude.values
+        times = ds.time.values
+        levels = ds.level.values if "level" in ds.dims else np.array([], "i4")
+        weights = None
+        if spec["grid"] is not None:
+            lat, lon, weights = regridding(lat, lon, spec["grid"], spec["method"])
+        labels = np.arange(len(times))
+        if spec["aggregate"] is not None:
+            labels = times.astype(PERIODS[spec["aggregate"]])
+            times = np.unique(labels).astype("datetime64[m]")
+        layout = dict(
+            variables={
+                v: dict(
+                    name=ds[v].attrs.get("long_name", v),
+                    units=ds[v].attrs.get("units", ""),
+                    levels=set(levels.tolist()) if "level" in ds[v].dims else set(),
+                )
+                for v in names
+            },
+            time=times,
+            level=levels,
+            latitude=lat.astype("f4"),
+            longitude=lon.astype("f4"),
+        )
+        step = sum(ds[v].isel(time=slice(0, 1)).nbytes for v in names) or 1
+        statistic = STATISTICS[spec["statistic"]]
+        partial = "{0}.part{1}".format(*os.path.splitext(target))
+        written = 0
+        with grib._NetCDF(partial, layout) as out:
+            periodic = spec["aggregate"] is not None
+            for chunk in derived._chunks(labels, max(1, MEMORY // step), periodic):
+                count = 0
+                for v in names:
+                    values = ds[v].isel(time=chunk).values.astype("f4")
+                    if periodic:
+                        _, starts = np.unique(labels[chunk], return_index=True)
+                        with warnings.catch_warnings():
+                            warnings.simplefilter("ignore", RuntimeWarning)  # all NaN
+                            values = np.stack(
+                                [
+                                    statistic(x, axis=0)
+                                    for x in np.split(values, starts[1:])
+                                ]
+                            )
+                    if weights is not None:
+                        values = regrid(values, *weights)
+                    count = len(values)
+                    out.write(v, (slice(written, written + count),), values)
+                written += count
+    os.replace(partial, target)
+
+
+def regridding(lat, lon, grid, method):
+    """Target coordinates and (cached) weights of regridding to `grid` degrees."""
+    new_lat, new_lon = _axis(lat, grid), _axis(lon, grid)
+    key = hashlib.md5(
+        b"".join(
+            np.ascontiguousarray(a, "f8").tobytes()
+            for a in (lat, lon, new_lat, new_lon)
+        )
+        + method.encode()
+    ).hexdigest()
+    if key not in _weights:
+        path = os.path.join(CACHE, f"{key}.npz")
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                weights = cached["lat"], cached["lon"]
+        else:
+            if method == "conservative":
+                weights = (
+                    _conservative(lat, new_lat, grid, latitude=True),
+                    _conservative(lon, new_lon, grid),
+                )
+            else:
+                weights = _bilinear(lat, new_lat), _bilinear(lon, new_lon)
+            os.makedirs(CACHE, exist_ok=True)
+            partial = f"{path}.{os.getpid()}.npz"
+            np.savez(partial, lat=weights[0], lon=weights[1])
+            os.replace(partial, path)
+        _weights[key] = tuple(w.astype("f4") for w in weights)
+    return new_lat, new_lon, _weights[key]
+
+
+def regrid(values, lat, lon):
+    """Apply the weights of each axis to the last two axes of `values`.
+
+    Missing values are left out and the weights renormalised.
+    """
+    valid = np.isfinite(values)
+    total = lat @ np.where(valid, values, 0) @ lon.T
+    weight = lat @ valid.astype("f4") @ lon.T
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weight > 0, total / weight, np.nan).astype("f4")
+
+
+def _axis(coords, step):
+    """Coordinates every `step` degrees over the extent of `coords`."""
+    extent = coords[-1] - coords[0]
+    n = int(np.floor(abs(extent) / step + 1e-6)) + 1
+    return coords[0] + np.sign(extent or 1) * step * np.arange(n)
+
+
+def _spacing(coords, default):
+    return abs(float(coords[1] - coords[0])) if len(coords) > 1 else default
+
+
+def _conservative(source, target, step, latitude=False):
+    """Overlap of target with source cells (by area on the sphere for `latitude`)."""
+    half = _spacing(source, step) / 2
+    bounds = []
+    for centers, width in ((source, half), (target, step / 2)):
+        low, high = centers - width, centers + width
+        if latitude:
+            low, high = (np.sin(np.radians(np.clip(x, -90, 90))) for x in (low, high))
+        bounds.append((low, high))
+    (s_low, s_high), (t_low, t_high) = bounds
+    overlap = np.minimum(t_high[:, None], s_high) - np.maximum(t_low[:, None], s_low)
+    overlap = np.clip(overlap, 0, None)
+    total = overlap.sum(axis=1, keepdims=True)
+    return np.divide(overlap, total, out=np.zeros_like(overlap), where=total > 0)
+
+
+def _bilinear(source, target):
+    """Linear interpolation weights between the two neighbouring points."""
+    weights = np.zeros((len(target), len(source)))
+    if len(source) == 1:
+        weights[:] = 1
+        return weights
+    order = np.argsort(source)
+    ordered = source[order]
+    i = np.clip(np.searchsorted(ordered, target) - 1, 0, len(source) - 2)
+    f = np.clip((target - ordered[i]) / (ordered[i + 1] - ordered[i]), 0, 1)
+    rows = np.arange(len(target))
+    weights[rows, order[i]] = 1 - f
+    weights[rows, order[i + 1]] += f
+    return weights
@@ -0,0 +1,315 @@
+# -- coding: utf-8 --
+"""Reference index of the downloaded files for lazy multi-file datasets.
+
+CDS delivers NetCDF3 files. After a download the header of the file is
+parsed once and byte offsets, shapes, encodings and coordinates of all its
+variables are stored with the file in the catalog. `open_dataset` builds a
+single lazy dataset over all indexed files of a variable from the catalog
+alone, without opening any file. Data is read through memory maps only when
+it is accessed, e.g. a point time series reads a few bytes per time step.
+Files written locally as NetCDF4 (e.g. merged, assembled or decoded from
+GRIB) are indexed by shapes, encodings and coordinates as well; their data
+is read through the netCDF4 library on access.
+
+Files recorded before the index existed are indexed with
+
+    python -m datarequests.references
+"""
+
+import json
+import os
+import threading
+import warnings
+
+import dask.array as da
+import numpy as np
+import xarray as xr
+from xarray.backends.common import BackendArray
+from xarray.core import indexing
+
+from . import catalog
+from . import variables
+
+TYPES = {1: "i1", 2: "S1", 3: ">i2", 4: ">i4", 5: ">f4", 6: ">f8"}
+NC_DIMENSION, NC_VARIABLE, NC_ATTRIBUTE = 10, 11, 12
+STREAMING = 0xFFFFFFFF
+HDF5 = b"\x89HDF\r\n\x1a\n"  # signature of NetCDF4 files
+AREA = [90, -180, -90, 180]
+
+
+class _Header:
+    """Reader of the header of a NetCDF3 (classic or 64-bit offset) file."""
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.position = 4
+        self.offset = ">i4" if buffer[3] == 1 else ">i8"
+
+    def read(self, dtype, count=1):
+        values = np.frombuffer(self.buffer, dtype, count, self.position)
+        self.position += values.nbytes
+        return values
+
+    def int(self):
+        return int(self.read(">u4")[0])
+
+    def name(self):
+        n = self.int()
+        name = bytes(self.buffer[self.position : self.position + n]).decode()
+        self.position += -(-n // 4) * 4
+        return name
+
+    def list(self, tag, item):
+        found, n = self.int(), self.int()
+        if found not in (0, tag):
+            raise ValueError(f"Unexpected tag {found} in NetCDF3 header")
+        return [item() for _ in range(n)]
+
+    def attribute(self):
+        name, dtype, n = self.name(), TYPES[self.int()], self.int()
+        size = np.dtype(dtype).itemsize * n
+        values = self.read(dtype, n)
+        self.position += -(-size // 4) * 4 - size
+        if dtype == "S1":
+            return name, values.tobytes().decode("utf-8", "replace")
+        return name, values.item() if n == 1 else values.tolist()
+
+    def variable(self):
+        name = self.name()
+        dims = [self.int() for _ in range(self.int())]
+        attrs = dict(self.list(NC_ATTRIBUTE, self.attribute))
+        dtype, vsize = TYPES[self.int()], self.int()
+        begin = int(self.read(self.offset)[0])
+        return name, dict(dims=dims, attrs=attrs, dtype=dtype, vsize=vsize, begin=begin)
+
+
+def index(path):
+    """References of all variables of a NetCDF3 or NetCDF4 file (`None` otherwise)."""
+    if os.path.isdir(path):  # e.g. Zarr
+        return None
+    with open(path, "rb") as f:
+        signature = f.read(len(HDF5))
+    if signature == HDF5:
+        return _index_netcdf4(path)
+    if signature[:4] not in (b"CDF\x01", b"CDF\x02"):
+        return None
+    buffer = np.memmap(path, np.uint8, "r")
+    header = _Header(buffer)
+    numrecs = header.int()
+    dims = header.list(NC_DIMENSION, lambda: (header.name(), header.int()))
+    header.list(NC_ATTRIBUTE, header.attribute)
+    refs = dict(header.list(NC_VARIABLE, header.variable))
+    record = [v for v in refs.values() if v["dims"] and dims[v["dims"][0]][1] == 0]
+    recsize = sum(v["vsize"] for v in record)
+    for v in refs.values():
+        shape = [size for _, size in (dims[d] for d in v["dims"])]
+        v["record"] = bool(shape) and shape[0] == 0
+        if len(record) == 1 and v["record"]:  # no padding between records
+            recsize = int(np.prod(shape[1:], dtype=int)) * np.dtype(v["dtype"]).itemsize
+        v["dims"] = [dims[d][0] for d in v["dims"]]
+        v["shape"] = shape
+    if numrecs == STREAMING:
+        numrecs = (len(buffer) - min(v["begin"] for v in record)) // recsize
+    for name, v in refs.items():
+        if v["record"]:
+            v["shape"][0] = numrecs
+        del v["vsize"]
+        if v["dims"] == [name]:
+            v["values"] = _values(path, v, recsize).tolist()
+    _decode_time(refs)
+    return dict(recsize=recsize, variables=refs)
+
+
+def _index_netcdf4(path):
+    """References of a NetCDF4 file, its data is read by `NetCDF4Array`."""
+    import netCDF4
+
+    refs = {}
+    with _HDF5_LOCK, netCDF4.Dataset(path) as ds:
+        for name, v in ds.variables.items():
+            if v.dtype == str or v.dtype.kind not in "iuf":
+                continue
+            v.set_auto_maskandscale(False)
+            refs[name] = dict(
+                dims=list(v.dimensions),
+                attrs={k: _plain(v.getncattr(k)) for k in v.ncattrs()},
+                dtype=v.dtype.str,
+                shape=list(v.shape),
+            )
+            if refs[name]["dims"] == [name]:
+                refs[name]["values"] = v[:].tolist()
+    _decode_time(refs)
+    return dict(format="netcdf4", variables=refs)
+
+
+def _plain(value):
+    """Attribute value as stored in JSON."""
+    if isinstance(value, np.ndarray):
+        return value.item() if value.size == 1 else value.tolist()
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _decode_time(refs):
+    if "time" in refs:
+        time = refs["time"]
+        decoded = xr.decode_cf(
+            xr.Dataset({"time": ("time", time["values"], time["attrs"])})
+        ).time
+        time["values"] = decoded.values.astype("datetime64[ns]").astype(int).tolist()
+        time["attrs"] = decoded.attrs
+
+
+def _values(path, ref, recsize):
+    """Memory mapped values of a variable; records are `recsize` apart."""
+    dtype, strides, step = np.dtype(ref["dtype"]), [], np.dtype(ref["dtype"]).itemsize
+    for n in reversed(ref["shape"]):
+        strides.insert(0, step)
+        step *= n
+    if ref["record"]:
+        strides[0] = recsize
+    buffer = np.memmap(path, np.uint8, "r")
+    return np.ndarray(ref["shape"], dtype, buffer, ref["begin"], strides)
+
+
+class NetCDF3Array(BackendArray):
+    """Lazily indexed variable of a NetCDF3 file described by its reference."""
+
+    def __init__(self, path, ref, recsize):
+        self.path, self.ref, self.recsize = path, ref, recsize
+        self.shape = tuple(ref["shape"])
+        self.dtype = np.dtype(ref["dtype"])
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.BASIC, self._getitem
+        )
+
+    def _getitem(self, key):
+        return np.array(_values(self.path, self.ref, self.recsize)[key])
+
+
+_HDF5_LOCK = threading.Lock()  # the HDF5 library is not thread-safe
+
+
+class NetCDF4Array(BackendArray):
+    """Lazily indexed variable of a NetCDF4 file, opened on access only."""
+
+    def __init__(self, path, name, ref):
+        self.path, self.name = path, name
+        self.shape = tuple(ref["shape"])
+        self.dtype = np.dtype(ref["dtype"])
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key, self.shape, indexing.IndexingSupport.BASIC, self._getitem
+        )
+
+    def _getitem(self, key):
+        import netCDF4
+
+        with _HDF5_LOCK, netCDF4.Dataset(self.path) as ds:
+            variable = ds[self.name]
+            variable.set_auto_maskandscale(False)  # decoded by xarray
+            return np.asarray(variable[key])
+
+
+def record(path, db=None):
+    """Index a file already recorded in the catalog."""
+    refs = index(path)
+    if refs is None:
+        warnings.warn(f"{path} is neither NetCDF3 nor NetCDF4, not indexed")
+        return False
+    db = db or catalog.connect()
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO refs SELECT id, ? FROM files WHERE path = ?",
+            (json.dumps(refs), path),
+        )
+    return True
+
+
+def open_dataset(name, variable, area=None, pressure_level=None, db=None):
+    """All indexed files of `variable` as one lazy dataset sorted by time."""
+    db = db or catalog.connect()
+    rows = db.execute(
+        """
+        SELECT f.path, r.refs FROM files f JOIN refs r ON r.file = f.id
+        WHERE f.dataset = ? AND f.north = ? AND f.west = ? AND f.south = ?
+        AND f.east = ? AND EXISTS (
+            SELECT 1 FROM cells c WHERE c.file = f.id AND c.variable = ?
+        ) ORDER BY f.path
+        """,
+        (name, *(area or AREA), variable),
+    ).fetchall()
+    (missing,) = db.execute(
+        """
+        SELECT COUNT(*) FROM files f
+        WHERE f.dataset = ? AND f.north = ? AND f.west = ? AND f.south = ?
+        AND f.east = ? AND f.id NOT IN (SELECT file FROM refs) AND EXISTS (
+            SELECT 1 FROM cells c WHERE c.file = f.id AND c.variable = ?
+        )
+        """,
+        (name, *(area or AREA), variable),
+    ).fetchone()
+    if missing:
+        warnings.warn(
+            f"{missing} files of {variable} are not indexed and left out"
+            " (see `python -m datarequests.references`)"
+        )
+    if not rows:
+        raise KeyError(f"No indexed files of {variable} in {name}")
+    levels = [int(x) for x in pressure_level] if pressure_level else None
+    pieces, coords = [], None
+    for path, refs in rows:
+        refs = json.loads(refs)
+        short, ref = _data_variable(refs["variables"], variable)
+        if refs.get("format") == "netcdf4":
+            array = NetCDF4Array(path, short, ref)
+        else:
+            array = NetCDF3Array(path, ref, refs["recsize"])
+        var = xr.Variable(ref["dims"], indexing.LazilyIndexedArray(array), ref["attrs"])
+        var = xr.conventions.decode_cf_variable(short, var)
+        found = {k: refs["variables"][k]["values"] for k in ref["dims"]}
+        if "level" in found:
+            levels = levels or found["level"]
+            if not pressure_level and found["level"] != levels:
+                raise ValueError("Files with different pressure levels, choose some")
+            if not set(levels) <= set(found["level"]):
+                continue
+            var = var.isel(level=[found["level"].index(x) for x in levels])
+            found["level"] = levels
+        if coords is None:
+            coords = {
+                k: (k, v, refs["variables"][k]["attrs"]) for k, v in found.items()
+            }
+        pieces.append((var.chunk().data, found["time"]))
+    if not pieces:
+        raise KeyError(f"No indexed files of {variable} on levels {levels}")
+    axis = var.dims.index("time")
+    data = da.concatenate([p[0] for p in pieces], axis=axis)
+    times = np.concatenate([np.array(p[1], "datetime64[ns]") for p in pieces])
+    order = np.argsort(times, kind="stable")
+    keep = order[np.r_[True, times[order][1:] != times[order][:-1]]]
+    if len(keep) != len(times) or (keep != np.arange(len(times))).any():
+        data, times = da.take(data, keep, axis=axis), times[keep]
+    coords["time"] = ("time", times)
+    return xr.Dataset({short: (var.dims, data, var.attrs)}, coords)
+
+
+def _data_variable(refs, variable):
+    short = variables.SHORT_NAMES.get(variable)
+    if short not in refs:
+        names = [k for k, v in refs.items() if v["dims"] != [k]]
+        if len(names) != 1:
+            raise KeyError(f"{variable} not found in {sorted(names)}")
+        short = names[0]
+    return short, refs[short]
+
+
+if __name__ == "__main__":
+    db = catalog.connect()
+    paths = db.execute(
+        "SELECT path FROM files WHERE id NOT IN (SELECT file FROM refs)"
+    ).fetchall()
+    indexed = sum(record(path, db) for (path,) in paths)
+    print(f"{indexed} of {len(paths)} files indexed")
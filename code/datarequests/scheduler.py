@@ -0,0 +1,119 @@
+# -- coding: utf-8 --
+"""Route retrievals into queues by their estimated cost.
+
+The cost of a request is the number of values it retrieves: the product of
+all request dimensions (variables, levels, years, months, days and times)
+and the grid points of the ERA5 grid inside its area. Requests are put into
+the `small`, `medium` or `large` queue, workers listen to them in this order
+(see `QUEUES`). A job waiting longer than `SCHEDULER_AGING` seconds is moved
+to the front of the next faster tier, so large requests are never starved.
+
+The queue wait of every retrieval job is sampled per queue in Redis:
+
+    python -m datarequests.scheduler
+"""
+
+import os
+from datetime import timedelta
+
+from rq import Queue
+from rq.utils import utcnow
+
+GRID = 0.25  # degrees
+DIMENSIONS = ("variable", "pressure_level", "year", "month", "day", "time")
+TIERS = ("small", "medium", "large")
+LIMITS = (
+    float(os.environ.get("SCHEDULER_SMALL", 1e8)),
+    float(os.environ.get("SCHEDULER_MEDIUM", 2e9)),
+)
+QUEUES = ("default",) + TIERS  # priority of the workers
+AGING = float(os.environ.get("SCHEDULER_AGING", 6 * 3600))
+WAITS = "datarequests:wait:{}"
+SAMPLES = 10000
+
+
+def cost(params):
+    """Estimated number of values retrieved by the parameters of a request."""
+    n = 1
+    for dimension in DIMENSIONS:
+        n *= len(params.get(dimension, [None]))
+    north, west, south, east = params.get("area", [90, -180, -90, 180])
+    n *= int((north - south) / GRID) + 1
+    n *= min(int((east - west) / GRID) + 1, int(360 / GRID))
+    return n
+
+
+def tier(params):
+    n = cost(params)
+    for name, limit in zip(TIERS, LIMITS):
+        if n <= limit:
+            return name
+    return TIERS[-1]
+
+
+def queue(params, connection, **kwargs):
+    return Queue(tier(params), connection=connection, **kwargs)
+
+
+def age(connection, aging=AGING):
+    """Move jobs up by one tier for every `aging` seconds they waited."""
+    now = utcnow()
+    moved = 0
+    for slower, faster in zip(TIERS[1:], TIERS[:-1]):
+        source = Queue(slower, connection=connection)
+        target = Queue(faster, connection=connection)
+        for job in source.get_jobs(0, 99):
+            aged = job.meta.get("aged", 0) + 1
+            if job.enqueued_at is None:
+                continue
+            if job.enqueued_at > now - timedelta(seconds=aging * aged):
+                continue
+            source.remove(job)
+            job.origin = target.name
+            job.meta["aged"] = aged
+            job.save()
+            target.push_job_id(job.id, at_front=True)
+            moved += 1
+    return moved
+
+
+def observe(job):
+    """Sample the time `job` waited in its queue."""
+    if job.enqueued_at is None or job.started_at is None:
+        return
+    wait = (job.started_at - job.enqueued_at).total_seconds()
+    key = WAITS.format(job.origin)
+    with job.connection.pipeline() as pipe:
+        pipe.lpush(key, wait)
+        pipe.ltrim(key, 0, SAMPLES - 1)
+        pipe.execute()
+
+
+def percentile(values, p):
+    """`p`-th percentile of sorted `values` (nearest rank)."""
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def stats(connection):
+    """Queue length and percentiles of the sampled waits per queue."""
+    result = {}
+    for name in QUEUES:
+        waits = sorted(float(v) for v in connection.lrange(WAITS.format(name), 0, -1))
+        values = dict(queued=Queue(name, connection=connection).count)
+        if waits:
+            values.update(samples=len(waits), max=waits[-1])
+            values.update({f"p{p}": percentile(waits, p) for p in (50, 90, 99)})
+        result[name] = values
+    return result
+
+
+if __name__ == "__main__":
+    import json
+
+    from redis import Redis
+
+    connection = Redis(
+        host=os.environ.get("REDIS_HOST", "redis"),
+        port=int(os.environ.get("REDIS_PORT", 6379)),
+    )
+    print(json.dumps(stats(connection), indent=2))
@@ -0,0 +1,78 @@
+# -- coding: utf-8 --
+"""Compiled schema of the ERA5 datasets.
+
+The allowed values of every axis are built once at import from `defaults`
+and `variables` into immutable tuples in canonical order. Each value is
+coded by its position; every accepted spelling of a value (e.g. `1`, `"1"`
+and `"01"` for January) maps to the same code, so validating and
+canonicalising a list of values is a single lookup per value.
+
+    >>> SCHEMAS["reanalysis-era5-single-levels"].canonical("month", [1, "2"])
+    ['01', '02']
+"""
+
+from dataclasses import dataclass, field
+from types import MappingProxyType
+
+from . import defaults
+from . import variables
+
+# Numeric axes and how their values are spelled canonically
+RANGES = {"year": "{:04}", "month": "{:02}", "day": "{:02}", "pressure_level": "{}"}
+
+
+@dataclass(frozen=True)
+class Schema:
+    """Allowed values per axis of a dataset, in canonical order."""
+
+    name: str
+    axes: MappingProxyType
+    codes: MappingProxyType = field(init=False, repr=False)
+
+    def __post_init__(self):
+        codes = {}
+        for axis, values in self.axes.items():
+            spellings = {}
+            for code, value in enumerate(values):
+                spellings[value] = code
+                if axis in RANGES:
+                    spellings[int(value)] = code
+                    spellings[str(int(value))] = code
+            codes[axis] = MappingProxyType(spellings)
+        object.__setattr__(self, "codes", MappingProxyType(codes))
+
+    def canonical(self, axis, values):
+        """Canonical spelling of `values`, `KeyError` for invalid values."""
+        codes, allowed = self.codes[axis], self.axes[axis]
+        try:
+            return [allowed[codes[v]] for v in values]
+        except KeyError:
+            wrong = [v for v in values if v not in codes]
+            raise KeyError(f"{axis} not allowed in {self.name}: {wrong}") from None
+
+    def valid(self, axis, values):
+        """Canonical spelling of the valid ones of `values`."""
+        codes, allowed = self.codes[axis], self.axes[axis]
+        return [allowed[codes[v]] for v in values if v in codes]
+
+
+def _schema(name, **axes):
+    common = dict(
+        year=defaults.year(),
+        month=defaults.month(),
+        day=defaults.day(),
+        time=defaults.time(),
+    )
+    axes = {k: tuple(v) for k, v in dict(common, **axes).items()}
+    return Schema(name, MappingProxyType(axes))
+
+
+SINGLE_LEVELS = _schema(
+    "reanalysis-era5-single-levels", variable=variables.SINGLE_LEVELS
+)
+PRESSURE_LEVELS = _schema(
+    "reanalysis-era5-pressure-levels",
+    variable=variables.PRESSURE_LEVELS,
+    pressure_level=defaults.pl(),
+)
+SCHEMAS = MappingProxyType({s.name: s for s in (SINGLE_LEVELS, PRESSURE_LEVELS)})
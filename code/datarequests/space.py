@@ -0,0 +1,112 @@
+# -- coding: utf-8 --
+"""Reserve disk space for downloads before they start.
+
+The size of a result is predicted from the request (see `predict`) or taken
+from CDS once the request completed. Reservations are kept per volume (the
+mount point of the target) in a Redis ledger. A download is only started if
+its size fits into the free space of the volume minus all reservations and
+`DATAREQUESTS_MIN_FREE` bytes; otherwise it is held back. Reservations are
+released when the download finished or failed and expire after `LEASE`
+seconds, so crashed workers do not block a volume forever. Reservations are
+taken on the workers (the only containers mounting the volumes); staged
+downloads that do not fit raise `Full` and are scheduled again after
+`DATAREQUESTS_HOLD` seconds (see `failures.handle`).
+
+Space already written by running downloads is counted twice (free space and
+reservation), which errs on the safe side.
+"""
+
+import json
+import os
+import shutil
+import time
+
+from . import scheduler
+
+BYTES_PER_VALUE = 2  # CDS packs NetCDF values into 16 bit integers
+OVERHEAD = 1.05  # coordinates, metadata and deviations of the estimate
+MIN_FREE = int(float(os.environ.get("DATAREQUESTS_MIN_FREE", 1 << 30)))
+LEASE = 24 * 3600
+LEDGER = "datarequests:space:{}"
+HOLD = int(os.environ.get("DATAREQUESTS_HOLD", 300))  # seconds
+
+
+class Full(Exception):
+    """The result of a download does not fit on its volume (yet)."""
+
+
+def predict(params):
+    """Predicted size of the result of a request in bytes."""
+    return int(scheduler.cost(params) * BYTES_PER_VALUE * OVERHEAD)
+
+
+def volume(path):
+    """Mount point of the volume `path` is written to."""
+    path = os.path.dirname(os.path.abspath(path))
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _reserved(values, now):
+    return sum(size for size, expires in map(json.loads, values) if expires > now)
+
+
+def try_reserve(connection, token, target, size):
+    """Reserve `size` bytes on the volume of `target` for `token`."""
+    mount = volume(target)
+    key = LEDGER.format(mount)
+
+    def reserve(pipe):
+        now = time.time()
+        ledger = pipe.hgetall(key)
+        ledger.pop(token.encode(), None)
+        free = shutil.disk_usage(mount).free - _reserved(ledger.values(), now)
+        if size > free - MIN_FREE:
+            return False
+        pipe.multi()
+        for field, value in ledger.items():
+            if json.loads(value)[1] <= now:
+                pipe.hdel(key, field)
+        pipe.hset(key, token, json.dumps([size, now + LEASE]))
+        return True
+
+    return connection.transaction(reserve, key, value_from_callable=True)
+
+
+def reserve(connection, token, target, size, poll=30):
+    """Block until `size` bytes for `target` are reserved."""
+    while not try_reserve(connection, token, target, size):
+        time.sleep(poll)
+
+
+def release(connection, token, target):
+    connection.hdel(LEDGER.format(volume(target)), token)
+
+
+def forget(connection, token):
+    """Release the reservations of `token` on all volumes."""
+    for key in connection.scan_iter(LEDGER.format("*")):
+        connection.hdel(key, token)
+
+
+def stats(connection):
+    """Free and reserved bytes per volume with reservations."""
+    now, result = time.time(), {}
+    for key in connection.scan_iter(LEDGER.format("*")):
+        mount = key.decode()[len(LEDGER.format("")) :]
+        result[mount] = dict(
+            free=shutil.disk_usage(mount).free,
+            reserved=_reserved(connection.hvals(key), now),
+        )
+    return result
+
+
+if __name__ == "__main__":
+    from redis import Redis
+
+    connection = Redis(
+        host=os.environ.get("REDIS_HOST", "redis"),
+        port=int(os.environ.get("REDIS_PORT", 6379)),
+    )
+    print(json.dumps(stats(connection), indent=2))
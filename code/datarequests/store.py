@@ -0,0 +1,97 @@
+# -- coding: utf-8 --
+"""Content-addressed store of downloaded files.
+
+With `DATAREQUESTS_STORE` set, every request is retrieved once into a file
+below that folder named by its `job_id` (the hash of the canonical request),
+e.g. `store/3f/3f2a...c1.nc`. The paths the requests were sent for are
+registered as targets of the job in Redis and materialised as hard links
+(symbolic links across file systems or with `STORE_LINK=symlink`) as soon
+as the stored file is complete. Identical requests for different paths
+therefore share a single retrieval and a single copy on disk.
+
+    DATAREQUESTS_STORE=/raid/era5/store
+"""
+
+import errno
+import os
+
+ROOT = os.environ.get("DATAREQUESTS_STORE")
+LINK = os.environ.get("STORE_LINK", "hardlink")  # "hardlink" or "symlink"
+TARGETS = "datarequests:store:{}"  # job_id -> paths to link on completion
+FALLBACK = (errno.EXDEV, errno.EPERM, errno.EMLINK)  # hard links impossible
+
+
+def path(job_id, output, root=None):
+    """Stored file of a request, with the extension of its `output`."""
+    extension = os.path.splitext(output)[1] or ".nc"
+    return os.path.join(root or ROOT, job_id[:2], f"{job_id}{extension}")
+
+
+def owner(stored, root=None):
+    """Job id of a stored file (`None` for files not in the store)."""
+    root = root or ROOT
+    if not root:
+        return None
+    folder, name = os.path.split(os.path.abspath(stored))
+    if os.path.dirname(folder) != os.path.abspath(root):
+        return None
+    return os.path.splitext(name)[0]
+
+
+def add(connection, pairs):
+    """Register the `(job_id, output)` pairs and return their stored files.
+
+    Outputs of requests already stored are linked right away, all others
+    when their job finishes (see `materialise`). Without a store the
+    outputs are returned unchanged.
+    """
+    if not ROOT:
+        return [output for _, output in pairs]
+    stored = [path(job_id, output) for job_id, output in pairs]
+    with connection.pipeline() as pipe:
+        for job_id, output in pairs:
+            pipe.sadd(TARGETS.format(job_id), os.path.abspath(output))
+        pipe.execute()
+    for source in stored:
+        if os.path.exists(source):
+            materialise(connection, source)
+    return stored
+
+
+def materialise(connection, stored):
+    """Link all targets registered for a stored file to it."""
+    job_id = owner(stored)
+    if job_id is None:
+        return []
+    key = TARGETS.format(job_id)
+    linked = []
+    for target in connection.smembers(key):
+        target = target.decode()
+        try:
+            link(stored, target)
+        except OSError as e:
+            print(f"Could not link {target} to {stored}: {e}")
+            continue
+        linked.append(target)
+    if linked:
+        connection.srem(key, *linked)
+    return linked
+
+
+def link(stored, target):
+    """Replace `target` atomically by a link to `stored`."""
+    if os.path.exists(target) and os.path.samefile(stored, target):
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    temporary = f"{target}.link"
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+    try:
+        if LINK == "symlink":
+            raise OSError(errno.EPERM, "symbolic links configured")
+        os.link(stored, temporary)
+    except OSError as e:
+        if e.errno not in FALLBACK:
+            raise
+        os.symlink(os.path.abspath(stored), temporary)
+    os.replace(temporary, target)
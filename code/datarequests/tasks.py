@@ -1,7 +1,477 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
 import cdsapi
+import xarray as xr
+from redis import Redis
+from rq import Queue, get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq.registry import DeferredJobRegistry
+from . import accounts
+from . import catalog
+from . import consolidate as consolidation
+from . import conversion
+from . import derived
+from . import failures
+from . import grib
+from . import ledger
+from . import metrics
+from . import postprocess as postprocessing
+from . import references
+from . import scheduler
+from . import space
+from . import store
+from . import transfer
+from . import variables
 
-c = cdsapi.Client()
+PENDING = "datarequests:pending"  # CDS request id -> download job and timings
+POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", 30))
+POLL_THREADS = int(os.environ.get("POLL_THREADS", 16))
+POLL_ERRORS = int(os.environ.get("POLL_ERRORS", 10))  # in a row until given up
+OPTIONS = ("name", "target", "postprocess", "intermediate")  # not sent to CDS
 
 
 def get_data(request):
-    c.retrieve(**request)
+    name, params, target = split(request)
+    job = get_current_job()
+    scheduler.observe(job)
+    space.reserve(job.connection, job.id, target, space.predict(params))
+    try:
+        account = accounts.acquire(job.connection, job.id)
+        limiter = account.limiter(job.connection)
+        try:
+            reply = _submit(account, limiter, name, params)
+            reply = _wait(account, reply, limiter)
+        finally:
+            limiter.release(job.id)
+        _download(account, reply, _source(params, target))
+        _decode(job, params, target)
+    finally:
+        space.release(job.connection, job.id, target)
+    metrics.record(job, name, params)
+    _finalise(request)
+
+
+def submit(request, download_id):
+    name, params, _ = split(request)
+    job = get_current_job()
+    account = accounts.try_acquire(job.connection, download_id)
+    if account is None:
+        # Slots are released by the poller, do not keep the worker waiting
+        raise accounts.Busy(f"No CDS account has a free slot for {download_id}")
+    scheduler.observe(job)
+    limiter = account.limiter(job.connection)
+    try:
+        reply = _submit(account, limiter, name, params)
+    except Exception:
+        limiter.release(download_id)
+        raise
+    job.meta.update(request_id=reply["request_id"], account=account.name)
+    job.save_meta()
+    pending(job.connection, reply["request_id"], download_id, account)
+    return reply["request_id"]
+
+
+def pending(connection, request_id, download_id, account):
+    """Register a submitted CDS request with the poller."""
+    entry = dict(
+        job=download_id, account=account.name, submitted=time.time(), started=None
+    )
+    connection.hset(PENDING, request_id, json.dumps(entry))
+
+
+def poll(connection):
+    """Release the download jobs of all completed or failed CDS requests.
+
+    Failed requests are submitted again or split if possible (see
+    `failures.resubmit`). Requests whose state cannot be fetched (e.g. a
+    network error or a request deleted in CDS) are counted as `errors` and
+    polled again; after `POLL_ERRORS` errors in a row they count as failed.
+    Requests whose download job no longer exists are dropped as `missing`.
+    """
+    entries = {
+        k.decode(): json.loads(v) for k, v in connection.hgetall(PENDING).items()
+    }
+    with ThreadPoolExecutor(POLL_THREADS) as pool:
+        replies = list(pool.map(_poll_state, entries.items()))
+    states = {}
+    for (request_id, entry), reply in zip(entries.items(), replies):
+        if isinstance(reply, Exception):
+            states["errors"] = states.get("errors", 0) + 1
+            entry["errors"] = entry.get("errors", 0) + 1
+            if entry["errors"] < POLL_ERRORS:
+                connection.hset(PENDING, request_id, json.dumps(entry))
+                continue
+            reply = dict(
+                state="failed",
+                error=dict(message=str(reply), reason="Polling the request failed"),
+            )
+        elif entry.pop("errors", None):
+            connection.hset(PENDING, request_id, json.dumps(entry))
+        states[reply["state"]] = states.get(reply["state"], 0) + 1
+        if reply["state"] == "queued":
+            continue
+        account = accounts.get(entry["account"])
+        limiter = account.limiter(connection)
+        if entry["started"] is None:
+            entry["started"] = time.time()
+            queue_seconds = entry["started"] - entry["submitted"]
+            _started(connection, account, limiter, queue_seconds)
+            connection.hset(PENDING, request_id, json.dumps(entry))
+        if reply["state"] == "running":
+            continue
+        if entry.get("finished") is None:
+            entry["finished"] = time.time()
+            limiter.release(entry["job"])
+            accounts.count(connection, account, **{reply["state"]: 1})
+            connection.hset(PENDING, request_id, json.dumps(entry))
+        try:
+            job = Job.fetch(entry["job"], connection=connection)
+        except NoSuchJobError:
+            # e.g. deleted or expired while CDS processed the request
+            print(f"Download job {entry['job']} of {request_id} does not exist")
+            limiter.release(entry["job"])
+            space.forget(connection, entry["job"])
+            states["missing"] = states.get("missing", 0) + 1
+            connection.hdel(PENDING, request_id)
+            continue
+        failed = reply["state"] == "failed"
+        if failed and failures.resubmit(job, reply.get("error", {})):
+            states["resubmitted"] = states.get("resubmitted", 0) + 1
+            connection.hdel(PENDING, request_id)
+            continue
+        job.meta.update(cds=reply, account=account.name)
+        metrics.add(
+            job,
+            cds_queue=entry["started"] - entry["submitted"],
+            cds_processing=entry["finished"] - entry["started"],
+        )
+        queue = Queue(job.origin, connection=connection)
+        DeferredJobRegistry(queue=queue).remove(job)
+        job.set_status(JobStatus.QUEUED)
+        queue.enqueue_job(job)
+        connection.hdel(PENDING, request_id)
+    return states
+
+
+def _poll_state(item):
+    """State of a pending CDS request, or the error fetching it."""
+    request_id, entry = item
+    try:
+        return _state(accounts.get(entry["account"]), request_id)
+    except Exception as e:
+        print(f"Polling {request_id} failed: {e!r}")
+        return e
+
+
+def poll_forever(connection, interval=POLL_INTERVAL):
+    archived = 0
+    while True:
+        try:
+            states = poll(connection)
+            if states:
+                print(states)
+            moved = scheduler.age(connection)
+            if moved:
+                print(f"{moved} jobs moved up by one tier")
+            if time.time() - archived >= ledger.INTERVAL:
+                archived = time.time()
+                print(f"{ledger.archive(connection)} jobs archived")
+        except Exception:
+            traceback.print_exc()  # e.g. Redis unavailable, poll again
+        time.sleep(interval)
+
+
+def download(request):
+    name, params, target = split(request)
+    job = get_current_job()
+    meta = job.meta
+    if meta["cds"]["state"] == "completed":
+        size = int(meta["cds"]["content_length"])
+        if not space.try_reserve(job.connection, job.id, target, size):
+            raise space.Full(f"{size} bytes do not fit on the volume of {target}")
+    scheduler.observe(job)
+    try:
+        account = accounts.get(meta["account"])
+        _download(account, meta["cds"], _source(params, target))
+        _decode(job, params, target)
+    finally:
+        space.release(job.connection, job.id, target)
+    metrics.record(job, name, params)
+    _finalise(request)
+
+
+def merge(sources, request):
+    with xr.open_mfdataset(sources, combine="by_coords") as ds:
+        conversion.unpacked(ds).to_netcdf(request["target"])
+    remove(*sources)
+    os.rmdir(os.path.dirname(sources[0]))
+    _finalise(request)
+
+
+def assemble(sources, request):
+    """Write a request from the files covering it and the retrieved `sources`.
+
+    `sources` are the hidden retrievals of the part not covered by the
+    catalog (see `era5._ECMWF._send_covered`); they are removed afterwards.
+    """
+    name, params, target = split(request)
+    paths = catalog.files(name, params) + list(sources)
+    datasets = [conversion.open_dataset(p, chunks={}) for p in paths]
+    try:
+        ds = select(datasets[0], params)
+        for other in datasets[1:]:
+            ds = ds.combine_first(select(other, params))
+        names = {variables.SHORT_NAMES.get(v, v) for v in params["variable"]}
+        expected = len(set(catalog.dates(params))) * len(params["time"])
+        if not names <= set(ds.data_vars) or ds.sizes["time"] != expected:
+            raise Exception(f"{target} is not covered by {paths}")
+        conversion.unpacked(ds).to_netcdf(target)
+    finally:
+        for each in datasets:
+            each.close()
+    if sources:
+        remove(*sources)
+        os.rmdir(os.path.dirname(sources[0]))
+    _finalise(request)
+
+
+def extract(source, request):
+    _, params, target = split(request)
+    with conversion.open_dataset(source) as ds:
+        select(ds, params).to_netcdf(target)
+    _finalise(request)
+
+
+def convert(request):
+    """Replace a finished file by a chunked and compressed copy."""
+    name, params, source = split(request)
+    stats = conversion.convert(source)
+    job = get_current_job()
+    job.meta["conversion"] = stats
+    job.save_meta()
+    catalog.record(name, params, stats["target"])
+    if conversion.REMOVE:
+        remove(source)
+    print(stats)
+
+
+def consolidate(request):
+    """Append a finished file to the time series stores of its variables."""
+    name, params, source = split(request)
+    job = get_current_job()
+    appended = consolidation.append(job.connection, name, params, source)
+    job.meta["consolidated"] = appended
+    job.save_meta()
+    return appended
+
+
+def derive(product, request):
+    """Compute a derived product from downloaded files (see `derived`)."""
+    name, params, target = split(request)
+    try:
+        sources = derived.sources(name, product, params)
+        if sources is None:
+            raise Exception(f"Inputs of {product} not downloaded")
+        derived.compute(product, sources, params, target)
+    except Exception:
+        # Triggered again by the next finished input (see `derived.guard`)
+        derived.release(get_current_job().connection, target)
+        raise
+    catalog.record(name, params, target)
+
+
+def postprocess(request):
+    """Replace a finished file by its regridded and aggregated copy."""
+    name, params, target = split(request)
+    spec = request["postprocess"]
+    partial = "{0}.reduced{1}".format(*os.path.splitext(target))
+    postprocessing.apply(target, partial, spec)
+    catalog.forget([target])
+    if spec["keep"]:
+        kept = postprocessing.full(target)
+        os.replace(target, kept)
+        catalog.record(name, params, kept)
+    os.replace(partial, target)
+    reduced = postprocessing.dataset(name, spec)
+    _finalise(dict(name=reduced, request=params, target=target))
+
+
+def remove(*paths):
+    for path in paths:
+        os.remove(path)
+    catalog.forget(paths)
+
+
+def split(request):
+    """Dataset name, request parameters and target of a request dict."""
+    params = request.get("request")
+    if params is None:
+        params = {k: v for k, v in request.items() if k not in OPTIONS}
+    return request["name"], params, request["target"]
+
+
+def select(ds, params):
+    """Part of `ds` within the cube of `params` (as far as `ds` covers it)."""
+    t = ds.time.dt
+    mask = t.year.isin([int(x) for x in params["year"]])
+    mask &= t.month.isin([int(x) for x in params["month"]])
+    if "day" in params:
+        mask &= t.day.isin([int(x) for x in params["day"]])
+    mask &= t.hour.isin([int(x[:2]) for x in params["time"]])
+    ds = ds.sel(time=mask)
+    if "pressure_level" in params:
+        levels = set(ds.level.values.tolist())
+        ds = ds.sel(
+            level=[int(x) for x in params["pressure_level"] if int(x) in levels]
+        )
+    names = [variables.SHORT_NAMES.get(v) for v in params["variable"]]
+    if all(names):
+        ds = ds[[n for n in names if n in ds.data_vars]]
+    north, west, south, east = params["area"]
+    return ds.sel(latitude=slice(north, south), longitude=slice(west, east))
+
+
+def _submit(account, limiter, name, params):
+    connection = get_current_job().connection
+    try:
+        reply = account.submitter.retrieve(name, params).reply
+    except Exception:
+        limiter.observe(error=True)
+        accounts.count(connection, account, errors=1)
+        raise
+    accounts.count(connection, account, submitted=1)
+    return reply
+
+
+def _wait(account, reply, limiter):
+    job = get_current_job()
+    submitted, started, sleep = time.time(), None, 1
+    while reply["state"] in ("queued", "running"):
+        time.sleep(sleep)
+        sleep = min(sleep * 1.5, account.client.sleep_max)
+        state, reply = reply["state"], _state(account, reply["request_id"])
+        if state == "queued" and reply["state"] != "queued":
+            started = time.time()
+            _started(job.connection, account, limiter, started - submitted)
+    accounts.count(job.connection, account, **{reply["state"]: 1})
+    finished = time.time()
+    started = started or finished
+    metrics.add(job, cds_queue=started - submitted, cds_processing=finished - started)
+    return reply
+
+
+def _started(connection, account, limiter, queue_seconds):
+    limiter.observe(queue_seconds=queue_seconds)
+    accounts.count(connection, account, started=1, queue_seconds=queue_seconds)
+
+
+def _download(account, reply, target, job=None):
+    if reply["state"] != "completed":
+        raise failures.RequestFailed(reply.get("error", {}))
+    c = account.client
+    size = int(reply["content_length"])
+    start = time.time()
+    sha256 = transfer.fetch(
+        c.session,
+        urljoin(c.url, reply["location"]),
+        target,
+        size,
+        verify=c.verify,
+        timeout=c.timeout,
+    )
+    seconds = time.time() - start
+    # Only now, a retried download needs the result (unlike `cdsapi.Result`)
+    c.robust(c.session.delete)(
+        f"{c.url}/tasks/{reply['request_id']}", verify=c.verify, timeout=c.timeout
+    )
+    job = job or get_current_job()
+    accounts.count(job.connection, account, bytes=size, download_seconds=seconds)
+    job.meta["sha256"] = sha256
+    metrics.add(job, bytes=size, download=seconds)
+
+
+def _source(params, target):
+    """File the result is downloaded to; GRIB is decoded into `target`."""
+    if params.get("format") == "grib" and not target.endswith(grib.EXTENSIONS):
+        return f"{target}.grib"
+    return target
+
+
+def _decode(job, params, target):
+    source = _source(params, target)
+    if source != target:
+        start = time.time()
+        grib.decode(source, target)
+        os.remove(source)
+        metrics.add(job, decode=time.time() - start)
+
+
+def _state(account, request_id):
+    s = account.submitter
+    reply = s.robust(s.session.get)(
+        f"{s.url}/tasks/{request_id}", verify=s.verify, timeout=s.timeout
+    )
+    reply.raise_for_status()
+    return reply.json()
+
+
+def _finalise(request, connection=None):
+    name, params, target = split(request)
+    if request.get("intermediate"):
+        return  # chunk or combined file, removed once merged or extracted
+    if target.endswith(grib.EXTENSIONS):
+        # Kept as GRIB, which neither extract nor assemble can read
+        store.materialise(connection or get_current_job().connection, target)
+        return
+    catalog.record(name, params, target)
+    connection = connection or get_current_job().connection
+    if "postprocess" in request:
+        # Linked and post-processed further once reduced
+        Queue(connection=connection).enqueue(
+            postprocess,
+            kwargs={"request": request},
+            description=target,
+            job_timeout="6h",
+        )
+        return
+    store.materialise(connection, target)
+    references.record(target)
+    if not (consolidation.ROOT or conversion.FORMAT or derived.ROOT):
+        return
+    queue = Queue(connection=connection)
+    options = dict(kwargs={"request": request}, description=target, job_timeout="6h")
+    depends_on = None
+    if consolidation.ROOT:
+        depends_on = queue.enqueue(consolidate, **options)
+    if conversion.FORMAT:
+        # The original may be removed after the conversion
+        depends_on = queue.enqueue(convert, depends_on=depends_on, **options)
+    if derived.ROOT:
+        for product, cube in derived.ready(name, params):
+            path = derived.target(name, product, cube)
+            if not derived.guard(connection, path):
+                continue  # triggered by another input already
+            queue.enqueue(
+                derive,
+                args=(product,),
+                kwargs={
+                    "request": dict(name=name, **cube, variable=[product], target=path)
+                },
+                description=path,
+                job_timeout="6h",
+                depends_on=depends_on,
+            )
+
+
+if __name__ == "__main__":
+    poll_forever(
+        Redis(
+            host=os.environ.get("REDIS_HOST", "redis"),
+            port=int(os.environ.get("REDIS_PORT", 6379)),
+        )
+    )
@@ -293,3 +293,40 @@ SINGLE_LEVELS = [
     "wave_spectral_skewness",
     "zero_degree_level",
 ]
+
+# Variable names inside the NetCDF files delivered by CDS. Only variables
+# listed here can be selected from a file holding several variables.
+SHORT_NAMES = {
+    "divergence": "d",
+    "fraction_of_cloud_cover": "cc",
+    "geopotential": "z",
+    "ozone_mass_mixing_ratio": "o3",
+    "potential_vorticity": "pv",
+    "relative_humidity": "r",
+    "specific_cloud_ice_water_content": "ciwc",
+    "specific_cloud_liquid_water_content": "clwc",
+    "specific_humidity": "q",
+    "specific_rain_water_content": "crwc",
+    "specific_snow_water_content": "cswc",
+    "temperature": "t",
+    "u_component_of_wind": "u",
+    "v_component_of_wind": "v",
+    "vertical_velocity": "w",
+    "vorticity": "vo",
+    "100m_u_component_of_wind": "u100",
+    "100m_v_component_of_wind": "v100",
+    "10m_u_component_of_wind": "u10",
+    "10m_v_component_of_wind": "v10",
+    "2m_dewpoint_temperature": "d2m",
+    "2m_temperature": "t2m",
+    "boundary_layer_height": "blh",
+    "land_sea_mask": "lsm",
+    "mean_sea_level_pressure": "msl",
+    "sea_surface_temperature": "sst",
+    "skin_temperature": "skt",
+    "surface_pressure": "sp",
+    "surface_solar_radiation_downwards": "ssrd",
+    "total_cloud_cover": "tcc",
+    "total_column_water_vapour": "tcwv",
+    "total_precipitation": "tp",
+}
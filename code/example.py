@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 # coding: utf-8
 
-from datarequests.era5 import ERA5PressureLevelsRequest
+from datarequests.era5 import ERA5PressureLevelsRequest, send_coalesced
 from datarequests.defaults import year, month
 
+pairs = []
 for v in ["temperature"]:
     for y in year()[:10]:
         for m in month():        
@@ -12,4 +13,5 @@ for v in ["temperature"]:
                 year=[y],
                 month=[m]
             )
-            req.send_request(f"/downloads/{y}/{m}/ERA5.pl.{v}.nc")
+            pairs.append((req, f"/downloads/{y}/{m}/ERA5.pl.{v}.nc"))
+send_coalesced(pairs)
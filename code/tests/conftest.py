@@ -0,0 +1,11 @@
+# -- coding: utf-8 --
+"""No CDS account, catalog or ledger of the repository is used by the tests."""
+
+import os
+import tempfile
+
+FOLDER = tempfile.mkdtemp(prefix="datarequests-tests-")
+os.environ.setdefault("CDSAPI_URL", "http://127.0.0.1:9/api/v2")
+os.environ.setdefault("CDSAPI_KEY", "0:tests")
+os.environ["DATAREQUESTS_CATALOG"] = os.path.join(FOLDER, "catalog.sqlite")
+os.environ["DATAREQUESTS_LEDGER"] = os.path.join(FOLDER, "ledger.sqlite")
@@ -0,0 +1,179 @@
+# -- coding: utf-8 --
+"""Tests of the coverage catalog and of requests served from it."""
+
+import fakeredis
+import pytest
+from rq import Queue
+
+from datarequests import catalog
+from datarequests import era5
+
+NAME = "reanalysis-era5-pressure-levels"
+GLOBAL = [90, -180, -90, 180]
+EUROPE = [70, -10, 35, 40]
+HOURS = [f"{h:02}:00" for h in range(24)]
+
+
+def _params(area=GLOBAL, **axes):
+    params = dict(
+        product_type="reanalysis",
+        variable=["temperature"],
+        pressure_level=["500", "850"],
+        year=["2000"],
+        month=["01"],
+        day=["01", "02"],
+        time=HOURS,
+        area=area,
+    )
+    params.update(axes)
+    return params
+
+
+@pytest.fixture
+def db(tmp_path):
+    return catalog.connect(str(tmp_path / "catalog.sqlite"))
+
+
+@pytest.fixture
+def record(db, tmp_path):
+    def record(filename, params, name=NAME):
+        path = tmp_path / filename
+        path.touch()
+        catalog.record(name, params, str(path), db)
+        return str(path)
+
+    return record
+
+
+def test_superset_exact(db, record):
+    path = record("a.nc", _params())
+    assert catalog.superset(NAME, _params(), db=db) == path
+
+
+def test_superset_covering_area_levels_and_hours(db, record):
+    path = record("global.nc", _params())
+    subset = _params(EUROPE, pressure_level=["850"], day=["02"], time=["12:00"])
+    assert catalog.superset(NAME, subset, db=db) == path
+    assert catalog.superset(NAME, _params(pressure_level=["250"]), db=db) is None
+    assert catalog.superset(NAME, _params(day=["03"]), db=db) is None
+    assert catalog.superset("reanalysis-era5-single-levels", subset, db=db) is None
+
+
+def test_superset_not_covering(db, record):
+    record("europe.nc", _params(EUROPE))
+    record("morning.nc", _params(time=HOURS[:12]))
+    record("first.nc", _params(day=["01"]))
+    assert catalog.superset(NAME, _params(), db=db) is None
+
+
+def test_superset_smallest_area(db, record):
+    record("global.nc", _params())
+    europe = record("europe.nc", _params(EUROPE))
+    assert catalog.superset(NAME, _params([60, 0, 50, 10]), db=db) == europe
+
+
+def test_superset_exact_variables(db, record):
+    path = record("both.nc", _params(variable=["temperature", "geopotential"]))
+    assert catalog.superset(NAME, _params(), db=db) == path
+    assert catalog.superset(NAME, _params(), exact_variables=True, db=db) is None
+
+
+def test_superset_removed_file(db, record, tmp_path):
+    record("gone.nc", _params())
+    (tmp_path / "gone.nc").unlink()
+    assert catalog.superset(NAME, _params(), db=db) is None
+
+
+def test_remainder(db, record):
+    record("first.nc", _params(day=["01"]))
+    record("morning.nc", _params(day=["02"], time=HOURS[:12]))
+    requested = _params(day=["01", "02"])
+    assert catalog.remainder(NAME, requested, db=db) == dict(
+        requested, day=["02"], time=HOURS[12:]
+    )
+    requested = _params(day=["01", "02", "03"])  # all hours of the 3rd
+    assert catalog.remainder(NAME, requested, db=db) == dict(
+        requested, day=["02", "03"]
+    )
+
+
+def test_remainder_variables_and_levels(db, record):
+    record("t.nc", _params())
+    record("z500.nc", _params(variable=["geopotential"], pressure_level=["500"]))
+    requested = _params(variable=["temperature", "geopotential"])
+    assert catalog.remainder(NAME, requested, db=db) == dict(
+        requested, variable=["geopotential"], pressure_level=["850"]
+    )
+
+
+def test_remainder_only_same_area(db, record):
+    record("global.nc", _params())
+    assert catalog.remainder(NAME, _params(), db=db) is None
+    assert catalog.remainder(NAME, _params(EUROPE), db=db) == _params(EUROPE)
+
+
+def test_files(db, record):
+    first = record("first.nc", _params(day=["01"]))
+    second = record("second.nc", _params(day=["02"]))
+    record("other.nc", _params(day=["03"]))
+    record("europe.nc", _params(EUROPE))
+    assert catalog.files(NAME, _params(), db=db) == [first, second]
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(era5, "REDIS_CONNECTION", connection)
+    monkeypatch.setattr(era5, "QUE", Queue(connection=connection))
+    return connection
+
+
+def _request(**axes):
+    defaults = dict(
+        variable=["temperature"],
+        pressure_level=["500", "850"],
+        year=["2000"],
+        month=["01"],
+        day=["01", "02"],
+        time=HOURS,
+    )
+    return era5.ERA5PressureLevelsRequest(**dict(defaults, **axes))
+
+
+def test_send_covered_output_itself(db, record, connection):
+    request = _request()
+    output = record("output.nc", request._request)
+    assert request._send_covered(output, db) == "covered"
+    assert not connection.keys("rq:job:*")
+
+
+def test_send_covered_extract(db, record, connection, tmp_path):
+    source = record("global.nc", _request()._request)
+    request = _request(lat_boundary=(70, 35), lon_boundary=(-10, 40), day=["02"])
+    job = request._send_covered(str(tmp_path / "europe.nc"), db)
+    assert job.id == request.job_id
+    assert job.func_name == "datarequests.tasks.extract"
+    assert job.kwargs["source"] == source
+
+
+def test_send_covered_assemble(db, record, connection, tmp_path):
+    first = record("first.nc", _request(day=["01"])._request)
+    request = _request(day=["01", "02", "03"])
+    job = request._send_covered(str(tmp_path / "output.nc"), db)
+    assert job.id == request.job_id
+    assert job.func_name == "datarequests.tasks.assemble"
+    assert job._dependency_ids == [f"{request.job_id}-0000"]
+    (source,) = job.kwargs["sources"]
+    retrieval = era5.Job.fetch(f"{request.job_id}-0000", connection=connection)
+    chunk = retrieval.kwargs["request"]
+    assert chunk["intermediate"] and chunk["target"] == source
+    assert chunk["request"]["day"] == ["02", "03"]
+    assert first not in job.kwargs["sources"]
+
+
+def test_send_covered_nothing(db, record, connection, tmp_path):
+    record(
+        "europe.nc", _request(lat_boundary=(70, 35), lon_boundary=(-10, 40))._request
+    )
+    assert _request()._send_covered(str(tmp_path / "output.nc"), db) is None
+    assert not connection.keys("rq:job:*")
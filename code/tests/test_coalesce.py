@@ -0,0 +1,117 @@
+# -- coding: utf-8 --
+"""Tests of combined retrievals of `datarequests.coalesce` and `send_coalesced`."""
+
+import os
+
+import fakeredis
+import pytest
+from rq import Queue, SimpleWorker
+from rq.job import Job
+
+from datarequests import coalesce
+from datarequests import era5
+
+
+def _single(**axes):
+    defaults = dict(variable=["2m_temperature"], year=["2000"], month=["01"])
+    return era5.ERA5SingleLevelsRequest(
+        **dict(defaults, day=["01"], time=["00:00"]) | axes
+    )
+
+
+def _pressure(**axes):
+    defaults = dict(variable=["temperature"], pressure_level=["500"], year=["2000"])
+    return era5.ERA5PressureLevelsRequest(
+        **dict(defaults, month=["01"], day=["01"], time=["00:00"]) | axes
+    )
+
+
+def _groups(requests, **kwargs):
+    pairs = [(r, f"{n}.nc") for n, r in enumerate(requests)]
+    return [
+        (combined, [output for _, output in members])
+        for combined, members in coalesce.group(pairs, **kwargs)
+    ]
+
+
+def test_group_along_one_axis():
+    ((combined, outputs),) = _groups([_single(month=[m]) for m in ("03", "01", "02")])
+    assert combined.month == ["01", "02", "03"]
+    assert sorted(outputs) == ["0.nc", "1.nc", "2.nc"]
+
+
+def test_group_axis_by_axis():
+    requests = [
+        _pressure(variable=[v], month=[m])
+        for v in ("temperature", "geopotential")
+        for m in ("01", "02")
+    ]
+    ((combined, outputs),) = _groups(requests)
+    assert combined.month == ["01", "02"]
+    assert sorted(combined.variable) == ["geopotential", "temperature"]
+    assert len(outputs) == 4
+
+
+def test_group_differing_in_two_axes():
+    groups = _groups(
+        [_single(month=["01"], day=["01"]), _single(month=["02"], day=["02"])]
+    )
+    assert [outputs for _, outputs in groups] == [["0.nc"], ["1.nc"]]
+
+
+def test_group_not_across_areas():
+    requests = [_single(month=["01"]), _single(month=["02"], lat_boundary=(10, 0))]
+    assert len(_groups(requests)) == 2
+
+
+def test_group_max_fields():
+    groups = _groups([_single(month=[f"{m:02}"]) for m in range(1, 5)], max_fields=2)
+    assert [combined.month for combined, _ in groups] == [["01", "02"], ["03", "04"]]
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    connection = fakeredis.FakeStrictRedis()
+    monkeypatch.setattr(era5, "REDIS_CONNECTION", connection)
+    monkeypatch.setattr(era5, "QUE", Queue(connection=connection))
+    return connection
+
+
+def _job(connection, request, status, **meta):
+    job = Job.create(print, id=request.job_id, connection=connection)
+    job.meta.update(meta)
+    job.save()
+    job.set_status(status)
+
+
+def test_send_coalesced(connection, tmp_path):
+    requests = [_single(month=[f"{m:02}"]) for m in range(1, 6)]
+    _job(connection, requests[0], "failed", failure="transient")
+    _job(connection, requests[1], "failed", failure="invalid")
+    _job(connection, requests[2], "finished")
+    pairs = [(r, str(tmp_path / f"{n}.nc")) for n, r in enumerate(requests)]
+    jobs = era5.send_coalesced(pairs + [pairs[3]])
+    assert jobs[1:3] == ["failed", "finished"]
+    assert jobs[5] is jobs[3]
+    for n in (0, 3, 4):  # the failed first month is sent again
+        assert jobs[n].id == requests[n].job_id
+        assert jobs[n].func_name == "datarequests.tasks.extract"
+    sources = {job.kwargs["source"] for job in (jobs[0], jobs[3], jobs[4])}
+    assert len(sources) == 1
+
+
+def test_send_coalesced_cleanup_after_failed_extracts(connection, tmp_path):
+    pairs = [(_single(month=[m]), str(tmp_path / f"{m}.nc")) for m in ("01", "02")]
+    first, _ = era5.send_coalesced(pairs)
+    source = first.kwargs["source"]
+    with open(source, "wb") as f:
+        f.write(b"not NetCDF")
+    retrieval = Job.fetch(first._dependency_ids[0], connection=connection)
+    retrieval.set_status("finished")
+    era5.QUE.enqueue_dependents(retrieval)
+    SimpleWorker([era5.QUE], connection=connection).work(burst=True)
+    statuses = [
+        Job.fetch(r.job_id, connection=connection).get_status() for r, _ in pairs
+    ]
+    assert statuses == ["failed", "failed"]
+    assert not os.path.exists(source)
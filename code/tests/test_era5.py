@@ -0,0 +1,56 @@
+# -- coding: utf-8 --
+"""Tests of the requests generated by `datarequests.era5.expand`."""
+
+import pytest
+
+from datarequests import era5
+
+SINGLE = "reanalysis-era5-single-levels"
+PRESSURE = "reanalysis-era5-pressure-levels"
+AREA = dict(lat_boundary=(70, 35), lon_boundary=(-10, 40))
+POSTPROCESS = dict(postprocess=dict(grid=1.0, aggregate="daily"))
+
+
+def _check(dataset, split, **axes):
+    triples = list(era5.expand(dataset, "{variable}.nc", split=split, **axes))
+    assert triples
+    for request, path, job_id in triples:
+        chosen = {a: getattr(request, a) for a in split}
+        expected = era5.DATASETS[dataset](**dict(axes, **chosen))
+        assert job_id == expected.job_id == request.job_id
+        assert request._request == expected._request
+        assert path == f"{request.variable[0]}.nc"
+    return triples
+
+
+@pytest.mark.parametrize("extra", [{}, AREA, POSTPROCESS, dict(AREA, **POSTPROCESS)])
+def test_expand_single_levels(extra):
+    triples = _check(
+        SINGLE,
+        ("variable", "year", "month"),
+        variable=["2m_temperature", "total_precipitation"],
+        year=range(2000, 2002),
+        month=["02", "01"],
+        day=["01", "02"],
+        **extra,
+    )
+    assert len(triples) == 8
+    assert len({job_id for _, _, job_id in triples}) == 8
+
+
+@pytest.mark.parametrize("extra", [{}, AREA, POSTPROCESS, dict(AREA, **POSTPROCESS)])
+def test_expand_pressure_levels(extra):
+    triples = _check(
+        PRESSURE,
+        ("variable", "pressure_level"),
+        variable=["temperature", "geopotential"],
+        pressure_level=["850", "500"],
+        year=["2000"],
+        month=["01"],
+        **extra,
+    )
+    assert len(triples) == 4
+
+
+def test_expand_nothing():
+    assert not list(era5.expand(SINGLE, "{variable}.nc", variable=[]))
@@ -0,0 +1,130 @@
+# -- coding: utf-8 --
+"""Tests of the classification and handling of failed retrievals."""
+
+from datetime import datetime, timedelta, timezone
+
+import fakeredis
+import pytest
+import requests
+from rq import Queue
+from rq.job import Job
+from rq.registry import ScheduledJobRegistry
+from rq.timeouts import JobTimeoutException
+
+from datarequests import accounts
+from datarequests import failures
+from datarequests import space
+
+
+def _http_error(status):
+    response = requests.Response()
+    response.status_code = status
+    return requests.HTTPError(f"{status} error", response=response)
+
+
+@pytest.mark.parametrize(
+    "error, kind",
+    [
+        (JobTimeoutException("Task exceeded maximum timeout value"), "timeout"),
+        (requests.ConnectionError("reset by peer"), "transient"),
+        (TimeoutError(), "transient"),
+        (_http_error(503), "transient"),
+        (_http_error(429), "transient"),
+        (_http_error(400), "unknown"),
+        (Exception("Request is too large, cost limits exceeded"), "too_large"),
+        (Exception("The request is not valid"), "invalid"),
+        (Exception("Download incomplete: 10 of 20 bytes"), "transient"),
+        (Exception("division by zero"), "unknown"),
+        ("", "unknown"),
+    ],
+)
+def test_classify(error, kind):
+    assert failures.classify(error) == kind
+
+
+def test_classify_traceback():
+    traceback = (
+        "Traceback (most recent call last):\n"
+        '  File "tasks.py", line 1, in get_data\n'
+        "    raise Exception('invalid input')\n"
+        "Exception: Service Unavailable\n"
+    )
+    assert failures.classify(traceback) == "transient"
+
+
+def test_classify_request_failed():
+    error = failures.RequestFailed(dict(message="Too large", reason="limit is 120000"))
+    assert failures.classify(error) == "too_large"
+
+
+@pytest.fixture
+def queue():
+    return Queue(connection=fakeredis.FakeStrictRedis())
+
+
+def _job(queue, func="datarequests.tasks.get_data", **meta):
+    job = Job.create(func, kwargs={"request": {}}, connection=queue.connection)
+    job.origin = queue.name
+    job.meta.update(meta)
+    job.save()
+    job.set_status("failed")
+    return job
+
+
+def _scheduled(queue, job):
+    registry = ScheduledJobRegistry(queue=queue)
+    assert job.id in registry.get_job_ids()
+    return registry.get_scheduled_time(job)
+
+
+@pytest.mark.parametrize(
+    "error, seconds",
+    [
+        (space.Full("does not fit"), space.HOLD),
+        (accounts.Busy("no free slot"), accounts.WAIT),
+    ],
+)
+def test_handle_held(queue, error, seconds):
+    job = _job(queue, "datarequests.tasks.submit")
+    start = datetime.now(timezone.utc)
+    assert failures.handle(job, type(error), error, None)
+    at = _scheduled(queue, job)
+    assert start + timedelta(seconds=seconds - 1) <= at
+    assert at <= datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    job.refresh()
+    assert job.get_status() == "scheduled"
+    assert "failure" not in job.meta and "retries" not in job.meta
+
+
+def test_handle_transient(queue, monkeypatch):
+    monkeypatch.setitem(failures.BACKOFF, failures.TRANSIENT, 10)
+    job = _job(queue)
+    error = requests.ConnectionError("reset by peer")
+    start = datetime.now(timezone.utc)
+    assert failures.handle(job, type(error), error, None)
+    at = _scheduled(queue, job)
+    assert start + timedelta(seconds=4) <= at <= start + timedelta(seconds=11)
+    job.refresh()
+    assert job.meta == dict(failure="transient", retries=1)
+
+
+def test_handle_retries_exhausted(queue):
+    job = _job(queue, retries=failures.RETRIES + 1)
+    error = requests.ConnectionError("reset by peer")
+    assert failures.handle(job, type(error), error, None)
+    assert not ScheduledJobRegistry(queue=queue).get_job_ids()
+    job.refresh()
+    assert job.meta["retries"] == failures.RETRIES + 2
+
+
+@pytest.mark.parametrize(
+    "func, error",
+    [
+        ("datarequests.tasks.get_data", Exception("The request is not valid")),
+        ("datarequests.tasks.extract", requests.ConnectionError("reset by peer")),
+    ],
+)
+def test_handle_not_retried(queue, func, error):
+    job = _job(queue, func)
+    assert failures.handle(job, type(error), error, None)
+    assert not ScheduledJobRegistry(queue=queue).get_job_ids()
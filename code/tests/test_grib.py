@@ -0,0 +1,61 @@
+# -- coding: utf-8 --
+"""Tests of the local GRIB decode of `datarequests.grib`."""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+eccodes = pytest.importorskip("eccodes")
+
+from datarequests import grib  # noqa: E402
+from datarequests import tasks  # noqa: E402
+
+SHORT_NAMES = {"2t": "2m_temperature", "10u": "10m_u_component_of_wind"}
+
+
+def _grib(path):
+    """Two hours of `SHORT_NAMES` on a 1 degree grid, values `hour * 10 + i`."""
+    with open(path, "wb") as f:
+        for hour in (0, 1):
+            for i, short in enumerate(SHORT_NAMES):
+                gid = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib1")
+                eccodes.codes_set_key_vals(
+                    gid,
+                    dict(
+                        Ni=4,
+                        Nj=3,
+                        latitudeOfFirstGridPointInDegrees=2.0,
+                        latitudeOfLastGridPointInDegrees=0.0,
+                        longitudeOfFirstGridPointInDegrees=0.0,
+                        longitudeOfLastGridPointInDegrees=3.0,
+                        iDirectionIncrementInDegrees=1.0,
+                        jDirectionIncrementInDegrees=1.0,
+                    ),
+                )
+                eccodes.codes_set(gid, "shortName", short)
+                eccodes.codes_set(gid, "dataDate", 20000101)
+                eccodes.codes_set(gid, "dataTime", hour * 100)
+                eccodes.codes_set_values(gid, np.full(12, hour * 10.0 + i))
+                eccodes.codes_write(gid, f)
+                eccodes.codes_release(gid)
+
+
+@pytest.mark.parametrize("suffix", [".nc", ".zarr"])
+def test_decode_netcdf_names(tmp_path, suffix):
+    source, target = tmp_path / "result.grib", str(tmp_path / f"result{suffix}")
+    _grib(source)
+    grib.decode(str(source), target)
+    with xr.open_dataset(target, engine="zarr" if suffix == ".zarr" else None) as ds:
+        assert sorted(ds.data_vars) == ["t2m", "u10"]
+        np.testing.assert_allclose(ds.t2m.values[:, 0, 0], [0, 10], atol=0.01)
+        params = dict(
+            variable=["2m_temperature"],
+            year=["2000"],
+            month=["01"],
+            day=["01"],
+            time=["01:00"],
+            area=[2, 0, 0, 1],
+        )
+        selected = tasks.select(ds, params)
+        assert list(selected.data_vars) == ["t2m"]
+        assert selected.t2m.shape == (1, 3, 2)
@@ -0,0 +1,70 @@
+# -- coding: utf-8 --
+"""Tests of archiving ended jobs from Redis into the ledger."""
+
+from datetime import timedelta
+
+import fakeredis
+import pytest
+from rq import Queue
+from rq.job import Job
+from rq.registry import FailedJobRegistry, FinishedJobRegistry
+from rq.results import Result
+from rq.utils import utcnow
+
+from datarequests import ledger
+
+
+@pytest.fixture
+def queue():
+    return Queue(connection=fakeredis.FakeStrictRedis())
+
+
+@pytest.fixture
+def db(tmp_path):
+    return ledger.connect(str(tmp_path / "ledger.sqlite"))
+
+
+def _job(queue, job_id, status, hours=48, **kwargs):
+    job = Job.create(print, id=job_id, connection=queue.connection, **kwargs)
+    job.origin = queue.name
+    job.ended_at = utcnow() - timedelta(hours=hours)
+    job.save()
+    job.set_status(status)
+    return job
+
+
+def _ended(queue, job_id, status="finished", exc_info=None, **kwargs):
+    job = _job(queue, job_id, status, **kwargs)
+    if status == "failed":
+        FailedJobRegistry(queue=queue).add(job, ttl=-1, exc_string=exc_info)
+        Result.create_failure(job, ttl=None, exc_string=exc_info)
+    else:
+        FinishedJobRegistry(queue=queue).add(job, ttl=-1)
+    return job
+
+
+def test_archive(queue, db, monkeypatch):
+    _ended(queue, "old")
+    _ended(queue, "recent", hours=1)
+    _ended(queue, "failed", "failed", exc_info="Traceback\nException: no data")
+    for job_id, dependent, status in (
+        ("waited", "deferred", "deferred"),
+        ("released", "queued", "queued"),
+        ("gone", "deleted", None),
+    ):
+        _ended(queue, job_id)
+        if status is not None:
+            _job(queue, dependent, status)
+        queue.connection.sadd(Job.dependents_key_for(job_id), dependent)
+    for command in ("smembers", "hget"):  # pipelined, not per job
+        monkeypatch.setattr(queue.connection, command, None)
+    assert ledger.archive(queue.connection, [queue.name], db=db) == 4
+    assert ledger.statuses(
+        ["old", "recent", "failed", "waited", "released", "gone"], db=db
+    ) == ["finished", None, "failed", None, "finished", "finished"]
+    assert ledger.get("failed", db=db)["error"] == "Exception: no data"
+    assert not Job.exists("old", connection=queue.connection)
+    assert Job.exists("waited", connection=queue.connection)
+    registry = FinishedJobRegistry(queue=queue)
+    assert sorted(registry.get_job_ids()) == ["recent", "waited"]
+    assert not FailedJobRegistry(queue=queue).get_job_ids()
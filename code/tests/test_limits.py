@@ -0,0 +1,80 @@
+# -- coding: utf-8 --
+"""Tests of the distributed semaphore limiting CDS requests in flight."""
+
+import time
+
+import fakeredis
+import pytest
+
+from datarequests import limits
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    monkeypatch.setattr(limits, "LIMIT", 2)
+    monkeypatch.setattr(limits, "ADAPTIVE", True)
+    return limits.Limiter(fakeredis.FakeStrictRedis(), "user")
+
+
+def test_acquire_up_to_limit(limiter):
+    assert limiter.try_acquire("a")
+    assert limiter.try_acquire("b")
+    assert not limiter.try_acquire("c")
+    assert limiter.try_acquire("a")  # held already
+    assert limiter.inflight() == 2
+    limiter.release("a")
+    assert limiter.try_acquire("c")
+    assert not limiter.try_acquire("a")
+
+
+def test_expired_leases(limiter):
+    limiter.connection.zadd(limiter.key, {"crashed": time.time() - 1})
+    assert limiter.inflight() == 0
+    assert limiter.try_acquire("a")
+    assert limiter.try_acquire("b")
+    assert limiter.connection.zscore(limiter.key, "crashed") is None
+
+
+def test_limits_per_account(limiter):
+    other = limits.Limiter(limiter.connection, "other")
+    assert limiter.try_acquire("a") and limiter.try_acquire("b")
+    assert other.try_acquire("c")
+    limiter.connection.set(other.limit_key, 0)
+    assert not other.try_acquire("d")
+    assert limiter.limit == 2
+
+
+def test_observe_increase_when_full(limiter):
+    limiter.observe(queue_seconds=1)
+    assert limiter.limit == 2  # not all slots used
+    limiter.try_acquire("a")
+    limiter.try_acquire("b")
+    limiter.observe(queue_seconds=1)
+    assert limiter.limit == 3
+    assert limiter.try_acquire("c")
+
+
+def test_observe_decrease(limiter):
+    limiter.connection.set(limiter.limit_key, 9)
+    limiter.observe(queue_seconds=limits.TARGET_QUEUE + 1)
+    assert limiter.limit == 8
+    limiter.observe(error=True)
+    assert limiter.limit == 4
+    for _ in range(3):
+        limiter.observe(error=True)
+    assert limiter.limit == limits.MIN_LIMIT
+
+
+def test_observe_bounds(limiter, monkeypatch):
+    monkeypatch.setattr(limits, "MAX_LIMIT", 2)
+    limiter.try_acquire("a")
+    limiter.try_acquire("b")
+    limiter.observe(queue_seconds=1)
+    assert limiter.limit == 2
+
+
+def test_observe_not_adaptive(limiter, monkeypatch):
+    monkeypatch.setattr(limits, "ADAPTIVE", False)
+    limiter.observe(error=True)
+    assert limiter.limit == 2
+    assert limiter.connection.get(limiter.limit_key) is None
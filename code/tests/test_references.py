@@ -0,0 +1,83 @@
+# -- coding: utf-8 --
+"""Tests of the reference index of `datarequests.references`."""
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from datarequests import catalog
+from datarequests import references
+
+NAME = "reanalysis-era5-single-levels"
+
+
+def _file(path, day, **kwargs):
+    """Day of hourly 2m temperature on a small global grid."""
+    time = pd.date_range(f"2000-01-{day:02}", periods=24, freq="h")
+    values = 250 + np.arange(24 * 3 * 4, dtype="f4").reshape(24, 3, 4) / 10
+    ds = xr.Dataset(
+        {"t2m": (("time", "latitude", "longitude"), values)},
+        dict(time=time, latitude=[90.0, 0, -90], longitude=[-180.0, -90, 0, 90]),
+    )
+    ds.to_netcdf(path, **kwargs)
+    return ds
+
+
+def _record(db, path, day):
+    params = dict(
+        variable=["2m_temperature"],
+        year=["2000"],
+        month=["01"],
+        day=[f"{day:02}"],
+        time=[f"{h:02}:00" for h in range(24)],
+        area=references.AREA,
+    )
+    catalog.record(NAME, params, str(path), db)
+    return references.record(str(path), db)
+
+
+@pytest.fixture
+def db(tmp_path):
+    return catalog.connect(str(tmp_path / "catalog.sqlite"))
+
+
+packed = dict(dtype="int16", scale_factor=0.01, add_offset=250.0, _FillValue=-32767)
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        dict(format="NETCDF3_64BIT"),  # as delivered by CDS
+        dict(format="NETCDF3_64BIT", encoding={"t2m": packed}),
+        dict(format="NETCDF4"),  # as written by merge, assemble or extract
+        dict(format="NETCDF4", encoding={"t2m": dict(packed, zlib=True)}),
+    ],
+)
+def test_open_dataset(db, tmp_path, kwargs):
+    expected = xr.concat(
+        [_file(tmp_path / f"{day}.nc", day, **kwargs) for day in (2, 1)], "time"
+    ).sortby("time")
+    assert all(_record(db, tmp_path / f"{day}.nc", day) for day in (2, 1))
+    ds = references.open_dataset(NAME, "2m_temperature", db=db)
+    np.testing.assert_array_equal(
+        ds.time.values.astype("datetime64[ns]"),
+        expected.time.values.astype("datetime64[ns]"),
+    )
+    np.testing.assert_allclose(ds.t2m.values, expected.t2m.values, atol=0.006)
+    np.testing.assert_allclose(
+        ds.t2m.isel(latitude=1, longitude=2).values,
+        expected.t2m.isel(latitude=1, longitude=2).values,
+        atol=0.006,
+    )
+
+
+def test_warn_not_indexed(db, tmp_path):
+    _file(tmp_path / "1.nc", 1)
+    assert _record(db, tmp_path / "1.nc", 1)
+    (tmp_path / "2.nc").write_bytes(b"GRIB")
+    with pytest.warns(UserWarning, match="not indexed"):
+        assert not _record(db, tmp_path / "2.nc", 2)
+    with pytest.warns(UserWarning, match="1 files of 2m_temperature"):
+        ds = references.open_dataset(NAME, "2m_temperature", db=db)
+    assert len(ds.time) == 24
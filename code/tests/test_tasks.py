@@ -0,0 +1,88 @@
+# -- coding: utf-8 --
+"""Tests of the poller and of jobs run after a download."""
+
+import json
+import time
+
+import fakeredis
+import pytest
+from rq import Queue, SimpleWorker
+from rq.job import Job
+
+from datarequests import accounts
+from datarequests import derived
+from datarequests import space
+from datarequests import tasks
+
+ACCOUNT = "0"  # user of CDSAPI_KEY (see `conftest.py`)
+
+
+@pytest.fixture
+def states(monkeypatch):
+    states = {}
+    monkeypatch.setattr(
+        tasks,
+        "_state",
+        lambda account, request_id: dict(state=states.get(request_id, "completed")),
+    )
+    return states
+
+
+@pytest.fixture
+def connection(states):
+    return fakeredis.FakeStrictRedis()
+
+
+def _pending(connection, request_id, job_id):
+    limiter = accounts.get(ACCOUNT).limiter(connection)
+    assert limiter.try_acquire(job_id)
+    entry = dict(job=job_id, account=ACCOUNT, submitted=time.time(), started=None)
+    connection.hset(tasks.PENDING, request_id, json.dumps(entry))
+
+
+def test_poll_releases_job(connection):
+    queue = Queue(connection=connection)
+    job = Job.create(print, id="download", connection=connection, origin=queue.name)
+    job.save()
+    job.set_status("deferred")
+    _pending(connection, "request", job.id)
+    assert tasks.poll(connection) == dict(completed=1)
+    assert queue.job_ids == ["download"]
+    job.refresh()
+    assert job.meta["cds"] == dict(state="completed")
+    assert not connection.hlen(tasks.PENDING)
+    assert accounts.get(ACCOUNT).limiter(connection).inflight() == 0
+
+
+def test_poll_missing_job(connection, states, tmp_path):
+    ledger = space.LEDGER.format(space.volume(str(tmp_path / "gone.nc")))
+    connection.hset(ledger, "gone", json.dumps([1, time.time() + space.LEASE]))
+    _pending(connection, "orphan", "gone")
+    _pending(connection, "queued", "other")
+    states["queued"] = "queued"
+    assert tasks.poll(connection) == dict(completed=1, missing=1, queued=1)
+    assert connection.hkeys(tasks.PENDING) == [b"queued"]
+    assert accounts.get(ACCOUNT).limiter(connection).inflight() == 1
+    assert connection.hget(ledger, "gone") is None
+
+
+def test_derive_failed_releases_guard(connection, tmp_path):
+    target = str(tmp_path / "wind.nc")
+    request = dict(
+        name="reanalysis-era5-single-levels",
+        year=["2000"],
+        month=["01"],
+        day=["01"],
+        time=["00:00"],
+        area=[90, -180, -90, 180],
+        variable=["10m_wind_speed"],
+        target=target,
+    )
+    assert derived.guard(connection, target)
+    queue = Queue(connection=connection)
+    job = queue.enqueue(
+        tasks.derive, args=("10m_wind_speed",), kwargs=dict(request=request)
+    )
+    SimpleWorker([queue], connection=connection).work(burst=True)
+    assert job.get_status() == "failed"
+    assert derived.guard(connection, target)
@@ -0,0 +1,133 @@
+# -- coding: utf-8 --
+"""Tests of the resumable and segmented downloads of `datarequests.transfer`."""
+
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from datarequests import transfer
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve `PAYLOAD`, with range requests unless `server.ranges` is false."""
+
+    def do_HEAD(self):
+        if not self.server.head:
+            self.send_error(405)
+            return
+        self._headers(200, len(PAYLOAD))
+
+    def do_GET(self):
+        self.server.requested.append(self.headers.get("Range"))
+        start, end = 0, len(PAYLOAD)
+        value = self.headers.get("Range")
+        if value and self.server.ranges:
+            first, _, last = value.split("=", 1)[1].partition("-")
+            start, end = int(first), int(last) + 1 if last else len(PAYLOAD)
+        self._headers(206 if (value and self.server.ranges) else 200, end - start)
+        self.wfile.write(PAYLOAD[start:end])
+
+    def _headers(self, status, length):
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        if self.server.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.ranges, server.head, server.requested = True, True, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    server.url = f"http://127.0.0.1:{server.server_port}/result.nc"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(transfer, "MIN_SEGMENT_SIZE", 64 << 10)
+
+
+def _part(url, target):
+    return f"{target}.{hashlib.md5(url.encode('utf-8')).hexdigest()[:8]}.part"
+
+
+def _fetch(server, target, segments):
+    return transfer.fetch(
+        requests.Session(), server.url, str(target), len(PAYLOAD), segments=segments
+    )
+
+
+def _check(target, sha256):
+    assert target.read_bytes() == PAYLOAD
+    assert sha256 == hashlib.sha256(PAYLOAD).hexdigest()
+    assert os.listdir(target.parent) == [target.name]
+
+
+def test_segments(server, tmp_path):
+    target = tmp_path / "result.nc"
+    _check(target, _fetch(server, target, 4))
+    assert len(server.requested) == 4
+
+
+@pytest.mark.parametrize("ranges,head", [(False, True), (True, False)])
+def test_single_stream_without_ranges(server, tmp_path, ranges, head):
+    server.ranges, server.head = ranges, head
+    target = tmp_path / "result.nc"
+    _check(target, _fetch(server, target, 4))
+    assert server.requested == [None]
+
+
+def test_resume_stream(server, tmp_path):
+    target = tmp_path / "result.nc"
+    with open(_part(server.url, target), "wb") as f:
+        f.write(PAYLOAD[:1000])
+    _check(target, _fetch(server, target, 1))
+    assert server.requested == ["bytes=1000-"]
+
+
+def test_restart_stream_without_ranges(server, tmp_path):
+    server.ranges = False
+    target = tmp_path / "result.nc"
+    with open(_part(server.url, target), "wb") as f:
+        f.write(b"\xff" * 1000)  # not trusted without a range reply
+    _check(target, _fetch(server, target, 1))
+
+
+def test_resume_segments(server, tmp_path):
+    target = tmp_path / "result.nc"
+    part, half = _part(server.url, target), len(PAYLOAD) // 2
+    with open(part, "wb") as f:
+        f.write(PAYLOAD[:100] + b"\0" * (half - 100) + PAYLOAD[half : half + 200])
+    with open(f"{part}.json", "w") as f:
+        json.dump({"0": 100, str(half): half + 200}, f)
+    _check(target, _fetch(server, target, 2))
+    assert sorted(server.requested) == [
+        f"bytes=100-{half - 1}",
+        f"bytes={half + 200}-{len(PAYLOAD) - 1}",
+    ]
+
+
+def test_segments_restart_as_stream(server, tmp_path):
+    target = tmp_path / "result.nc"
+    part = _part(server.url, target)
+    with open(part, "wb") as f:
+        f.write(b"\0" * len(PAYLOAD))  # preallocated, nothing written yet
+    with open(f"{part}.json", "w") as f:
+        json.dump({"0": 0}, f)
+    server.ranges = False
+    _check(target, _fetch(server, target, 2))
+    assert server.requested == [None]